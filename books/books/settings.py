@@ -52,11 +52,14 @@ INTERNAL_IPS = [
 ]
 
 MIDDLEWARE = [
+    'store.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'store.routers.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'store.querybudget.QueryBudgetMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
@@ -94,6 +97,86 @@ DATABASES = {
     }
 }
 
+# рабочая БД задаётся окружением (или .env): DB_ENGINE=postgresql|sqlite3,
+# DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT; бэкенды store.db
+# умеют пул соединений и проверку соединений (см. store.db.pool)
+DB_ENGINE = os.getenv('DB_ENGINE')
+if DB_ENGINE:
+    # 0 - без пула
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '0'))
+    DATABASES['default'] = {
+        'ENGINE': f'store.db.backends.{DB_ENGINE}',
+        'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+        'USER': os.getenv('DB_USER', ''),
+        'PASSWORD': os.getenv('DB_PASSWORD', ''),
+        'HOST': os.getenv('DB_HOST', ''),
+        'PORT': os.getenv('DB_PORT', ''),
+        # постоянные соединения; с пулом соединение после каждого запроса
+        # возвращается в пул и держать его в потоке незачем
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE',
+                                      '0' if DB_POOL_SIZE else '60')),
+        # перед первым запросом к БД в каждом запросе к сайту
+        'CONN_HEALTH_CHECKS': os.getenv('DB_HEALTH_CHECKS', '1') == '1',
+        'POOL': {
+            'MAX_SIZE': DB_POOL_SIZE,
+            'MIN_SIZE': int(os.getenv('DB_POOL_MIN_SIZE', '0')),
+            'TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', '5')),
+            'MAX_LIFETIME': int(os.getenv('DB_POOL_MAX_LIFETIME', '1800')),
+        } if DB_POOL_SIZE else None,
+    }
+
+# SQLITE_TUNING=1 - режим SQLite для рабочей установки: WAL и PRAGMA при
+# открытии каждого соединения (см. store.db.sqlite)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    # отрицательное - в КиБ
+    'cache_size': -int(os.getenv('SQLITE_CACHE_KB', '65536')),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'temp_store': 'memory',
+} if os.getenv('SQLITE_TUNING') == '1' else {}
+# повторы записи после «database is locked»
+SQLITE_LOCKED_RETRIES = int(os.getenv('SQLITE_LOCKED_RETRIES', '5'))
+SQLITE_LOCKED_RETRY_DELAY = float(
+    os.getenv('SQLITE_LOCKED_RETRY_DELAY', '0.05'))
+
+# реплики только для чтения: DATABASE_REPLICAS=/path/replica1.sqlite3,...
+READ_REPLICAS = []
+for index, name in enumerate(
+        filter(None, os.getenv('DATABASE_REPLICAS', '').split(',')), 1):
+    DATABASES[f'replica{index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name.strip(),
+    }
+    READ_REPLICAS.append(f'replica{index}')
+
+# каталог, через который воркеры gunicorn отдают общие метрики /metrics,
+# без него каждый процесс отдаёт свои
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+# /metrics отдаётся только с этих адресов или сетей (REMOTE_ADDR, за
+# прокси - адрес прокси) и запросам с Authorization: Bearer METRICS_TOKEN
+METRICS_ALLOWED_IPS = [
+    network.strip() for network in
+    os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+    if network.strip()]
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# бюджеты запросов view (store.querybudget): 'log', 'raise' или 'off'
+QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'log')
+# столько одинаковых запросов за запрос к API считается N+1
+QUERY_BUDGET_REPEATS = int(os.getenv('QUERY_BUDGET_REPEATS', '5'))
+
+# насколько может отставать реплика: столько секунд после записи клиент
+# читает с основной БД
+READ_REPLICA_MAX_LAG = int(os.getenv('READ_REPLICA_MAX_LAG', '5'))
+
+DATABASE_ROUTERS = ['store.routers.ReplicaRouter']
+
+# тестовая реплика и настройки тестов (books.test_runner)
+TEST_RUNNER = 'books.test_runner.TestRunner'
+
 AUTHENTICATION_BACKENDS = (
     'social_core.backends.github.GithubOAuth2',
 
@@ -141,17 +224,35 @@ STATIC_URL = '/static/'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-    ]
-    # 'DEFAULT_RENDERER_CLASSES': (
-    #     'rest_framework.renderers.JSONRenderer',
-    # ),
-    # 'DEFAULT_PARSER_CLASSES': (
-    #     'rest_framework.parsers.JSONParser',
-    #     'rest_framework.parsers.MultiPartParser',
-    # )
+    ],
+    # JSON через orjson, browsable API только при DEBUG
+    'DEFAULT_RENDERER_CLASSES': [
+        'store.renderers.ORJSONRenderer',
+    ] + (['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
+    'DEFAULT_PARSER_CLASSES': [
+        'store.renderers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 #SOCIAL_AUTH_POSTGRES_JSONFIELD = True
 
+# 'sync' - счётчики книги обновляются в том же запросе, 'deferred' - книга
+# только помечается, пересчитывает её команда process_rating_queue
+STORE_RATING_MODE = os.getenv('STORE_RATING_MODE', 'sync')
+# через сколько секунд (не больше) пересчитывается помеченная книга
+STORE_RATING_MAX_STALENESS = float(
+    os.getenv('STORE_RATING_MAX_STALENESS', '5'))
+
+# таблицы лидеров (store.leaderboards): книги с наибольшим field среди
+# подходящих под filter
+LEADERBOARD_SIZE = 100
+LEADERBOARDS = {
+    'likes': {'field': 'likes_count'},
+    'rating': {'field': 'rating'},
+    'rating-budget': {'field': 'rating', 'filter': {'price__lt': 500}},
+}
+
 SOCIAL_AUTH_GITHUB_KEY = os.getenv('SOCIAL_AUTH_GITHUB_KEY')
 SOCIAL_AUTH_GITHUB_SECRET = os.getenv('SOCIAL_AUTH_GITHUB_SECRET')
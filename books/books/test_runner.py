@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """manage.py test (в том числе под coverage и из IDE) с окружением
+    тестов проекта.
+
+    Реплика в тестах - отдельная БД replica1, маршрутизацию на неё
+    включают сами тесты через override_settings(READ_REPLICAS=...).
+    """
+    test_settings = {
+        'READ_REPLICAS': [],
+        # превышение бюджета запросов или N+1 роняет тест
+        'QUERY_BUDGET_MODE': 'raise',
+    }
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        # connections читает тот же словарь, тестовые БД ещё не созданы
+        settings.DATABASES.setdefault('replica1', {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': settings.BASE_DIR / 'db.replica1.sqlite3',
+        })
+        self.overrides = override_settings(**self.test_settings)
+        self.overrides.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.overrides.disable()
+        super().teardown_test_environment(**kwargs)
@@ -4,17 +4,21 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import SimpleRouter, DefaultRouter
 
-from store.views import BookViewSet, auth, UserBooksRelationView
+from store.metrics import metrics_view
+from store.views import BookViewSet, auth, UserBooksRelationView, \
+    LeaderboardViewSet
 
 router = SimpleRouter()
 
 router.register(r'book', BookViewSet)
 router.register(r'book_relation', UserBooksRelationView)
+router.register(r'leaderboard', LeaderboardViewSet, basename='leaderboard')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     url('', include('social_django.urls', namespace='social')),
     path('auth/', auth),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 urlpatterns += router.urls
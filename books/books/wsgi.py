@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'books.settings')
 
 application = get_wsgi_application()
+
+# соединения пула (DB_POOL_MIN_SIZE) открываются при старте, а не
+# на первых запросах
+from store.db.pool import fill_pools  # noqa: E402
+
+fill_pools()
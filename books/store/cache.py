@@ -0,0 +1,98 @@
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+LIST_VERSION_KEY = 'store:version:list'
+EPOCH_VERSION_KEY = 'store:version:epoch'
+BOOK_VERSION_KEY = 'store:version:book:{}'
+USER_VERSION_KEY = 'store:version:user:{}'
+HITS_KEY = 'store:cache:hits'
+MISSES_KEY = 'store:cache:misses'
+
+
+def _initial_version():
+    # если ключ версии вытеснен из кеша, новая версия не совпадёт со старыми
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key, _initial_version())
+    return version
+
+
+def _incr(key, initial=None):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, initial or _initial_version(), None)
+
+
+def _bump(keys):
+    for key in keys:
+        _incr(key)
+    # повторно после коммита, чтобы не закешировать данные до коммита
+    transaction.on_commit(lambda: [_incr(key) for key in keys])
+
+
+def bump_book_version(*book_ids):
+    """Инвалидирует закешированные ответы по книгам и списки книг."""
+    _bump([LIST_VERSION_KEY] + [BOOK_VERSION_KEY.format(book_id)
+                                for book_id in book_ids])
+
+
+def bump_all_versions():
+    """Инвалидирует все закешированные ответы по книгам."""
+    _bump([LIST_VERSION_KEY, EPOCH_VERSION_KEY])
+
+
+def bump_user_version(*user_ids):
+    """Инвалидирует персональные ответы пользователей (их лайки, закладки
+    и оценки)."""
+    _bump([USER_VERSION_KEY.format(user_id) for user_id in user_ids])
+
+
+def get_list_version():
+    return get_version(LIST_VERSION_KEY)
+
+
+def get_book_version(book_id):
+    epoch = get_version(EPOCH_VERSION_KEY)
+    version = get_version(BOOK_VERSION_KEY.format(book_id))
+    return f'{epoch}.{version}'
+
+
+def get_user_version(user_id):
+    epoch = get_version(EPOCH_VERSION_KEY)
+    version = get_version(USER_VERSION_KEY.format(user_id))
+    return f'{epoch}.{version}'
+
+
+def normalize_params(request):
+    return sorted((key, value)
+                  for key, values in request.query_params.lists()
+                  for value in values)
+
+
+def make_key(prefix, version, request, *parts):
+    """Ключ ответа: версия + нормализованные параметры запроса."""
+    params = normalize_params(request)
+    digest = hashlib.md5(json.dumps(
+        [request.build_absolute_uri(request.path), params, parts],
+        default=str).encode()).hexdigest()
+    return f'store:response:{prefix}:{version}:{digest}'
+
+
+def record_hit(hit):
+    _incr(HITS_KEY if hit else MISSES_KEY, initial=1)
+
+
+def get_stats():
+    stats = cache.get_many([HITS_KEY, MISSES_KEY])
+    return {'hits': stats.get(HITS_KEY, 0),
+            'misses': stats.get(MISSES_KEY, 0)}
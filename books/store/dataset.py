@@ -0,0 +1,183 @@
+"""Воспроизводимые синтетические данные для замеров на больших объёмах.
+
+Пользователи, книги и отношения пишутся пачками, одним executemany на
+пачку в обход моделей и сигналов; счётчики книг и таблицы лидеров
+пересчитываются в конце одним UPDATE (поисковый индекс ведут триггеры).
+Популярность книг распределена по Ципфу: немногие книги собирают
+большую часть читателей. Одни и те же параметры и seed дают одни и те
+же данные, а новые данные дописываются к существующим.
+"""
+import random
+from itertools import accumulate
+
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from store.logic import rebuild_counters
+from store.models import Book, UserBookRelation
+
+WORDS = ('python', 'django', 'history', 'war', 'peace', 'garden', 'night',
+         'river', 'stone', 'music', 'winter', 'summer', 'code', 'letters',
+         'journey', 'shadow', 'empire', 'ocean', 'silence', 'machine')
+SURNAMES = ('Tolstoy', 'Pushkin', 'Orwell', 'Austen', 'Dickens', 'Chekhov',
+            'Gogol', 'Twain', 'Woolf', 'Nabokov')
+FIRST_NAMES = ('Ivan', 'Anna', 'Petr', 'Olga', 'Sergey', 'Maria', 'Dmitry',
+               'Elena', 'Alexey', 'Irina')
+
+
+class DatasetGenerator:
+    """Генерирует users пользователей, books книг и relations отношений.
+
+    skew - показатель распределения Ципфа для популярности книг (0 -
+    равномерно), progress(название, готово, всего) вызывается после
+    каждой пачки.
+    """
+
+    def __init__(self, seed=0, skew=1.1, batch_size=10000,
+                 using=DEFAULT_DB_ALIAS, progress=None):
+        self.seed = seed
+        self.skew = skew
+        self.batch_size = batch_size
+        self.using = using
+        self.progress = progress or (lambda name, done, total: None)
+        self.now = connections[using].ops.adapt_datetimefield_value(
+            timezone.now())
+
+    def random(self, name):
+        # у каждой таблицы свой генератор: другое число отношений
+        # не меняет книги
+        return random.Random(f'{self.seed}:{name}')
+
+    def generate(self, users, books, relations):
+        user_ids = self.generate_users(users)
+        book_ids = self.generate_books(books, user_ids)
+        quality = self.book_quality(book_ids)
+        created = self.generate_relations(relations, user_ids, book_ids,
+                                          quality)
+        self.reset_sequences()
+        if book_ids:
+            rebuild_counters(Book.objects.filter(id__gte=book_ids[0]),
+                             using=self.using)
+        return {'users': len(user_ids), 'books': len(book_ids),
+                'relations': created}
+
+    def next_ids(self, model, count):
+        last = model.objects.using(self.using).aggregate(
+            last=Max('pk'))['last'] or 0
+        return range(last + 1, last + count + 1)
+
+    def insert(self, model, fields, rows):
+        """Строки-кортежи в колонки fields модели одним executemany."""
+        connection = connections[self.using]
+        quote = connection.ops.quote_name
+        columns = [model._meta.get_field(field).column for field in fields]
+        sql = (f'INSERT INTO {quote(model._meta.db_table)} '
+               f'({", ".join(map(quote, columns))}) '
+               f'VALUES ({", ".join(["%s"] * len(columns))})')
+        with transaction.atomic(using=self.using), \
+                connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+    def insert_batches(self, model, fields, rows, total):
+        batch, done = [], 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                self.insert(model, fields, batch)
+                done += len(batch)
+                self.progress(model._meta.verbose_name_plural, done, total)
+                batch = []
+        if batch:
+            self.insert(model, fields, batch)
+            done += len(batch)
+            self.progress(model._meta.verbose_name_plural, done, total)
+        return done
+
+    def generate_users(self, count):
+        ids = self.next_ids(User, count)
+        rng = self.random('users')
+        rows = ((user_id, f'user{user_id}', UNUSABLE_PASSWORD_PREFIX,
+                 rng.choice(FIRST_NAMES), rng.choice(SURNAMES), '',
+                 False, False, True, self.now)
+                for user_id in ids)
+        self.insert_batches(User, (
+            'id', 'username', 'password', 'first_name', 'last_name', 'email',
+            'is_superuser', 'is_staff', 'is_active', 'date_joined'),
+            rows, count)
+        return ids
+
+    def generate_books(self, count, owner_ids):
+        ids = self.next_ids(Book, count)
+        rng = self.random('books')
+
+        def rows():
+            for book_id in ids:
+                # частые слова плюс редкое, чтобы были селективные запросы
+                name = ' '.join(rng.sample(WORDS, 3)).capitalize() + \
+                    f' tome{rng.randrange(50000)}'
+                author = f'{rng.choice("ABCDEFGHIK")}. {rng.choice(SURNAMES)}'
+                cents = rng.randint(100, 500000)
+                owner = rng.choice(owner_ids) \
+                    if owner_ids and rng.random() < 0.2 else None
+                yield (book_id, name, f'{cents // 100}.{cents % 100:02d}',
+                       author, owner, 0, 0, 0, 0, self.now)
+
+        self.insert_batches(Book, (
+            'id', 'name', 'price', 'author_name', 'owner', 'rating_sum',
+            'rating_count', 'likes_count', 'readers_count', 'updated_at'),
+            rows(), count)
+        return ids
+
+    def book_quality(self, book_ids):
+        """Средняя оценка, к которой тяготеют оценки книги."""
+        rng = self.random('quality')
+        return {book_id: 1 + 4 * rng.betavariate(4, 2) for book_id in book_ids}
+
+    def generate_relations(self, count, user_ids, book_ids, quality):
+        if not user_ids or not book_ids:
+            return 0
+        rng = self.random('relations')
+        # места в рейтинге популярности раздаются книгам вперемешку
+        ranked = list(book_ids)
+        rng.shuffle(ranked)
+        cum_weights = list(accumulate(
+            1 / rank ** self.skew for rank in range(1, len(ranked) + 1)))
+        per_user, extra = divmod(count, len(user_ids))
+
+        def rows():
+            for index, user_id in enumerate(user_ids):
+                size = min(per_user + (index < extra), len(ranked))
+                if size > len(ranked) // 2:
+                    chosen = rng.sample(ranked, size)
+                else:
+                    chosen = set()
+                    while len(chosen) < size:
+                        chosen.update(rng.choices(
+                            ranked, cum_weights=cum_weights,
+                            k=size - len(chosen)))
+                for book_id in sorted(chosen):
+                    mean = quality[book_id]
+                    rate = None
+                    if rng.random() < 0.4:
+                        rate = min(5, max(1, round(rng.gauss(mean, 0.8))))
+                    yield (user_id, book_id,
+                           rng.random() < (mean - 1) / 8 + 0.05,
+                           rng.random() < 0.1, rate)
+
+        return self.insert_batches(UserBookRelation, (
+            'user', 'book', 'like', 'in_bookmarks', 'rate'), rows(), count)
+
+    def reset_sequences(self):
+        # id задавались явно, последовательности PostgreSQL об этом
+        # не знают
+        connection = connections[self.using]
+        statements = connection.ops.sequence_reset_sql(
+            no_style(), [User, Book, UserBookRelation])
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
@@ -0,0 +1,310 @@
+"""Пул соединений с БД внутри процесса и проверка живости соединений.
+
+Django 3.1 держит по соединению на поток и либо закрывает его после
+запроса, либо держит CONN_MAX_AGE секунд. Бэкенды store.db.backends.*
+вместо этого берут соединение из общего пула процесса и возвращают его
+туда при close(), так что и потоки WSGI-сервера, и пул потоков ASGI
+(sync_to_async) используют не больше POOL['MAX_SIZE'] соединений.
+Настройки в DATABASES[alias]:
+
+    'POOL': {'MAX_SIZE': 10, 'MIN_SIZE': 0, 'TIMEOUT': 5,
+             'MAX_LIFETIME': 1800, 'CHECK_AFTER': 30},
+    'CONN_HEALTH_CHECKS': True,
+
+Без POOL соединения открываются как обычно. CONN_HEALTH_CHECKS, как
+в Django 4.1, проверяет переиспользуемое соединение перед первым
+запросом в каждом запросе к сайту.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError, connections
+
+from store.metrics import DB_POOL_CONNECTIONS, DB_POOL_TIMEOUTS, \
+    DB_POOL_WAIT_SECONDS, DB_POOL_WAITS
+
+POOL_DEFAULTS = {
+    'MAX_SIZE': 10,
+    'MIN_SIZE': 0,
+    # сколько секунд ждать свободного соединения
+    'TIMEOUT': 5,
+    # соединения старше закрываются при возврате в пул, None - не закрывать
+    'MAX_LIFETIME': 30 * 60,
+    # соединение, простоявшее в пуле дольше, проверяется перед выдачей
+    'CHECK_AFTER': 30,
+}
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+def ping(connection):
+    """Живо ли соединение DB-API."""
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений DB-API одной БД.
+
+    connect() открывает новое соединение, check(соединение) проверяет,
+    живо ли оно.
+    """
+
+    def __init__(self, alias, connect, max_size=10, min_size=0, timeout=5,
+                 max_lifetime=None, check_after=30, check=ping):
+        self.alias = alias
+        self.connect = connect
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self.check = check
+        self.condition = threading.Condition()
+        # (соединение, когда открыто, когда вернулось в пул)
+        self.idle = deque()
+        # id(соединение) -> когда открыто
+        self.in_use = {}
+        self.opening = 0
+        self.waiting = self.waits = self.timeouts = 0
+        self.opened = self.closed = 0
+
+    @property
+    def size(self):
+        return len(self.idle) + len(self.in_use) + self.opening
+
+    def acquire(self):
+        started = time.monotonic()
+        waited = timed_out = False
+        try:
+            while True:
+                with self.condition:
+                    while not self.idle and self.size >= self.max_size:
+                        remaining = self.timeout - (
+                            time.monotonic() - started)
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            timed_out = True
+                            raise PoolTimeout(
+                                f'No free connection in the {self.alias!r} '
+                                f'pool of {self.max_size} after '
+                                f'{self.timeout} s')
+                        if not waited:
+                            waited = True
+                            self.waits += 1
+                        self.waiting += 1
+                        self.condition.wait(remaining)
+                        self.waiting -= 1
+                    if not self.idle:
+                        self.opening += 1
+                        break
+                    connection, opened_at, idle_since = self.idle.pop()
+                    self.in_use[id(connection)] = opened_at
+                if time.monotonic() - idle_since < self.check_after or \
+                        self.check(connection):
+                    return connection
+                # разорванное соединение из пула - закрываем и берём другое
+                self._discard(connection)
+            return self._open()
+        finally:
+            if waited:
+                DB_POOL_WAITS.inc(self.alias)
+                DB_POOL_WAIT_SECONDS.inc(
+                    self.alias, amount=time.monotonic() - started)
+            if timed_out:
+                DB_POOL_TIMEOUTS.inc(self.alias)
+            self.report()
+
+    def _open(self):
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self.condition:
+                self.opening -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.opening -= 1
+            self.opened += 1
+            self.in_use[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection, discard=False):
+        """Возвращает соединение в пул, discard=True - закрывает его."""
+        with self.condition:
+            opened_at = self.in_use.pop(id(connection), None)
+            expired = self.max_lifetime is not None and \
+                opened_at is not None and \
+                time.monotonic() - opened_at >= self.max_lifetime
+            if not discard and not expired and opened_at is not None:
+                self.idle.append((connection, opened_at, time.monotonic()))
+                self.condition.notify()
+                connection = None
+        if connection is not None:
+            self._close(connection)
+            with self.condition:
+                self.condition.notify()
+        self.report()
+
+    def _discard(self, connection):
+        with self.condition:
+            self.in_use.pop(id(connection), None)
+            self.condition.notify()
+        self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.closed += 1
+
+    def fill(self):
+        """Открывает соединения до min_size, например при старте
+        сервера."""
+        while True:
+            with self.condition:
+                if self.size >= self.min_size:
+                    break
+                self.opening += 1
+            connection = self._open()
+            self.release(connection)
+
+    def close_all(self):
+        with self.condition:
+            idle, self.idle = list(self.idle), deque()
+        for connection, _, _ in idle:
+            self._close(connection)
+        self.report()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'in_use': len(self.in_use),
+                'idle': len(self.idle),
+                'waiting': self.waiting,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'opened': self.opened,
+                'closed': self.closed,
+            }
+
+    def report(self):
+        stats = self.stats()
+        DB_POOL_CONNECTIONS.set(stats['in_use'], self.alias, 'in_use')
+        DB_POOL_CONNECTIONS.set(stats['idle'], self.alias, 'idle')
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = None
+
+
+def get_pool(alias, connect=None, options=None):
+    """Пул соединений alias в этом процессе, connect и options (POOL из
+    DATABASES) нужны, чтобы создать его. После fork пулы новые: чужие
+    соединения не закрываются, их сокеты общие с родителем."""
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools_pid = os.getpid()
+            _pools.clear()
+        pool = _pools.get(alias)
+        if pool is None and connect is not None:
+            options = dict(POOL_DEFAULTS, **(options or {}))
+            pool = _pools[alias] = ConnectionPool(
+                alias, connect, max_size=options['MAX_SIZE'],
+                min_size=options['MIN_SIZE'], timeout=options['TIMEOUT'],
+                max_lifetime=options['MAX_LIFETIME'],
+                check_after=options['CHECK_AFTER'])
+        return pool
+
+
+def get_pool_stats():
+    """{alias: статистика пула} для пулов этого процесса."""
+    with _pools_lock:
+        pools = dict(_pools) if _pools_pid == os.getpid() else {}
+    return {alias: pool.stats() for alias, pool in pools.items()}
+
+
+def fill_pools():
+    """Открывает MIN_SIZE соединений каждой БД с пулом (books/wsgi.py,
+    books/asgi.py)."""
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None:
+            pool.fill()
+
+
+class PooledDatabaseWrapperMixin:
+    """Примесь к DatabaseWrapper бэкенда Django: соединения из пула
+    (если задан POOL) и CONN_HEALTH_CHECKS."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+        self.discard_connection = False
+
+    @property
+    def pool(self):
+        options = self.settings_dict.get('POOL')
+        if options is None:
+            return None
+        return get_pool(self.alias, self.open_pooled_connection, options)
+
+    def open_pooled_connection(self):
+        return super().get_new_connection(self.get_connection_params())
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+        return pool.acquire()
+
+    def connect(self):
+        super().connect()
+        # только что полученное соединение проверять незачем
+        self.health_check_done = True
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        # закрытие внутри atomic: Django оставляет ссылку на соединение
+        discard = self.discard_connection or self.in_atomic_block
+        self.discard_connection = False
+        if not discard and not self.get_autocommit():
+            try:
+                self.connection.rollback()
+            except Exception:
+                discard = True
+        pool.release(self.connection, discard=discard)
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # начало или конец запроса к сайту
+        self.health_check_done = False
+
+    def ensure_connection(self):
+        if self.connection is not None and not self.health_check_done and \
+                self.settings_dict.get('CONN_HEALTH_CHECKS') and \
+                not self.in_atomic_block:
+            self.health_check_done = True
+            if not self.is_usable():
+                self.discard_connection = True
+                self.close()
+        super().ensure_connection()
@@ -0,0 +1,81 @@
+"""Настройка SQLite для небольших рабочих установок.
+
+Если задан settings.SQLITE_PRAGMAS, каждое новое соединение с SQLite
+выполняет эти PRAGMA (store.signals, connection_created), например:
+
+    {'journal_mode': 'wal', 'synchronous': 'normal',
+     'mmap_size': 268435456, 'cache_size': -65536,
+     'busy_timeout': 5000, 'temp_store': 'memory'}
+
+В WAL читатели не ждут писателя и не мешают ему, но писатель всё равно
+один. Транзакция, которая сначала читала, а потом пишет, получает
+«database is locked» сразу, не дожидаясь busy_timeout, если за это время
+БД изменил кто-то другой. Такие записи повторяет целиком
+@retry_on_locked.
+"""
+import random
+import re
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+
+from store.metrics import DB_LOCKED_RETRIES
+
+LOCKED_MESSAGES = ('database is locked', 'database table is locked')
+_PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+def apply_pragmas(connection):
+    """Выполняет SQLITE_PRAGMAS на только что открытом соединении."""
+    pragmas = settings.SQLITE_PRAGMAS
+    if connection.vendor != 'sqlite' or not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if not _PRAGMA_VALUE.match(name) or \
+                    not _PRAGMA_VALUE.match(str(value)):
+                raise ValueError(f'Bad SQLITE_PRAGMAS item {name!r}: '
+                                 f'{value!r}')
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def is_locked_error(exc):
+    # в общем кэше (in-memory БД тестов) SQLite добавляет имя таблицы
+    return isinstance(exc, OperationalError) and \
+        str(exc).lower().startswith(LOCKED_MESSAGES)
+
+
+def retry_on_locked(func=None, *, using=None, on_retry=None):
+    """Повторяет func, если БД ответила «database is locked».
+
+    Повторять можно только всю транзакцию, поэтому внутри чужого atomic
+    ошибка уходит наверх, к внешнему @retry_on_locked. Попыток
+    SQLITE_LOCKED_RETRIES, паузы растут от SQLITE_LOCKED_RETRY_DELAY
+    секунд; on_retry() перед повтором возвращает объект в исходное
+    состояние.
+    """
+    if func is None:
+        return lambda func: retry_on_locked(func, using=using,
+                                            on_retry=on_retry)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                attempt += 1
+                if not is_locked_error(exc) or \
+                        attempt >= settings.SQLITE_LOCKED_RETRIES or \
+                        transaction.get_connection(using).in_atomic_block:
+                    raise
+            DB_LOCKED_RETRIES.inc(func.__qualname__)
+            # со случайной добавкой, чтобы повторы не сталкивались снова
+            time.sleep(settings.SQLITE_LOCKED_RETRY_DELAY *
+                       2 ** (attempt - 1) * (1 + random.random()))
+            if on_retry is not None:
+                on_retry()
+    return wrapper
@@ -0,0 +1,338 @@
+"""Таблицы лидеров: первые LEADERBOARD_SIZE книг по счётчику Book.
+
+Места хранятся в LeaderboardEntry и обновляются инкрементально, когда
+меняются лайки или рейтинг книги, поэтому топ отдаётся чтением
+LEADERBOARD_SIZE строк по индексу, без сортировки всех книг. Таблицы
+задаются в settings.LEADERBOARDS:
+
+    {'likes': {'field': 'likes_count'},
+     'rating-budget': {'field': 'rating', 'filter': {'price__lt': 500}}}
+
+В таблицу попадают книги, подходящие под filter, с положительным
+значением field; при равенстве выше книга с меньшим id.
+
+Места пересчитываются по прочитанным текущим местам, поэтому изменения
+одной таблицы идут по очереди (lock_boards): иначе две транзакции с
+разными книгами удалят одно и то же последнее место и таблица вырастет
+больше LEADERBOARD_SIZE, а добор вставит одну книгу дважды.
+"""
+import random
+import time
+import zlib
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.db.models import BooleanField, Case, FloatField, OuterRef, Q, \
+    Subquery, Value, When
+from django.db.models.functions import Cast
+
+from store.db.sqlite import is_locked_error
+from store.models import Book, LeaderboardEntry
+
+# первый ключ pg_advisory_xact_lock для таблиц лидеров ('LB')
+LOCK_CLASS = 0x4c42
+
+
+class Board:
+    def __init__(self, name, field, filter=None):
+        self.name = name
+        self.field = field
+        self.filter = Q(**(filter or {}))
+        self.size = settings.LEADERBOARD_SIZE
+
+    def score(self):
+        # как хранится в БД: SQLite держит среднее в рейтинге без
+        # округления до decimal_places, и сортирует по нему же
+        return Cast(self.field, FloatField())
+
+    def books(self, using=None):
+        """[(book_id, score)] книг, которые могут быть в таблице, в порядке
+        мест."""
+        return Book.objects.using(using).filter(self.filter, **{
+            f'{self.field}__gt': 0}).order_by(f'-{self.field}', 'id') \
+            .values_list('id', self.score())
+
+    def top(self, using=None):
+        """Правильная таблица, считается по Book."""
+        return list(self.books(using)[:self.size])
+
+    def entries(self, using=None):
+        return LeaderboardEntry.objects.using(using).filter(
+            board=self.name).order_by('-score', 'book_id')
+
+
+def get_boards(fields=None):
+    """Таблицы из settings.LEADERBOARDS, только по полям fields, если
+    они заданы."""
+    return [Board(name, **options)
+            for name, options in settings.LEADERBOARDS.items()
+            if fields is None or options['field'] in fields]
+
+
+def get_board(name):
+    options = settings.LEADERBOARDS.get(name)
+    return None if options is None else Board(name, **options)
+
+
+def get_board_columns():
+    """Поля Book, от которых зависят места: счётчики и поля фильтров."""
+    columns = set()
+    for options in settings.LEADERBOARDS.values():
+        columns.add(options['field'])
+        columns.update(lookup.split('__')[0]
+                       for lookup in options.get('filter', {}))
+    return columns
+
+
+def book_saved(book, created):
+    """Обновляет места книги после Book.save(), если изменились поля,
+    от которых они зависят."""
+    columns = get_board_columns()
+    if created:
+        # новая книга без лайков и оценок ни в одну таблицу не попадает
+        changed = any(getattr(book, options['field'])
+                      for options in settings.LEADERBOARDS.values())
+    elif book.has_loaded_values():
+        changed = any(book.is_dirty(column) for column in columns)
+    else:
+        changed = True
+    if changed:
+        update_leaderboards([book.id])
+
+
+def _lock_key(name):
+    # второй ключ pg_advisory_xact_lock - int4
+    key = zlib.crc32(name.encode())
+    return key - 2 ** 32 if key >= 2 ** 31 else key
+
+
+def lock_boards(names, fresh=True, using=None):
+    """Блокирует таблицы names до конца текущей транзакции в БД using.
+
+    PostgreSQL: advisory lock на каждую таблицу, всегда в одном порядке.
+    SQLite пишет по одному, и транзакция, которая уже писала, держит
+    блокировку записи; новой (fresh) пустой UPDATE берёт её до чтения
+    мест, дальше ждут busy_timeout. В общем кэше (in-memory БД тестов)
+    SQLite не ждёт, поэтому первый запрос транзакции повторяем сами.
+    Возвращает True, если блокировка взята этим вызовом: прочитанное до
+    него могло устареть.
+    """
+    connection = transaction.get_connection(using)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(%s, key) FROM (SELECT '
+                'unnest(%s::int[]) AS key ORDER BY key) AS keys',
+                [LOCK_CLASS, sorted({_lock_key(name) for name in names})])
+        return True
+    if connection.vendor == 'sqlite' and fresh:
+        table = connection.ops.quote_name(LeaderboardEntry._meta.db_table)
+        attempt = 0
+        while True:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f'UPDATE {table} SET score = score WHERE 0 = 1')
+                return True
+            except OperationalError as exc:
+                attempt += 1
+                if not is_locked_error(exc) or \
+                        attempt >= settings.SQLITE_LOCKED_RETRIES:
+                    raise
+            time.sleep(settings.SQLITE_LOCKED_RETRY_DELAY *
+                       2 ** (attempt - 1) * (1 + random.random()))
+    return False
+
+
+def _rank(entry):
+    book_id, score = entry
+    return -score, book_id
+
+
+def update_leaderboards(book_ids, fields=None):
+    """Пересчитывает места книг book_ids после изменения их счётчиков.
+
+    Сначала один запрос без блокировки: место книги и последнее место
+    каждой таблицы. Если ни одна книга не может войти в таблицу, выбыть
+    или сдвинуться (обычный лайк книги вне топа), на этом всё. Иначе
+    таблицы блокируются, читаются текущие места и, только если они
+    изменились, пишутся DELETE и INSERT. Если книга выбыла из
+    заполненной таблицы, таблица добирается следующими книгами из Book.
+    """
+    boards = get_boards(fields)
+    if not boards or not book_ids:
+        return
+    # id из URL приходят строками, а строки книг - по int
+    book_ids = [Book._meta.pk.to_python(book_id) for book_id in book_ids]
+    books = _book_rows(boards, book_ids, positions=True)
+    if not any(_moves(board, index, books, _changed(board, index, books,
+                                                     book_ids))
+               for index, board in enumerate(boards)):
+        return
+    fresh = not transaction.get_connection().in_atomic_block
+    with transaction.atomic(savepoint=False):
+        if lock_boards([board.name for board in boards], fresh):
+            # прочитанное до блокировки могло устареть
+            books = _book_rows(boards, book_ids)
+        _update_leaderboards(boards, book_ids, books)
+
+
+def _book_rows(boards, book_ids, positions=False):
+    """{book_id: строка} книг: подходят ли под filter каждой таблицы и
+    значения их полей; с positions - ещё место книги в таблице и
+    последнее место заполненной таблицы."""
+    # подходит ли книга под filter каждой таблицы - тем же запросом
+    flags = {f'_in_{index}': Case(When(board.filter, then=Value(True)),
+                                  default=Value(False),
+                                  output_field=BooleanField())
+             if board.filter else Value(True, output_field=BooleanField())
+             for index, board in enumerate(boards)}
+    scores = {f'_score_{board.field}': board.score() for board in boards}
+    places = {}
+    if positions:
+        for index, board in enumerate(boards):
+            entries = board.entries()
+            last = entries[board.size - 1:board.size]
+            places[f'_stored_{index}'] = Subquery(entries.filter(
+                book_id=OuterRef('pk')).values('score')[:1])
+            places[f'_last_score_{index}'] = Subquery(last.values('score'))
+            places[f'_last_book_{index}'] = Subquery(
+                last.values('book_id'))
+    return {row['id']: row for row in Book.objects.filter(
+        id__in=book_ids).annotate(**flags, **scores, **places).values(
+        'id', *scores, *flags, *places)}
+
+
+def _changed(board, index, books, book_ids):
+    """{book_id: score} книг по таблице, None - книги в ней быть не
+    должно."""
+    changed = {}
+    for book_id in book_ids:
+        row = books.get(book_id)
+        score = None
+        if row is not None and row[f'_in_{index}'] and \
+                (row[f'_score_{board.field}'] or 0) > 0:
+            score = row[f'_score_{board.field}']
+        changed[book_id] = score
+    return changed
+
+
+def _moves(board, index, books, changed):
+    """Может ли изменение книг changed поменять таблицу - по месту
+    книги и последнему месту из _book_rows(positions=True)."""
+    for book_id, score in changed.items():
+        row = books.get(book_id)
+        if row is None:
+            # книга удалена, её места - вместе с ней
+            return True
+        stored = row[f'_stored_{index}']
+        if stored is not None:
+            if stored != score:
+                return True
+        elif score is not None:
+            last_score = row[f'_last_score_{index}']
+            if last_score is None or _rank((book_id, score)) <= \
+                    _rank((row[f'_last_book_{index}'], last_score)):
+                return True
+    return False
+
+
+def _update_leaderboards(boards, book_ids, books):
+    current = {board.name: {} for board in boards}
+    for name, book_id, score in LeaderboardEntry.objects.filter(
+            board__in=list(current)).values_list('board', 'book_id',
+                                                 'score'):
+        current[name][book_id] = score
+
+    stale, new = Q(), []
+    for index, board in enumerate(boards):
+        entries = current[board.name]
+        top = _update_board(board, entries,
+                            _changed(board, index, books, book_ids))
+        # изменившиеся места всех таблиц - одним DELETE и одним INSERT
+        stale_ids = [book_id for book_id, score in entries.items()
+                     if top.get(book_id) != score]
+        if stale_ids:
+            stale |= Q(board=board.name, book_id__in=stale_ids)
+        new += [LeaderboardEntry(board=board.name, book_id=book_id,
+                                 score=score)
+                for book_id, score in top.items()
+                if entries.get(book_id) != score]
+    if stale:
+        LeaderboardEntry.objects.filter(stale).delete()
+    LeaderboardEntry.objects.bulk_create(new)
+
+
+def _update_board(board, entries, changed):
+    """Новая таблица {book_id: score} после изменения книг changed."""
+    full = len(entries) >= board.size
+    # книги вне таблицы не выше последнего места
+    last = max(entries.items(), key=_rank, default=None) if full else None
+    ranking = dict(entries)
+    dropped = False
+    for book_id, score in changed.items():
+        entry = (book_id, score)
+        if score is not None and \
+                (last is None or _rank(entry) <= _rank(last)):
+            ranking[book_id] = score
+        elif book_id in ranking:
+            # выбыла или опустилась ниже книг, которых нет в таблице
+            del ranking[book_id]
+            dropped = full
+    top = sorted(ranking.items(), key=_rank)[:board.size]
+    if dropped and len(top) < board.size:
+        top += list(board.books().exclude(
+            id__in=[book_id for book_id, _ in top])[:board.size - len(top)])
+    return dict(top)
+
+
+def refill_leaderboards(names):
+    """Добирает таблицы names до LEADERBOARD_SIZE мест, например после
+    удаления книги из них."""
+    boards = [board for board in map(get_board, names) if board is not None]
+    if not boards:
+        return
+    fresh = not transaction.get_connection().in_atomic_block
+    with transaction.atomic(savepoint=False):
+        lock_boards([board.name for board in boards], fresh)
+        new = []
+        for board in boards:
+            book_ids = list(board.entries().values_list('book_id',
+                                                        flat=True))
+            if len(book_ids) >= board.size:
+                continue
+            new += [LeaderboardEntry(board=board.name, book_id=book_id,
+                                     score=score)
+                    for book_id, score in board.books().exclude(
+                        id__in=book_ids)[:board.size - len(book_ids)]]
+        LeaderboardEntry.objects.bulk_create(new)
+
+
+def rebuild_leaderboards(using=None):
+    """Заполняет все таблицы БД using заново по Book, возвращает число
+    мест."""
+    created = 0
+    fresh = not transaction.get_connection(using).in_atomic_block
+    with transaction.atomic(using=using):
+        lock_boards(list(settings.LEADERBOARDS), fresh, using)
+        LeaderboardEntry.objects.using(using).exclude(
+            board__in=list(settings.LEADERBOARDS)).delete()
+        for board in get_boards():
+            board.entries(using).delete()
+            created += len(LeaderboardEntry.objects.using(
+                using).bulk_create([
+                    LeaderboardEntry(board=board.name, book_id=book_id,
+                                     score=score)
+                    for book_id, score in board.top(using)]))
+    return created
+
+
+def find_leaderboard_drift(using=None):
+    """Таблицы, расходящиеся с Book: {название: (хранится, должно быть)}."""
+    drift = {}
+    for board in get_boards():
+        stored = list(board.entries(using).values_list('book_id', 'score'))
+        expected = board.top(using)
+        if stored != expected:
+            drift[board.name] = (stored, expected)
+    return drift
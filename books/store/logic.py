@@ -1,6 +1,16 @@
-from django.db.models import Avg
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Case, Count, DecimalField, \
+    ExpressionWrapper, F, FloatField, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Cast, Coalesce, Mod
+from django.utils import timezone
 
-from store.models import UserBookRelation
+from store.cache import bump_all_versions, bump_book_version, \
+    bump_user_version
+from store.db.sqlite import retry_on_locked
+from store.leaderboards import rebuild_leaderboards, update_leaderboards
+from store.metrics import timed_recompute
+from store.models import Book, DirtyBook, UserBookRelation
 
 
 def operations(a, b, c):
@@ -12,8 +22,336 @@ def operations(a, b, c):
         return a * b
 
 
+@retry_on_locked
+@timed_recompute
 def set_rating(book):
-    rating = UserBookRelation.objects.filter(book=book).aggregate(
-        rating=Avg('rate')).get('rating')
-    book.rating = rating
-    book.save()
+    """Полный пересчёт рейтинга книги по всем её оценкам.
+
+    Одним UPDATE с подзапросами: записанное не зависит от прочитанного
+    раньше, а другие колонки книги (цену, счётчики) он не трогает.
+    """
+    Book.objects.filter(id=book.id).update(updated_at=timezone.now(),
+                                           **_rating_subqueries())
+    book.refresh_from_db(fields=['rating', 'rating_sum', 'rating_count',
+                                 'updated_at'])
+    bump_book_version(book.id)
+    update_leaderboards([book.id], fields={'rating'})
+
+
+def rating_delta(old_rate, new_rate):
+    """Изменение (суммы, количества) оценок при переходе old_rate -> new_rate.
+
+    None означает отсутствие оценки, поэтому переходы None -> 5 и 5 -> None
+    меняют и количество, и сумму.
+    """
+    sum_delta = (new_rate or 0) - (old_rate or 0)
+    count_delta = (new_rate is not None) - (old_rate is not None)
+    return sum_delta, count_delta
+
+
+def _rating_updates(old_rate, new_rate):
+    sum_delta, count_delta = rating_delta(old_rate, new_rate)
+    if not sum_delta and not count_delta:
+        return {}
+    new_sum = F('rating_sum') + sum_delta
+    new_count = F('rating_count') + count_delta
+    return {
+        'rating_sum': new_sum,
+        'rating_count': new_count,
+        # справа в UPDATE стоят старые значения колонок
+        'rating': Case(
+            When(rating_count__gt=-count_delta,
+                 then=ExpressionWrapper(
+                     Cast(new_sum, FloatField()) / new_count,
+                     output_field=FloatField())),
+            default=None,
+            output_field=DecimalField(max_digits=3, decimal_places=2)),
+    }
+
+
+def is_deferred():
+    return settings.STORE_RATING_MODE == 'deferred'
+
+
+def mark_books_dirty(*book_ids):
+    """Ставит книги в очередь на пересчёт одним INSERT, повторные метки
+    одной книги склеиваются (остаётся самая старая)."""
+    now = timezone.now()
+    DirtyBook.objects.bulk_create(
+        [DirtyBook(book_id=book_id, marked_at=now) for book_id in book_ids],
+        ignore_conflicts=True)
+
+
+def update_book_counters(book_id, old_rate=None, new_rate=None,
+                         old_like=False, new_like=False, readers_delta=0):
+    """Инкрементально обновляет рейтинг, лайки и число читателей книги
+    одним UPDATE за O(1).
+
+    В режиме 'deferred' строку книги не трогает, а только помечает книгу
+    для process_rating_queue.
+    """
+    update_books_counters([book_id], old_rate=old_rate, new_rate=new_rate,
+                          old_like=old_like, new_like=new_like,
+                          readers_delta=readers_delta)
+
+
+@timed_recompute
+def update_books_counters(book_ids, old_rate=None, new_rate=None,
+                          old_like=False, new_like=False, readers_delta=0,
+                          leaderboards=True):
+    """То же для нескольких книг с одинаковым изменением одним UPDATE.
+
+    Возвращает изменённые поля Book; leaderboards=False - таблицы лидеров
+    обновит вызывающий код.
+    """
+    if not book_ids:
+        return set()
+    if is_deferred():
+        if old_rate != new_rate or bool(old_like) != bool(new_like) or \
+                readers_delta:
+            mark_books_dirty(*book_ids)
+        return set()
+    updates = _rating_updates(old_rate, new_rate)
+    likes_delta = int(bool(new_like)) - int(bool(old_like))
+    if likes_delta:
+        updates['likes_count'] = F('likes_count') + likes_delta
+    if readers_delta:
+        updates['readers_count'] = F('readers_count') + readers_delta
+    if updates:
+        books = Book.objects.filter(id__in=book_ids) if len(book_ids) > 1 \
+            else Book.objects.filter(id=book_ids[0])
+        books.update(updated_at=timezone.now(), **updates)
+        bump_book_version(*book_ids)
+        if leaderboards:
+            update_leaderboards(book_ids, fields=set(updates))
+    return set(updates)
+
+
+@retry_on_locked
+def bulk_upsert_relations(user, items):
+    """Создаёт или обновляет отношения user к книгам пачкой.
+
+    items - словари {book, like, in_bookmarks, rate}, по одному на книгу;
+    отсутствующие ключи у существующих отношений не меняются. Всё делается
+    в одной транзакции: один SELECT, bulk_create, bulk_update и по одному
+    UPDATE счётчиков на каждый вид изменения (а не на каждую книгу).
+    Возвращает {book_id: created}.
+
+    Ещё не существующие строки select_for_update не блокирует: если
+    параллельный запрос создал то же отношение после нашего SELECT,
+    bulk_create нарушит уникальность, и пачка повторяется один раз - это
+    отношение уже найдётся и обновится.
+    """
+    try:
+        return _upsert_relations(user, items)
+    except IntegrityError:
+        return _upsert_relations(user, items)
+
+
+def _lock_relations(user, book_ids):
+    """{book_id: отношение} для существующих отношений user к книгам."""
+    return {relation.book_id: relation for relation in
+            UserBookRelation.objects.select_for_update().filter(
+                user=user, book_id__in=book_ids)}
+
+
+def _upsert_relations(user, items):
+    fields = ('like', 'in_bookmarks', 'rate')
+    with transaction.atomic():
+        existing = _lock_relations(user, [item['book'] for item in items])
+        to_create, to_update, counters, result = [], [], [], {}
+        for item in items:
+            values = {key: item[key] for key in fields if key in item}
+            relation = existing.get(item['book'])
+            if relation is None:
+                relation = UserBookRelation(user=user, book_id=item['book'],
+                                            **values)
+                to_create.append(relation)
+                counters.append((relation.book_id, None, relation.rate,
+                                 False, relation.like, 1))
+                result[relation.book_id] = True
+                continue
+            old_rate, old_like = relation.rate, relation.like
+            for key, value in values.items():
+                setattr(relation, key, value)
+            if relation.is_dirty():
+                to_update.append(relation)
+                counters.append((relation.book_id, old_rate, relation.rate,
+                                 old_like, relation.like, 0))
+            result[relation.book_id] = False
+
+        UserBookRelation.objects.bulk_create(to_create)
+        UserBookRelation.objects.without_counters().bulk_update(to_update,
+                                                                fields)
+        if is_deferred():
+            mark_books_dirty(*[book_id for book_id, *_ in counters])
+            counters = []
+        # книги с одинаковым изменением - одним UPDATE
+        changes = {}
+        for book_id, *change in counters:
+            changes.setdefault(tuple(change), []).append(book_id)
+        changed_ids, changed_fields = [], set()
+        for (old_rate, new_rate, old_like, new_like, readers), book_ids in \
+                changes.items():
+            fields = update_books_counters(
+                book_ids, old_rate=old_rate, new_rate=new_rate,
+                old_like=old_like, new_like=new_like, readers_delta=readers,
+                leaderboards=False)
+            if fields:
+                changed_ids += book_ids
+                changed_fields |= fields
+        # таблицы лидеров - один раз на всю пачку
+        update_leaderboards(changed_ids, fields=changed_fields)
+        if to_create or to_update:
+            bump_user_version(user.id)
+        for relation in to_create + to_update:
+            relation._reset_loaded_values()
+    return result
+
+
+def _rating_subqueries():
+    relations = UserBookRelation.objects.filter(
+        book=OuterRef('pk'), rate__isnull=False).order_by().values('book')
+    return {
+        'rating_sum': Coalesce(
+            Subquery(relations.annotate(s=Sum('rate')).values('s')), 0),
+        'rating_count': Coalesce(
+            Subquery(relations.annotate(c=Count('rate')).values('c')), 0),
+        'rating': Subquery(relations.annotate(a=Avg('rate')).values('a')),
+    }
+
+
+def rebuild_ratings(books=None):
+    """Пересчитывает счётчики рейтинга с нуля, возвращает число книг."""
+    if books is None:
+        books = Book.objects.all()
+    updated = books.update(updated_at=timezone.now(), **_rating_subqueries())
+    bump_all_versions()
+    rebuild_leaderboards()
+    return updated
+
+
+def find_rating_drift(books=None):
+    """Книги, у которых сохранённые счётчики расходятся с реальными оценками."""
+    if books is None:
+        books = Book.objects.all()
+    subqueries = _rating_subqueries()
+    return books.annotate(
+        actual_sum=subqueries['rating_sum'],
+        actual_count=subqueries['rating_count'],
+    ).exclude(
+        rating_sum=F('actual_sum'), rating_count=F('actual_count'),
+    ).order_by('id')
+
+
+def _likes_subquery():
+    likes = UserBookRelation.objects.filter(
+        book=OuterRef('pk'), like=True).order_by().values('book')
+    return Coalesce(Subquery(likes.annotate(c=Count('id')).values('c')), 0)
+
+
+def rebuild_likes(books=None):
+    """Пересчитывает Book.likes_count с нуля, возвращает число книг."""
+    if books is None:
+        books = Book.objects.all()
+    updated = books.update(updated_at=timezone.now(),
+                           likes_count=_likes_subquery())
+    bump_all_versions()
+    rebuild_leaderboards()
+    return updated
+
+
+def find_likes_drift(books=None):
+    """Книги, у которых likes_count расходится с реальными лайками."""
+    if books is None:
+        books = Book.objects.all()
+    return books.annotate(actual_likes=_likes_subquery()).exclude(
+        likes_count=F('actual_likes')).order_by('id')
+
+
+def _readers_subquery():
+    readers = UserBookRelation.objects.filter(
+        book=OuterRef('pk')).order_by().values('book')
+    return Coalesce(Subquery(readers.annotate(c=Count('id')).values('c')), 0)
+
+
+def rebuild_readers(books=None):
+    """Пересчитывает Book.readers_count с нуля, возвращает число книг."""
+    if books is None:
+        books = Book.objects.all()
+    updated = books.update(updated_at=timezone.now(),
+                           readers_count=_readers_subquery())
+    bump_all_versions()
+    return updated
+
+
+def find_readers_drift(books=None):
+    """Книги, у которых readers_count расходится с реальными отношениями."""
+    if books is None:
+        books = Book.objects.all()
+    return books.annotate(actual_readers=_readers_subquery()).exclude(
+        readers_count=F('actual_readers')).order_by('id')
+
+
+def _counter_subqueries():
+    return dict(likes_count=_likes_subquery(),
+                readers_count=_readers_subquery(), **_rating_subqueries())
+
+
+def rebuild_counters(books=None, using=None):
+    """Пересчитывает с нуля все счётчики книг БД using одним UPDATE,
+    например после загрузки отношений в обход save(); возвращает число
+    книг."""
+    if books is None:
+        books = Book.objects.all()
+    if using is not None:
+        books = books.using(using)
+    updated = books.update(updated_at=timezone.now(), **_counter_subqueries())
+    bump_all_versions()
+    rebuild_leaderboards(using)
+    return updated
+
+
+@timed_recompute
+def recompute_books(book_ids):
+    """Пересчитывает с нуля все счётчики книг одним UPDATE."""
+    updated = Book.objects.filter(id__in=book_ids).update(
+        updated_at=timezone.now(), **_counter_subqueries())
+    if book_ids:
+        bump_book_version(*book_ids)
+        update_leaderboards(book_ids)
+    return updated
+
+
+@retry_on_locked
+def process_dirty_books(batch_size=1000, shard=0, shards=1):
+    """Разбирает пачку меток из очереди, возвращает число пересчитанных книг.
+
+    Сколько бы раз книга ни была помечена, она пересчитывается один раз.
+    Метки снимаются до пересчёта в той же транзакции: повторная метка
+    склеивается с существующей, и удаление после пересчёта стёрло бы
+    метку, поставленную во время него. Параллельная метка ждёт конца
+    транзакции и ставится заново. shard/shards делят очередь по
+    book_id % shards между параллельными процессами.
+    """
+    with transaction.atomic():
+        marks = DirtyBook.objects.select_for_update(skip_locked=True)
+        if shards > 1:
+            marks = marks.annotate(shard=Mod('book_id', shards)).filter(
+                shard=shard)
+        book_ids = list(marks.order_by('marked_at').values_list(
+            'book_id', flat=True)[:batch_size])
+        if not book_ids:
+            return 0
+        DirtyBook.objects.filter(book_id__in=book_ids).delete()
+        recompute_books(book_ids)
+    return len(book_ids)
+
+
+def get_queue_lag():
+    """Возраст самой старой метки в секундах (0, если очередь пуста)."""
+    oldest = DirtyBook.objects.order_by('marked_at').values_list(
+        'marked_at', flat=True).first()
+    if oldest is None:
+        return 0
+    return (timezone.now() - oldest).total_seconds()
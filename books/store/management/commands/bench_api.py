@@ -0,0 +1,233 @@
+import json
+import platform
+import random
+import statistics
+import time
+from contextlib import ExitStack
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from store.dataset import WORDS
+from store.metrics import QueryTimer
+from store.models import Book, UserBookRelation
+
+SCENARIOS = ('list', 'filtered', 'searched', 'sorted', 'detail',
+             'leaderboard', 'relation_patch')
+# что сравнивается с прошлым запуском (--compare)
+COMPARED = ('p50_ms', 'p95_ms', 'queries_mean')
+# клиент теста ходит с 127.0.0.1 из INTERNAL_IPS, и при DEBUG панель
+# рендерится на каждый запрос - на порядки дольше самого API
+DEBUG_TOOLBAR = 'debug_toolbar.middleware.DebugToolbarMiddleware'
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = ('Measures latency, throughput and DB queries of API scenarios '
+            'in-process on the current database (see generate_dataset) and '
+            'saves them as JSON for comparison between runs; '
+            'relation_patch writes to the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                            help=f'Any of {", ".join(SCENARIOS)}, '
+                                 f'all by default')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear-cache', action='store_true',
+                            help='Clear the response cache before every '
+                                 'request')
+        parser.add_argument('--output', help='Write the results to this '
+                                             'JSON file')
+        parser.add_argument('--compare', help='Compare with the results '
+                                              'of an earlier --output')
+        parser.add_argument('--max-regression', type=float,
+                            help='Fail if p50, p95 or the mean number of '
+                                 'queries grew by more than this many '
+                                 'percent against --compare')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or SCENARIOS
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(unknown)}')
+        if options['requests'] < 1:
+            raise CommandError('--requests must be positive')
+        bounds = Book.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            raise CommandError('No books, run generate_dataset first')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = {result['name']: result
+                            for result in json.load(file)['scenarios']}
+
+        rng = random.Random(options['seed'])
+        self.books = self.sample_books(rng, bounds)
+        user, _ = User.objects.get_or_create(username='bench_api')
+        middleware = [name for name in settings.MIDDLEWARE
+                      if name != DEBUG_TOOLBAR]
+
+        results = []
+        with override_settings(ALLOWED_HOSTS=['testserver'],
+                               MIDDLEWARE=middleware):
+            # цепочка middleware клиента собирается при первом запросе
+            self.anonymous, self.client = Client(), Client()
+            self.client.force_login(user)
+            for name in names:
+                scenario = getattr(self, f'scenario_{name}')
+                self.measure(scenario, rng, options['warmup'], options)
+                result = self.measure(scenario, rng, options['requests'],
+                                      options)
+                result['name'] = name
+                results.append(result)
+
+        self.report(results, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump({'meta': self.get_meta(options, middleware),
+                           'scenarios': results}, file, indent=2)
+        if baseline is not None and options['max_regression'] is not None:
+            regressions = [
+                f'{result["name"]} {key}'
+                for result in results if result['name'] in baseline
+                for key in COMPARED
+                if self.change(baseline[result['name']][key], result[key]) >
+                options['max_regression']]
+            if regressions:
+                raise CommandError(f'Regressed: {", ".join(regressions)}')
+
+    @staticmethod
+    def sample_books(rng, bounds, size=200):
+        """(id, price) случайных книг для параметров запросов."""
+        books = []
+        for _ in range(size):
+            books += Book.objects.filter(id__gte=rng.randint(
+                bounds['first'], bounds['last'])).order_by('id').values_list(
+                'id', 'price')[:1]
+        return books
+
+    def scenario_list(self, rng):
+        return self.anonymous, 'get', reverse('book-list'), {}
+
+    def scenario_filtered(self, rng):
+        _, price = rng.choice(self.books)
+        return self.anonymous, 'get', reverse('book-list'), {'price': price}
+
+    def scenario_searched(self, rng):
+        return self.anonymous, 'get', reverse('book-list'), {
+            'search': ' '.join(rng.sample(WORDS, 2))}
+
+    def scenario_sorted(self, rng):
+        return self.anonymous, 'get', reverse('book-list'), {
+            'ordering': rng.choice(('price', '-price', 'author_name'))}
+
+    def scenario_detail(self, rng):
+        book_id, _ = rng.choice(self.books)
+        return self.anonymous, 'get', reverse('book-detail',
+                                              args=(book_id,)), {}
+
+    def scenario_leaderboard(self, rng):
+        return self.anonymous, 'get', reverse(
+            'leaderboard-detail',
+            args=(rng.choice(('likes', 'rating', 'rating-budget')),)), \
+            {'limit': 20}
+
+    def scenario_relation_patch(self, rng):
+        book_id, _ = rng.choice(self.books)
+        return self.client, 'patch', reverse('userbookrelation-detail',
+                                             args=(book_id,)), {
+            'like': rng.random() < 0.5, 'rate': rng.randint(1, 5)}
+
+    def measure(self, scenario, rng, requests, options):
+        latencies, queries, errors = [], [], 0
+        elapsed = 0
+        for _ in range(requests):
+            client, method, url, data = scenario(rng)
+            kwargs = {}
+            if method != 'get':
+                data = json.dumps(data)
+                kwargs['content_type'] = 'application/json'
+            if options['clear_cache']:
+                cache.clear()
+            timer = QueryTimer()
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timer))
+                started = time.perf_counter()
+                response = getattr(client, method)(url, data, **kwargs)
+                latency = time.perf_counter() - started
+            elapsed += latency
+            latencies.append(latency)
+            queries.append(timer.count)
+            if response.status_code >= 400:
+                errors += 1
+        if not requests:
+            return None
+        return {
+            'example': url,
+            'requests': requests,
+            'errors': errors,
+            'rps': round(requests / elapsed, 1),
+            'mean_ms': round(statistics.mean(latencies) * 1000, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'queries_mean': round(statistics.mean(queries), 2),
+            'queries_max': max(queries),
+        }
+
+    @staticmethod
+    def change(old, new):
+        """Рост в процентах."""
+        if not old:
+            return 0 if not new else float('inf')
+        return (new - old) / old * 100
+
+    def report(self, results, baseline):
+        self.stdout.write(f'{"scenario":<16}{"rps":>9}{"p50 ms":>9}'
+                          f'{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}'
+                          f'{"errors":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result["name"]:<16}{result["rps"]:>9}'
+                f'{result["p50_ms"]:>9}{result["p95_ms"]:>9}'
+                f'{result["p99_ms"]:>9}{result["queries_mean"]:>9}'
+                f'{result["errors"]:>8}')
+            old = (baseline or {}).get(result['name'])
+            if old is not None:
+                self.stdout.write(f'{"":<16}vs baseline: ' + ', '.join(
+                    f'{key} {self.change(old[key], result[key]):+.1f}%'
+                    for key in COMPARED))
+
+    @staticmethod
+    def get_meta(options, middleware):
+        return {
+            'created': timezone.now().isoformat(),
+            'books': Book.objects.count(),
+            'users': User.objects.count(),
+            'relations': UserBookRelation.objects.count(),
+            'database': connections['default'].vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'seed': options['seed'],
+            'clear_cache': options['clear_cache'],
+            'middleware': middleware,
+        }
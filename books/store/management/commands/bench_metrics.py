@@ -0,0 +1,81 @@
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+
+from store import metrics
+from store.management.commands.bench_api import DEBUG_TOOLBAR
+
+MIDDLEWARE = 'store.metrics.MetricsMiddleware'
+
+
+class Command(BaseCommand):
+    help = ('Measures the per-request overhead of MetricsMiddleware, '
+            'in-process and with METRICS_DIR file aggregation')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='/book/?page_size=20')
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Requests per round')
+        parser.add_argument('--rounds', type=int, default=7)
+
+    def handle(self, *args, **options):
+        if MIDDLEWARE not in settings.MIDDLEWARE:
+            raise CommandError(f'{MIDDLEWARE} is not in MIDDLEWARE')
+        middleware = [name for name in settings.MIDDLEWARE
+                      if name != DEBUG_TOOLBAR]
+        without = [name for name in middleware if name != MIDDLEWARE]
+        with tempfile.TemporaryDirectory() as directory:
+            variants = (
+                ('no metrics', {'MIDDLEWARE': without}),
+                ('in-process', {'MIDDLEWARE': middleware,
+                                'METRICS_DIR': None}),
+                ('METRICS_DIR', {'MIDDLEWARE': middleware,
+                                 'METRICS_DIR': directory}),
+            )
+            clients = []
+            for name, overrides in variants:
+                with override_settings(ALLOWED_HOSTS=['testserver'],
+                                       **overrides):
+                    client = Client()
+                    response = client.get(options['url'])
+                    if response.status_code != 200:
+                        raise CommandError(
+                            f'{options["url"]} returned '
+                            f'{response.status_code}')
+                clients.append((name, overrides, client))
+
+            # варианты по очереди в каждом раунде, чтобы шум делился поровну
+            timings = {name: [] for name, _ in variants}
+            for _ in range(options['rounds']):
+                for name, overrides, client in clients:
+                    with override_settings(ALLOWED_HOSTS=['testserver'],
+                                           **overrides):
+                        started = time.perf_counter()
+                        for _ in range(options['requests']):
+                            client.get(options['url'])
+                        timings[name].append(
+                            (time.perf_counter() - started) /
+                            options['requests'] * 1e6)
+            text = metrics.render()
+
+        baseline = statistics.median(timings['no metrics'])
+        self.stdout.write(f'{options["url"]}, {options["requests"]} '
+                          f'requests x {options["rounds"]} rounds')
+        self.stdout.write(f'{"variant":<14}{"us/request":>12}'
+                          f'{"overhead us":>13}')
+        for name, values in timings.items():
+            median = statistics.median(values)
+            self.stdout.write(f'{name:<14}{median:>12.1f}'
+                              f'{median - baseline:>13.1f}')
+
+        count = 100000
+        started = time.perf_counter()
+        for _ in range(count):
+            metrics.REQUEST_SECONDS.observe(0.01, 'bench', 'GET')
+        observe_ns = (time.perf_counter() - started) / count * 1e9
+        self.stdout.write(f'Histogram.observe: {observe_ns:.0f} ns, '
+                          f'/metrics body {len(text)} bytes')
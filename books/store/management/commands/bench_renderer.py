@@ -0,0 +1,72 @@
+import io
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from store.models import Book
+from store.renderers import ORJSONParser, ORJSONRenderer, orjson
+from store.serializers import FastBookSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compares JSONRenderer/JSONParser with the orjson ones on a '
+            'list of the first books of the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            raise CommandError('orjson is not installed')
+        rows = Book.objects.order_by('id').values(
+            *FastBookSerializer.get_columns())[:options['books']]
+        data = FastBookSerializer(rows).data
+        if not data:
+            raise CommandError('No books, run generate_dataset first')
+
+        body = JSONRenderer().render(data)
+        if ORJSONRenderer().render(data) != body:
+            raise CommandError('ORJSONRenderer output differs')
+        self.stdout.write(f'{len(data)} books, {len(body)} bytes, '
+                          f'output identical')
+
+        cases = (
+            ('render', lambda: JSONRenderer().render(data),
+             lambda: ORJSONRenderer().render(data)),
+            ('parse', lambda: JSONParser().parse(io.BytesIO(body)),
+             lambda: ORJSONParser().parse(io.BytesIO(body))),
+        )
+        self.stdout.write(f'{"case":<8}{"json ms":>10}{"orjson ms":>11}'
+                          f'{"speedup":>9}{"json MB":>10}{"orjson MB":>11}')
+        for name, stdlib, fast in cases:
+            stdlib_ms = self.measure(stdlib, options['repeat'])
+            fast_ms = self.measure(fast, options['repeat'])
+            self.stdout.write(
+                f'{name:<8}{stdlib_ms:>10.2f}{fast_ms:>11.2f}'
+                f'{stdlib_ms / fast_ms:>8.1f}x'
+                f'{self.allocated(stdlib):>10.1f}'
+                f'{self.allocated(fast):>11.1f}')
+
+    @staticmethod
+    def measure(func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    @staticmethod
+    def allocated(func):
+        """Пик памяти Python во время вызова, МБ."""
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
@@ -0,0 +1,127 @@
+import operator
+import random
+import statistics
+import time
+from functools import reduce
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Q
+
+from store.dataset import SURNAMES, WORDS
+from store.models import Book
+from store.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = ('Compares ?search= through the full-text index with ILIKE on '
+            'the current books; --populate adds generated books for the '
+            'run, use it on a throwaway database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--populate', type=int, default=0,
+                            metavar='BOOKS',
+                            help='Temporarily add generated books until '
+                                 'there are this many; they are deleted '
+                                 'afterwards unless --keep is given')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the books added by --populate')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('terms', nargs='*',
+                            default=['python', 'war peace', 'sil',
+                                     'tome4711', 'tome123 winter'])
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if backend is None:
+            raise CommandError('Full-text index is not installed, '
+                               'run rebuild_search_index first')
+        # сгенерированные книги - между последней книгой до и после
+        # генерации
+        first_id = self.last_id() + 1
+        try:
+            self.populate(options['populate'], options['batch_size'],
+                          options['seed'])
+        finally:
+            generated = first_id, self.last_id()
+        try:
+            if not Book.objects.exists():
+                raise CommandError('No books, use --populate or run '
+                                   'generate_dataset first')
+            self.benchmark(backend, options)
+        finally:
+            if not options['keep']:
+                self.cleanup(*generated)
+
+    @staticmethod
+    def last_id():
+        return Book.objects.aggregate(last=Max('id'))['last'] or 0
+
+    def benchmark(self, backend, options):
+        self.stdout.write(f'{"term":<20}{"mode":<8}{"matches":>10}'
+                          f'{"page ms":>10}{"count ms":>10}')
+        for term in options['terms']:
+            terms = term.split()
+            fts = backend.filter(Book.objects.all(), terms).order_by(
+                '-search_rank', 'id')
+            ilike = Book.objects.filter(reduce(operator.and_, [
+                Q(name__icontains=word) | Q(author_name__icontains=word)
+                for word in terms
+            ])).order_by('id')
+            results = {}
+            for mode, queryset in (('fts', fts), ('ilike', ilike)):
+                page_ms = self.measure(
+                    lambda: list(queryset.values_list(
+                        'id', flat=True)[:options['page_size']]),
+                    options['repeat'])
+                count_ms = self.measure(lambda: queryset.count(),
+                                        options['repeat'])
+                results[mode] = page_ms, count_ms
+                self.stdout.write(
+                    f'{term:<20}{mode:<8}{queryset.count():>10}'
+                    f'{page_ms:>10.2f}{count_ms:>10.2f}')
+            (fts_page, fts_count), (ilike_page, ilike_count) = \
+                results['fts'], results['ilike']
+            self.stdout.write(f'{"":<20}fts speedup: page '
+                              f'x{ilike_page / fts_page:.2f}, count '
+                              f'x{ilike_count / fts_count:.2f}')
+
+    def populate(self, total, batch_size, seed):
+        existing = Book.objects.count()
+        rng = random.Random(seed + existing)
+        while existing < total:
+            size = min(batch_size, total - existing)
+            Book.objects.bulk_create([
+                # частые слова плюс редкое, чтобы были селективные запросы
+                Book(name=' '.join(rng.sample(WORDS, 3)).capitalize() +
+                     f' tome{rng.randrange(50000)}',
+                     author_name=f'{rng.choice("ABCDEFGHIK")}. '
+                                 f'{rng.choice(SURNAMES)}',
+                     price=rng.randint(100, 500000) / 100)
+                for _ in range(size)
+            ], batch_size=size)
+            existing += size
+            self.stdout.write(f'Generated {existing}/{total} books')
+
+    def cleanup(self, first_id, last_id):
+        # одним DELETE: сигналов и связей у сгенерированных книг нет,
+        # строки поискового индекса удаляют триггеры
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {Book._meta.db_table} '
+                f'WHERE id BETWEEN %s AND %s', [first_id, last_id])
+            if cursor.rowcount:
+                self.stdout.write(f'Deleted {cursor.rowcount} generated '
+                                  f'books')
+
+    @staticmethod
+    def measure(func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
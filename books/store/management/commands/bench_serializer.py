@@ -0,0 +1,69 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from store.models import Book
+from store.serializers import BookSerializer, FastBookSerializer
+from store.views import readers_preview_prefetch
+
+
+class Command(BaseCommand):
+    help = ('Compares BookSerializer with FastBookSerializer on the first '
+            'books of the database and checks that their JSON is identical')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000,
+                            help='Books per list')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        limit, repeat = options['books'], options['repeat']
+        books = Book.objects.order_by('id')[:limit]
+        if not books.exists():
+            raise CommandError('No books, run generate_dataset first')
+        renderer = JSONRenderer()
+
+        def load_instances():
+            return list(books.select_related('owner').prefetch_related(
+                readers_preview_prefetch()))
+
+        def load_rows():
+            return list(books.values(*FastBookSerializer.get_columns()))
+
+        instances, rows = load_instances(), load_rows()
+        previews = FastBookSerializer.load_readers_previews(
+            [row['id'] for row in rows])
+        slow_json = renderer.render(BookSerializer(instances, many=True).data)
+        fast_json = renderer.render(FastBookSerializer(rows).data)
+        if slow_json != fast_json:
+            raise CommandError('FastBookSerializer output differs')
+
+        cases = (
+            ('serialize', lambda: BookSerializer(instances, many=True).data,
+             lambda: FastBookSerializer(
+                 rows, readers_previews=previews).data),
+            ('query+render',
+             lambda: renderer.render(
+                 BookSerializer(load_instances(), many=True).data),
+             lambda: renderer.render(FastBookSerializer(load_rows()).data)),
+        )
+        self.stdout.write(f'{len(rows)} books, {len(fast_json)} bytes, '
+                          f'output identical')
+        self.stdout.write(f'{"case":<14}{"drf ms":>10}{"fast ms":>10}'
+                          f'{"speedup":>10}')
+        for name, slow, fast in cases:
+            slow_ms = self.measure(slow, repeat)
+            fast_ms = self.measure(fast, repeat)
+            self.stdout.write(f'{name:<14}{slow_ms:>10.2f}{fast_ms:>10.2f}'
+                              f'{slow_ms / fast_ms:>9.1f}x')
+
+    @staticmethod
+    def measure(func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
@@ -0,0 +1,179 @@
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Max, Min
+from django.test import override_settings
+
+from store.management.commands.bench_api import percentile
+from store.metrics import DB_LOCKED_RETRIES
+from store.models import Book, UserBookRelation
+
+# PRAGMA без SQLITE_TUNING: журнал отката, как у SQLite по умолчанию
+DEFAULT_PRAGMAS = {'journal_mode': 'delete'}
+TUNED_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -65536,
+    'busy_timeout': 5000,
+    'temp_store': 'memory',
+}
+PAGE_SIZE = 20
+# повторы записи считает retry_on_locked в UserBookRelation.save()
+RETRIED = 'UserBookRelation._save_with_counters'
+
+
+def read(rng, bounds):
+    """Страница списка по цене и карточка книги."""
+    price = rng.randint(1, 5000)
+    list(Book.objects.filter(price__gte=price).order_by('price', 'id')
+         .values('id', 'name', 'price', 'likes_count', 'rating')
+         [:PAGE_SIZE])
+    list(Book.objects.filter(id__gte=rng.randint(*bounds)).order_by('id')
+         .values()[:1])
+
+
+def write(rng, bounds, user_ids):
+    """Лайк и оценка книги: отношение, счётчики и таблицы лидеров."""
+    book = Book.objects.filter(id__gte=rng.randint(*bounds)).order_by(
+        'id').only('id').first()
+    relation, _ = UserBookRelation.objects.get_or_create(
+        user_id=rng.choice(user_ids), book=book)
+    relation.like = not relation.like
+    relation.rate = rng.randint(1, 5)
+    relation.save()
+
+
+def run_worker(kind, seed, duration, bounds, user_ids):
+    """Выполняет операции kind до конца срока, возвращает
+    (время операций, ошибки, повторы)."""
+    rng = random.Random(seed)
+    latencies, errors = [], 0
+    retries = DB_LOCKED_RETRIES.get(RETRIED)
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                if kind == 'read':
+                    read(rng, bounds)
+                else:
+                    write(rng, bounds, user_ids)
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+    finally:
+        connections.close_all()
+    retries = DB_LOCKED_RETRIES.get(RETRIED) - retries
+    return kind, latencies, errors, retries
+
+
+class Command(BaseCommand):
+    help = ('Measures concurrent read and write throughput of the SQLite '
+            'database with the default journal and with SQLITE_TUNING '
+            'pragmas (WAL, mmap, ...); writers like and rate books as '
+            'bench_sqlite* users')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4,
+                            help='Reading processes')
+        parser.add_argument('--writers', type=int, default=2,
+                            help='Writing processes')
+        parser.add_argument('--duration', type=float, default=5,
+                            help='Seconds per mode')
+        parser.add_argument('--modes', default='default,tuned',
+                            help='Comma-separated: default, tuned')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite' or \
+                connection.is_in_memory_db():
+            raise CommandError('Needs a file SQLite database')
+        modes = options['modes'].split(',')
+        unknown = set(modes) - {'default', 'tuned'}
+        if unknown:
+            raise CommandError(f'Unknown modes: {", ".join(unknown)}')
+        bounds = Book.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            raise CommandError('No books, run generate_dataset first')
+        bounds = (bounds['first'], bounds['last'])
+        user_ids = [
+            User.objects.get_or_create(username=f'bench_sqlite{index}')[0].id
+            for index in range(max(options['writers'], 1) * 10)]
+        journal_mode = self.pragma('journal_mode')
+
+        results = []
+        try:
+            for mode in modes:
+                pragmas = TUNED_PRAGMAS if mode == 'tuned' \
+                    else DEFAULT_PRAGMAS
+                with override_settings(SQLITE_PRAGMAS=pragmas):
+                    # новое соединение переключает журнал
+                    connections.close_all()
+                    self.pragma('journal_mode')
+                    results.append((mode, self.run(options, bounds,
+                                                   user_ids)))
+        finally:
+            with override_settings(SQLITE_PRAGMAS={}):
+                connections.close_all()
+                self.pragma(f'journal_mode = {journal_mode}')
+                connections.close_all()
+        self.report(results, options)
+
+    @staticmethod
+    def pragma(statement):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {statement}')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def run(options, bounds, user_ids):
+        # соединения не должны достаться процессам по наследству
+        connections.close_all()
+        jobs = [('read', index) for index in range(options['readers'])] + \
+            [('write', index) for index in range(options['writers'])]
+        result = {'read': ([], 0, 0), 'write': ([], 0, 0)}
+        with ProcessPoolExecutor(
+                len(jobs),
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [
+                executor.submit(run_worker, kind, options['seed'] + index,
+                                options['duration'], bounds, user_ids)
+                for index, (kind, _) in enumerate(jobs)]
+            for future in futures:
+                kind, latencies, errors, retries = future.result()
+                old_latencies, old_errors, old_retries = result[kind]
+                result[kind] = (old_latencies + latencies,
+                                old_errors + errors, old_retries + retries)
+        return result
+
+    def report(self, results, options):
+        self.stdout.write(
+            f'{options["readers"]} readers, {options["writers"]} writers, '
+            f'{options["duration"]:g} s per mode, '
+            f'{settings.DATABASES["default"]["NAME"]}')
+        self.stdout.write(f'{"mode":<9}{"kind":<7}{"ops/s":>9}{"p50 ms":>9}'
+                          f'{"p95 ms":>9}{"errors":>8}{"retries":>9}')
+        throughput = {}
+        for mode, result in results:
+            for kind, (latencies, errors, retries) in result.items():
+                rate = len(latencies) / options['duration']
+                throughput[mode, kind] = rate
+                p50 = percentile(latencies, 50) * 1000 if latencies else 0
+                p95 = percentile(latencies, 95) * 1000 if latencies else 0
+                self.stdout.write(f'{mode:<9}{kind:<7}{rate:>9.1f}'
+                                  f'{p50:>9.2f}{p95:>9.2f}{errors:>8}'
+                                  f'{retries:>9}')
+        for kind in ('read', 'write'):
+            before = throughput.get(('default', kind))
+            after = throughput.get(('tuned', kind))
+            if before and after:
+                self.stdout.write(f'{kind}: x{after / before:.2f} '
+                                  f'with SQLITE_TUNING')
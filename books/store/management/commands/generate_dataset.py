@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from store.dataset import DatasetGenerator
+
+
+class Command(BaseCommand):
+    help = ('Bulk-generates a reproducible synthetic dataset: users, books '
+            'and user-book relations with Zipf-skewed book popularity, '
+            'e.g. generate_dataset --books 1000000 --users 100000 '
+            '--relations 50000000')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=100000)
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--relations', type=int, default=1000000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of book popularity, '
+                                 '0 - uniform')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        def progress(name, done, total):
+            if options['verbosity'] > 1 or done == total:
+                self.stdout.write(f'{name}: {done}/{total}')
+
+        generator = DatasetGenerator(
+            seed=options['seed'], skew=options['skew'],
+            batch_size=options['batch_size'], using=options['database'],
+            progress=progress)
+        started = time.perf_counter()
+        created = generator.generate(options['users'], options['books'],
+                                     options['relations'])
+        elapsed = time.perf_counter() - started
+        rows = sum(created.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {created["users"]} users, {created["books"]} books, '
+            f'{created["relations"]} relations in {elapsed:.1f} s '
+            f'({rows / elapsed:.0f} rows/s)'))
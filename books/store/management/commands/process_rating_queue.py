@@ -0,0 +1,93 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from store.logic import get_queue_lag, process_dirty_books
+
+
+def drain(batch_size, shard=0, shards=1):
+    """Разбирает свою часть очереди до конца, возвращает число книг."""
+    processed = 0
+    while True:
+        count = process_dirty_books(batch_size, shard=shard, shards=shards)
+        processed += count
+        if count < batch_size:
+            return processed
+
+
+def drain_shard(batch_size, shard, shards):
+    try:
+        return drain(batch_size, shard=shard, shards=shards)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Recomputes counters of books marked dirty in deferred rating mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep draining the queue until interrupted')
+        parser.add_argument('--interval', type=float,
+                            help='Seconds between drains in --loop mode, '
+                                 'half of STORE_RATING_MAX_STALENESS '
+                                 'by default')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes, each drains book_id % workers')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--check', action='store_true',
+                            help='Fail if the oldest mark is older than '
+                                 'STORE_RATING_MAX_STALENESS')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            lag = get_queue_lag()
+            if lag > settings.STORE_RATING_MAX_STALENESS:
+                raise CommandError(f'Rating queue is {lag:.1f}s behind')
+            self.stdout.write(self.style.SUCCESS(
+                f'Rating queue is {lag:.1f}s behind'))
+            return
+
+        interval = options['interval']
+        if interval is None:
+            interval = settings.STORE_RATING_MAX_STALENESS / 2
+        workers = max(options['workers'], 1)
+        if workers > 1 and connection.vendor == 'sqlite':
+            # у SQLite один писатель, параллельные воркеры только
+            # ловили бы "database is locked"
+            self.stderr.write('SQLite allows a single writer, '
+                              'running with one worker')
+            workers = 1
+
+        executor = None
+        if workers > 1:
+            # дочерние процессы открывают свои соединения
+            connections.close_all()
+            executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('fork'))
+        try:
+            while True:
+                started = time.monotonic()
+                processed = self.drain(executor, workers,
+                                       options['batch_size'])
+                if processed or not options['loop']:
+                    self.stdout.write(f'Recomputed {processed} books')
+                if not options['loop']:
+                    break
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    @staticmethod
+    def drain(executor, workers, batch_size):
+        if executor is None:
+            return drain(batch_size)
+        return sum(executor.map(drain_shard, [batch_size] * workers,
+                                range(workers), [workers] * workers))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.leaderboards import find_leaderboard_drift, rebuild_leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the precomputed leaderboards from Book counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drifted leaderboards')
+
+    def handle(self, *args, **options):
+        drift = find_leaderboard_drift()
+        for name, (stored, expected) in drift.items():
+            self.stdout.write(
+                f'Leaderboard {name}: {len(stored)} stored entries differ '
+                f'from {len(expected)} expected')
+
+        if options['check']:
+            if drift:
+                raise CommandError(f'{len(drift)} leaderboards have drifted')
+            self.stdout.write(self.style.SUCCESS(
+                'Leaderboards are consistent'))
+            return
+
+        created = rebuild_leaderboards()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt leaderboards with {created} entries'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import find_likes_drift, rebuild_likes
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds Book.likes_count from user likes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report books with drifted counters')
+
+    def handle(self, *args, **options):
+        drift = list(find_likes_drift().values_list(
+            'id', 'likes_count', 'actual_likes'))
+        for book_id, stored_likes, actual_likes in drift:
+            self.stdout.write(
+                f'Book {book_id}: likes {stored_likes} != {actual_likes}')
+
+        if options['check']:
+            if drift:
+                raise CommandError(f'{len(drift)} books have drifted likes')
+            self.stdout.write(self.style.SUCCESS('Likes are consistent'))
+            return
+
+        updated = rebuild_likes()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt likes for {updated} books'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import find_rating_drift, rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds Book.rating_sum/rating_count/rating from user rates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report books with drifted counters')
+
+    def handle(self, *args, **options):
+        drift = list(find_rating_drift().values_list(
+            'id', 'rating_sum', 'actual_sum', 'rating_count', 'actual_count'))
+        for book_id, stored_sum, actual_sum, stored_count, actual_count in \
+                drift:
+            self.stdout.write(
+                f'Book {book_id}: sum {stored_sum} != {actual_sum} '
+                f'or count {stored_count} != {actual_count}')
+
+        if options['check']:
+            if drift:
+                raise CommandError(f'{len(drift)} books have drifted ratings')
+            self.stdout.write(self.style.SUCCESS('Ratings are consistent'))
+            return
+
+        updated = rebuild_ratings()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt ratings for {updated} books'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store.logic import find_readers_drift, rebuild_readers
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds Book.readers_count from user-book relations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report books with drifted counters')
+
+    def handle(self, *args, **options):
+        drift = list(find_readers_drift().values_list(
+            'id', 'readers_count', 'actual_readers'))
+        for book_id, stored_readers, actual_readers in drift:
+            self.stdout.write(
+                f'Book {book_id}: readers {stored_readers} != {actual_readers}')
+
+        if options['check']:
+            if drift:
+                raise CommandError(
+                    f'{len(drift)} books have drifted readers counts')
+            self.stdout.write(
+                self.style.SUCCESS('Readers counts are consistent'))
+            return
+
+        updated = rebuild_readers()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt readers counts for {updated} books'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from store.search import BACKENDS, reset_search_backends
+
+
+class Command(BaseCommand):
+    help = 'Installs (or drops) and rebuilds the full-text index of books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--drop', action='store_true',
+                            help='Drop the index and fall back to ILIKE')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        for backend in BACKENDS:
+            if backend.vendor == connection.vendor:
+                break
+        else:
+            raise CommandError(
+                f'Full-text search is not supported on {connection.vendor}')
+
+        if options['drop']:
+            backend.uninstall(connection)
+        else:
+            backend.install(connection)
+        reset_search_backends()
+        self.stdout.write(self.style.SUCCESS(
+            f'Search index {"dropped" if options["drop"] else "rebuilt"}'))
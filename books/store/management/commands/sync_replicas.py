@@ -0,0 +1,46 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = ('Copies the SQLite primary into READ_REPLICAS, with --loop '
+            'simulates replication lag for local runs')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep copying until interrupted')
+        parser.add_argument('--lag', type=float, default=2,
+                            help='Seconds between copies in --loop mode')
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        replicas = [connections[alias] for alias in settings.READ_REPLICAS]
+        if not replicas:
+            raise CommandError('No READ_REPLICAS configured')
+        for connection in [primary] + replicas:
+            if connection.vendor != 'sqlite':
+                raise CommandError('Only SQLite replicas can be synced here, '
+                                   'others are replicated by the server')
+
+        try:
+            while True:
+                started = time.monotonic()
+                primary.ensure_connection()
+                for replica in replicas:
+                    target = sqlite3.connect(replica.settings_dict['NAME'])
+                    try:
+                        primary.connection.backup(target)
+                    finally:
+                        target.close()
+                self.stdout.write(
+                    f'Synced {len(replicas)} replicas in '
+                    f'{time.monotonic() - started:.2f}s')
+                if not options['loop']:
+                    break
+                time.sleep(options['lag'])
+        except KeyboardInterrupt:
+            pass
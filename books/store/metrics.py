@@ -0,0 +1,495 @@
+"""Метрики в текстовом формате Prometheus без сторонних библиотек.
+
+Значения копятся в памяти процесса. Если задан METRICS_DIR, процесс
+раз в METRICS_FLUSH_INTERVAL секунд (и при выходе) сохраняет их в свой
+файл в этом каталоге, а /metrics складывает файлы всех процессов, так
+что любой воркер gunicorn отдаёт общую картину. Счётчики остановленных
+воркеров переносятся в один архив запуска сервера, чтобы не
+уменьшались, а их файлы и Gauge удаляются; файлы прошлых запусков
+сервера не учитываются и удаляются.
+
+/metrics отдаётся адресам из METRICS_ALLOWED_IPS и запросам с
+Authorization: Bearer METRICS_TOKEN.
+"""
+import asyncio
+import atexit
+import fcntl
+import hmac
+import ipaddress
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+from store.querybudget import get_view_name
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REGISTRY = {}
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    def samples(self, values):
+        """Строки выборки для {значения меток: значение}."""
+        raise NotImplementedError
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', r'\\').replace(
+                '"', r'\"').replace('\n', r'\n'))
+            for name, value in pairs)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        _store.add(self.name, labels, amount)
+
+    def get(self, *labels):
+        """Значение в этом процессе."""
+        return _store.get(self.name, labels)
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{self.format_labels(labels)} {value}'
+
+
+class Gauge(Metric):
+    """Текущее значение; у нескольких процессов складываются значения
+    только живых."""
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        _store.set(self.name, labels, value)
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{self.format_labels(labels)} {value}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        _store.observe(self.name, labels, self.buckets, value)
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self, values):
+        # значение - [число попаданий в каждый интервал, сумма, количество]
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket'
+                       f'{self.format_labels(labels, [("le", bound)])} '
+                       f'{cumulative}')
+            yield (f'{self.name}_bucket'
+                   f'{self.format_labels(labels, [("le", "+Inf")])} {count}')
+            yield f'{self.name}_sum{self.format_labels(labels)} {total}'
+            yield f'{self.name}_count{self.format_labels(labels)} {count}'
+
+
+class Store:
+    """Значения метрик процесса: {имя: {значения меток: значение}}."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.values = {}
+        self.filename = None
+        self.flushed_at = 0
+
+    def _check_process(self):
+        # после fork воркер начинает со своими значениями и своим файлом
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.values = {}
+            self.filename = (f'metrics_{self.pid}_{os.getppid()}_'
+                             f'{uuid.uuid4().hex[:8]}.json')
+            self.flushed_at = 0
+
+    @property
+    def path(self):
+        if not settings.METRICS_DIR or self.filename is None:
+            return None
+        return os.path.join(settings.METRICS_DIR, self.filename)
+
+    def add(self, name, labels, amount):
+        with self.lock:
+            self._check_process()
+            series = self.values.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+        self.maybe_flush()
+
+    def get(self, name, labels):
+        with self.lock:
+            self._check_process()
+            return self.values.get(name, {}).get(labels, 0)
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self._check_process()
+            self.values.setdefault(name, {})[labels] = value
+        self.maybe_flush()
+
+    def observe(self, name, labels, buckets, value):
+        with self.lock:
+            self._check_process()
+            series = self.values.setdefault(name, {})
+            counts, total, count = series.get(labels) or \
+                ([0] * len(buckets), 0, 0)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[labels] = (counts, total + value, count + 1)
+        self.maybe_flush()
+
+    def dump(self):
+        with self.lock:
+            self._check_process()
+            return {name: [[list(labels), _copy(value)]
+                           for labels, value in series.items()]
+                    for name, series in self.values.items()}
+
+    def maybe_flush(self):
+        if self.path is not None and time.monotonic() - self.flushed_at >= \
+                settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        data = self.dump()
+        path = self.path
+        if path is None:
+            return
+        self.flushed_at = time.monotonic()
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        _write(path, data)
+
+    def collect(self):
+        """Значения всех процессов этого запуска сервера: сохранённые
+        файлы, архив остановленных процессов и текущий процесс."""
+        self.flush()
+        dumps = [self.dump()]
+        directory = settings.METRICS_DIR
+        if directory and os.path.isdir(directory):
+            self.compact(directory)
+            for name in os.listdir(directory):
+                owner = _parse_filename(name)
+                if name == self.filename or owner is None or \
+                        not _same_run(*owner):
+                    continue
+                dump = _load(os.path.join(directory, name))
+                if dump is not None:
+                    dumps.append(dump)
+        return _merge_dumps(dumps)
+
+    def compact(self, directory):
+        """Переносит счётчики остановленных процессов этого запуска в
+        архив, удаляет их файлы и файлы прошлых запусков."""
+        with open(os.path.join(directory, '.lock'), 'w') as lock:
+            # иначе два воркера перенесут один файл дважды
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            dead, stale = {}, []
+            for name in os.listdir(directory):
+                owner = _parse_filename(name)
+                if owner is None or name == self.filename:
+                    continue
+                pid, ppid = owner
+                if _is_alive(pid if pid is not None else ppid):
+                    continue
+                if pid is not None and _same_run(pid, ppid):
+                    dead.setdefault(ppid, []).append(name)
+                elif not _same_run(pid, ppid):
+                    stale.append(name)
+            for ppid, names in dead.items():
+                path = os.path.join(directory, f'archive_{ppid}.json')
+                dumps = [_load(path) or {}]
+                for name in names:
+                    dump = _load(os.path.join(directory, name)) or {}
+                    dumps.append({
+                        metric: series for metric, series in dump.items()
+                        if getattr(REGISTRY.get(metric), 'type', None)
+                        != 'gauge'})
+                merged = _merge_dumps(dumps)
+                _write(path, {name: [[list(labels), value]
+                                     for labels, value in series.items()]
+                              for name, series in merged.items()})
+                stale += names
+            for name in stale:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+def _parse_filename(name):
+    """(pid, ppid) процесса по имени его файла, (None, ppid) у архива
+    остановленных процессов запуска ppid."""
+    if not name.endswith('.json'):
+        return None
+    parts = name[:-len('.json')].split('_')
+    try:
+        if parts[0] == 'metrics' and len(parts) == 4:
+            return int(parts[1]), int(parts[2])
+        if parts[0] == 'archive' and len(parts) == 2:
+            return None, int(parts[1])
+    except ValueError:
+        pass
+    return None
+
+
+def _same_run(pid, ppid):
+    """Тот же запуск сервера: другой воркер того же мастера, сам мастер
+    или дочерний процесс текущего."""
+    run = {os.getpid(), os.getppid()}
+    return pid in run or ppid in run
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def _merge_dumps(dumps):
+    merged = {}
+    for dump in dumps:
+        for name, series in dump.items():
+            target = merged.setdefault(name, {})
+            for labels, value in series:
+                labels = tuple(labels)
+                target[labels] = _merge(target.get(labels), value)
+    return merged
+
+
+def _copy(value):
+    if isinstance(value, (int, float)):
+        return value
+    counts, total, count = value
+    return [list(counts), total, count]
+
+
+def _merge(old, new):
+    if old is None:
+        return new
+    if isinstance(new, (int, float)):
+        return old + new
+    (old_counts, old_total, old_count), (counts, total, count) = old, new
+    return ([a + b for a, b in zip(old_counts, counts)],
+            old_total + total, old_count + count)
+
+
+_store = Store()
+atexit.register(_store.flush)
+
+
+def flush():
+    """Сохраняет значения процесса в METRICS_DIR сразу, а не по таймеру."""
+    _store.flush()
+
+
+def render():
+    values = _store.collect()
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        lines.extend(metric.samples(values.get(name, {})))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Обнуляет значения текущего процесса (для тестов)."""
+    with _store.lock:
+        _store.values = {}
+
+
+REQUEST_SECONDS = Histogram(
+    'store_request_duration_seconds', 'Request latency by view',
+    labels=('view', 'method'))
+DB_QUERIES = Histogram(
+    'store_db_queries_per_request', 'Database queries per request',
+    labels=('view',), buckets=QUERY_BUCKETS)
+DB_SECONDS = Histogram(
+    'store_db_duration_seconds_per_request',
+    'Time spent in database queries per request', labels=('view',))
+SERIALIZER_SECONDS = Histogram(
+    'store_serializer_duration_seconds', 'Serializer .data time',
+    labels=('serializer',))
+RATING_RECOMPUTES = Counter(
+    'store_rating_recomputes_total', 'Rating recomputations',
+    labels=('function',))
+RATING_RECOMPUTE_SECONDS = Counter(
+    'store_rating_recompute_seconds_total',
+    'Time spent recomputing ratings', labels=('function',))
+
+DB_POOL_CONNECTIONS = Gauge(
+    'store_db_pool_connections', 'Pooled database connections by state',
+    labels=('alias', 'state'))
+DB_POOL_WAITS = Counter(
+    'store_db_pool_waits_total',
+    'Connection requests that waited for a free pooled connection',
+    labels=('alias',))
+DB_POOL_WAIT_SECONDS = Counter(
+    'store_db_pool_wait_seconds_total',
+    'Time spent waiting for a pooled connection', labels=('alias',))
+DB_POOL_TIMEOUTS = Counter(
+    'store_db_pool_timeouts_total',
+    'Connection requests that timed out waiting for the pool',
+    labels=('alias',))
+DB_LOCKED_RETRIES = Counter(
+    'store_db_locked_retries_total',
+    'Writes retried after "database is locked"', labels=('function',))
+
+
+def timed_recompute(func):
+    """Считает вызовы и время функции пересчёта рейтинга."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            RATING_RECOMPUTES.inc(func.__name__)
+            RATING_RECOMPUTE_SECONDS.inc(
+                func.__name__, amount=time.perf_counter() - started)
+    return wrapper
+
+
+class QueryTimer:
+    """execute_wrapper: число и суммарное время запросов."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+def get_request_view(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return get_view_name(match.func, request.method)
+
+
+class MetricsMiddleware:
+    """Время ответа по view (для viewset - по действию) и запросы к БД.
+
+    В асинхронной цепочке запросы к БД выполняются в пуле потоков
+    и не считаются, только время ответа.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # так Django распознаёт асинхронную middleware
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        timer = QueryTimer()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        view = get_request_view(request)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, view,
+                                request.method)
+        DB_QUERIES.observe(timer.count, view)
+        DB_SECONDS.observe(timer.seconds, view)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        view = get_request_view(request)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, view,
+                                request.method)
+        return response
+
+
+def metrics_allowed(request):
+    """Запрос с токеном METRICS_TOKEN или с адреса из
+    METRICS_ALLOWED_IPS."""
+    token = settings.METRICS_TOKEN
+    if token and hmac.compare_digest(
+            request.META.get('HTTP_AUTHORIZATION', '').encode(),
+            f'Bearer {token}'.encode()):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False)
+               for network in settings.METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """GET /metrics в текстовом формате Prometheus."""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+from django.db.models import Avg, Count, Sum
+
+
+def fill_rating_counters(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    aggregates = UserBookRelation.objects.filter(
+        rate__isnull=False).values('book').annotate(
+        rating=Avg('rate'), rating_sum=Sum('rate'), rating_count=Count('rate'))
+    for row in aggregates:
+        Book.objects.filter(id=row['book']).update(
+            rating=row['rating'], rating_sum=row['rating_sum'],
+            rating_count=row['rating_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_auto_20201101_1932'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating',
+            field=models.DecimalField(decimal_places=2, default=None, max_digits=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_counters, migrations.RunPython.noop),
+    ]
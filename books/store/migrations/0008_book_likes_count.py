@@ -0,0 +1,28 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_likes_count(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    likes = UserBookRelation.objects.filter(like=True).values(
+        'book').annotate(likes_count=Count('id'))
+    for row in likes:
+        Book.objects.filter(id=row['book']).update(
+            likes_count=row['likes_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_book_rating_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_likes_count, migrations.RunPython.noop),
+    ]
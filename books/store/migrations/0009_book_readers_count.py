@@ -0,0 +1,28 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_readers_count(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    readers = UserBookRelation.objects.values('book').annotate(
+        readers_count=Count('id'))
+    for row in readers:
+        Book.objects.filter(id=row['book']).update(
+            readers_count=row['readers_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_book_likes_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='readers_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_readers_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,88 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+import store.search
+
+# DDL на момент миграции, а не из store.search: миграция должна делать
+# одно и то же, как бы индекс ни менялся потом
+SQLITE_INSTALL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS store_book_fts USING fts5(
+        name, author_name, content='store_book', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS store_book_fts_ai AFTER INSERT ON store_book
+    BEGIN
+        INSERT INTO store_book_fts(rowid, name, author_name)
+        VALUES (new.id, new.name, new.author_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS store_book_fts_ad AFTER DELETE ON store_book
+    BEGIN
+        INSERT INTO store_book_fts(store_book_fts, rowid, name, author_name)
+        VALUES ('delete', old.id, old.name, old.author_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS store_book_fts_au
+    AFTER UPDATE OF name, author_name ON store_book
+    BEGIN
+        INSERT INTO store_book_fts(store_book_fts, rowid, name, author_name)
+        VALUES ('delete', old.id, old.name, old.author_name);
+        INSERT INTO store_book_fts(rowid, name, author_name)
+        VALUES (new.id, new.name, new.author_name);
+    END""",
+    "INSERT INTO store_book_fts(store_book_fts) VALUES ('rebuild')",
+)
+
+SQLITE_UNINSTALL = (
+    'DROP TRIGGER IF EXISTS store_book_fts_ai',
+    'DROP TRIGGER IF EXISTS store_book_fts_ad',
+    'DROP TRIGGER IF EXISTS store_book_fts_au',
+    'DROP TABLE IF EXISTS store_book_fts',
+)
+
+POSTGRESQL_INSTALL = (
+    """ALTER TABLE store_book ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple',
+        coalesce(name, '') || ' ' || coalesce(author_name, ''))) STORED""",
+    """CREATE INDEX IF NOT EXISTS store_book_search_vector_idx
+    ON store_book USING GIN (search_vector)""",
+)
+
+POSTGRESQL_UNINSTALL = (
+    'DROP INDEX IF EXISTS store_book_search_vector_idx',
+    'ALTER TABLE store_book DROP COLUMN IF EXISTS search_vector',
+)
+
+
+def run_sql(statements):
+    """RunPython-функция: statements[vendor] для текущей БД, на
+    остальных БД поиск работает через ILIKE."""
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(sql, params=None)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_book_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSearchIndex',
+            fields=[
+                ('book', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='store.book')),
+                ('name', models.TextField()),
+                ('author_name', models.TextField()),
+                ('document', store.search.FullTextField(db_column='store_book_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'store_book_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(
+            run_sql({'sqlite': SQLITE_INSTALL,
+                     'postgresql': POSTGRESQL_INSTALL}),
+            run_sql({'sqlite': SQLITE_UNINSTALL,
+                     'postgresql': POSTGRESQL_UNINSTALL})),
+    ]
@@ -0,0 +1,66 @@
+from django.db import migrations, models
+from django.db.models import Avg, Count, Q, Sum
+
+
+def dedupe_relations(apps, schema_editor):
+    """Сливает дубли (user, book) в одну запись с наименьшим id."""
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+
+    duplicates = UserBookRelation.objects.values('user', 'book').annotate(
+        relations=Count('id')).filter(relations__gt=1)
+    affected_books = set()
+    for duplicate in list(duplicates):
+        relations = list(UserBookRelation.objects.filter(
+            user=duplicate['user'], book=duplicate['book']).order_by('id'))
+        keep, extra = relations[0], relations[1:]
+        keep.like = any(relation.like for relation in relations)
+        keep.in_bookmarks = any(relation.in_bookmarks
+                                for relation in relations)
+        rates = [relation.rate for relation in relations
+                 if relation.rate is not None]
+        keep.rate = rates[-1] if rates else None
+        keep.save()
+        UserBookRelation.objects.filter(
+            id__in=[relation.id for relation in extra]).delete()
+        affected_books.add(duplicate['book'])
+
+    for book_id in affected_books:
+        counters = UserBookRelation.objects.filter(book=book_id).aggregate(
+            rating=Avg('rate'), rating_sum=Sum('rate'),
+            rating_count=Count('rate'),
+            likes_count=Count('id', filter=Q(like=True)),
+            readers_count=Count('id'))
+        counters['rating_sum'] = counters['rating_sum'] or 0
+        Book.objects.filter(id=book_id).update(**counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_book_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['price', 'id'], name='store_book_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['author_name', 'id'], name='store_book_author_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(like=True), fields=['book'], name='store_relation_book_like_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(rate__isnull=False), fields=['book', 'rate'], name='store_relation_book_rate_idx'),
+        ),
+        migrations.RunPython(dedupe_relations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userbookrelation',
+            constraint=models.UniqueConstraint(fields=('user', 'book'), name='store_relation_user_book_uniq'),
+        ),
+    ]
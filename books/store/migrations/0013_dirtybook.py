@@ -0,0 +1,22 @@
+# Generated by Django 3.1.2 on 2026-10-16 22:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_relation_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyBook',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='store.book')),
+                ('marked_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,204 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from store import cache as response_cache
+from store.routers import get_replica, use_replica
+
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+
+class ConditionalGetMixin:
+    """ETag/Last-Modified для list/retrieve.
+
+    Валидаторы считаются по last_modified_field записей, попавших в ответ
+    (для списка - записей текущей страницы). На условный запрос сначала
+    выполняется дешёвый запрос только pk и last_modified_field, и при
+    совпадении отдаётся 304 без сериализации.
+    """
+    last_modified_field = 'updated_at'
+
+    def is_personal_response(self):
+        """Ответ зависит от текущего пользователя: валидаторы и ключ кеша
+        учитывают его версию из store.cache."""
+        return False
+
+    def get_validator_queryset(self):
+        return self.get_queryset().model.objects.order_by(
+            *self.queryset.query.order_by).only('pk', self.last_modified_field)
+
+    def list(self, request, *args, **kwargs):
+        if self.is_conditional_request():
+            self.paginate_queryset(
+                self.filter_queryset(self.get_validator_queryset()))
+            response = self.get_not_modified_response()
+            if response is not None:
+                return response
+
+        response = super().list(request, *args, **kwargs)
+        return self.set_validator_headers(response)
+
+    def retrieve(self, request, *args, **kwargs):
+        if self.is_conditional_request():
+            lookup = kwargs[self.lookup_url_kwarg or self.lookup_field]
+            self.validated_rows = list(self.get_validator_queryset().filter(
+                **{self.lookup_field: lookup}))
+            response = self.get_not_modified_response()
+            if response is not None:
+                return response
+
+        response = super().retrieve(request, *args, **kwargs)
+        return self.set_validator_headers(response)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        self.validated_rows = page
+        return page
+
+    def get_object(self):
+        obj = super().get_object()
+        self.validated_rows = [obj]
+        return obj
+
+    def is_conditional_request(self):
+        return 'HTTP_IF_NONE_MATCH' in self.request.META or \
+               'HTTP_IF_MODIFIED_SINCE' in self.request.META
+
+    def get_validators(self):
+        rows = getattr(self, 'validated_rows', None)
+        if not rows:
+            return None, None
+        if isinstance(rows[0], dict):
+            # строки .values(), см. BookViewSet.fast_serializer_class
+            pk = self.queryset.model._meta.pk.attname
+            parts = [(row[pk], row[self.last_modified_field])
+                     for row in rows]
+        else:
+            parts = [(row.pk, getattr(row, self.last_modified_field))
+                     for row in rows]
+        last_modified = max(modified for _, modified in parts)
+        paginator = self.paginator
+        if paginator is not None and self.action == 'list':
+            parts.append([getattr(paginator, 'has_next', None),
+                          getattr(paginator, 'has_previous', None),
+                          getattr(paginator, 'count', None)])
+        payload = [self.action, parts,
+                   response_cache.normalize_params(self.request)]
+        last_modified = int(last_modified.timestamp())
+        if self.is_personal_response():
+            user_id = self.request.user.pk
+            payload.append([user_id,
+                            response_cache.get_user_version(user_id)])
+            # отметки пользователя не меняют updated_at книг
+            last_modified = None
+        etag = quote_etag(hashlib.md5(json.dumps(
+            payload, default=str).encode()).hexdigest())
+        return etag, last_modified
+
+    def get_not_modified_response(self):
+        etag, last_modified = self.get_validators()
+        if etag is None:
+            return None
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            self.add_validator_headers(response, etag, last_modified)
+        return response
+
+    def set_validator_headers(self, response):
+        if response.status_code == status.HTTP_200_OK:
+            etag, last_modified = self.get_validators()
+            if etag is not None:
+                self.add_validator_headers(response, etag, last_modified)
+        return response
+
+    @staticmethod
+    def add_validator_headers(response, etag, last_modified):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+
+class ReplicaReadMixin:
+    """Безопасные запросы читают с реплики (см. store.routers), если
+    клиент недавно ничего не писал."""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            use_replica()
+
+
+class CachedResponseMixin:
+    """Кеширует данные ответов list/retrieve под версиями из store.cache.
+
+    Версии увеличиваются при любом изменении книги или её лайков/рейтинга,
+    поэтому таймаут только ограничивает объём кеша. Вместе с данными
+    хранятся ETag/Last-Modified, так что условный запрос к закешированному
+    ответу не обращается к БД.
+    """
+    response_cache_timeout = 60 * 60
+
+    def list(self, request, *args, **kwargs):
+        key = response_cache.make_key(
+            'list', response_cache.get_list_version(), request,
+            *self.get_personal_key())
+        return self.get_cached_response(key, super().list,
+                                        request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        key = response_cache.make_key(
+            'detail', response_cache.get_book_version(lookup), request,
+            lookup, *self.get_personal_key())
+        return self.get_cached_response(key, super().retrieve,
+                                        request, *args, **kwargs)
+
+    def is_personal_response(self):
+        return False
+
+    def get_personal_key(self):
+        # персональный ответ устаревает и при изменении отметок пользователя
+        if not self.is_personal_response():
+            return []
+        user_id = self.request.user.pk
+        return [user_id, response_cache.get_user_version(user_id)]
+
+    def get_cached_response(self, key, handler, request, *args, **kwargs):
+        replica = get_replica()
+        if replica is not None:
+            # ответы с реплики могут отставать от версии: храним их
+            # отдельно и не дольше допустимого отставания реплики
+            key = f'{key}:replica'
+        cached = response_cache.cache.get(key)
+        if cached is not None:
+            response_cache.record_hit(True)
+            data, headers = cached
+            response = None
+            if 'ETag' in headers:
+                response = get_conditional_response(
+                    request, etag=headers['ETag'])
+            if response is None:
+                response = Response(data)
+            for header, value in headers.items():
+                response[header] = value
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response_cache.record_hit(False)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            headers = {header: response[header]
+                       for header in VALIDATOR_HEADERS if header in response}
+            timeout = self.response_cache_timeout
+            if replica is not None:
+                timeout = min(timeout, settings.READ_REPLICA_MAX_LAG)
+            response_cache.cache.set(key, (response.data, headers), timeout)
+        response['X-Cache'] = 'MISS'
+        return response
@@ -1,8 +1,70 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
+from store.cache import bump_all_versions
+from store.db.sqlite import retry_on_locked
+from store.search import FTS_TABLE, FullTextField
 
-class Book(models.Model):
+
+class DirtyFieldsMixin:
+    """Запоминает значения полей в момент загрузки из БД."""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._reset_loaded_values()
+        return instance
+
+    def _reset_loaded_values(self):
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred
+        }
+
+    def has_loaded_values(self):
+        return hasattr(self, '_loaded_values')
+
+    def get_loaded_value(self, field_name):
+        field = self._meta.get_field(field_name)
+        return self._loaded_values[field.attname]
+
+    def get_dirty_fields(self):
+        """Изменённые поля: {attname: значение при загрузке}."""
+        if not self.has_loaded_values():
+            return {}
+        return {
+            attname: value
+            for attname, value in self._loaded_values.items()
+            if getattr(self, attname) != value
+        }
+
+    def is_dirty(self, field_name=None):
+        if field_name is None:
+            return bool(self.get_dirty_fields())
+        field = self._meta.get_field(field_name)
+        return field.attname in self.get_dirty_fields()
+
+    def _mark_loaded(self, field_names):
+        if field_names is None or not self.has_loaded_values():
+            self._reset_loaded_values()
+            return
+        for field_name in field_names:
+            attname = self._meta.get_field(field_name).attname
+            self._loaded_values[attname] = getattr(self, attname)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._mark_loaded(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._mark_loaded(fields)
+
+
+class Book(DirtyFieldsMixin, models.Model):
     name = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=7, decimal_places=2)
     author_name = models.CharField(max_length=255)
@@ -12,12 +74,101 @@ class Book(models.Model):
                                      related_name='books')
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=None,
                                  null=True)
+    # счётчики для инкрементального пересчёта рейтинга (см. store.logic)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    likes_count = models.PositiveIntegerField(default=0)
+    readers_count = models.PositiveIntegerField(default=0)
+    # меняется и при изменении счётчиков, используется для ETag
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # ключи keyset-пагинации при сортировке по price/author_name
+            models.Index(fields=['price', 'id'],
+                         name='store_book_price_id_idx'),
+            models.Index(fields=['author_name', 'id'],
+                         name='store_book_author_id_idx'),
+        ]
 
     def __str__(self):
         return f'Id {self.id}: {self.name}'
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and self.has_loaded_values() and \
+                not kwargs.get('force_insert') and \
+                kwargs.get('update_fields') is None:
+            # пишем только изменённые колонки: UPDATE всей строки затёр бы
+            # счётчики, изменённые другими запросами после загрузки книги
+            deferred = self.get_deferred_fields()
+            changed = set(self.get_dirty_fields()) | {
+                field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.attname not in self._loaded_values and
+                field.attname not in deferred}
+            kwargs['update_fields'] = list(changed | {'updated_at'}) \
+                if changed else []
+        super().save(*args, **kwargs)
+
+
+class BookSearchIndex(models.Model):
+    """Строка FTS5-индекса книг, есть только в SQLite (см. store.search)."""
+    book = models.OneToOneField(Book, primary_key=True, db_column='rowid',
+                                on_delete=models.DO_NOTHING,
+                                related_name='search_index')
+    name = models.TextField()
+    author_name = models.TextField()
+    document = FullTextField(db_column=FTS_TABLE)
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = FTS_TABLE
+
+
+class UserBookRelationQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._update_counters = True
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._update_counters = self._update_counters
+        return clone
 
-class UserBookRelation(models.Model):
+    def without_counters(self):
+        """update()/bulk_update() без пересчёта счётчиков книг: их
+        обновляет вызывающий код."""
+        clone = self._chain()
+        clone._update_counters = False
+        return clone
+
+    def update(self, **kwargs):
+        """Массовое обновление, не ломающее счётчики книг."""
+        from store.logic import rebuild_likes, rebuild_ratings
+
+        if not self._update_counters:
+            return super().update(**kwargs)
+        if 'like' not in kwargs and 'rate' not in kwargs:
+            rows = super().update(**kwargs)
+            # персональные ответы (закладки) не узнать, чьи - сбрасываем все
+            bump_all_versions()
+            return rows
+
+        with transaction.atomic(using=self.db):
+            book_ids = set(self.values_list('book_id', flat=True))
+            rows = super().update(**kwargs)
+            books = Book.objects.filter(id__in=book_ids)
+            if 'like' in kwargs:
+                rebuild_likes(books)
+            if 'rate' in kwargs:
+                rebuild_ratings(books)
+        return rows
+
+    update.alters_data = True
+
+
+class UserBookRelation(DirtyFieldsMixin, models.Model):
     RATE_CHOICES = (
         (1, 'Ok'),
         (2, 'Fine'),
@@ -32,21 +183,109 @@ class UserBookRelation(models.Model):
     in_bookmarks = models.BooleanField(default=False)
     rate = models.PositiveIntegerField(choices=RATE_CHOICES, null=True)
 
+    objects = UserBookRelationQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'],
+                                    name='store_relation_user_book_uniq'),
+        ]
+        indexes = [
+            # пересчёт лайков и рейтинга книги (rebuild_*, set_rating)
+            models.Index(fields=['book'], condition=models.Q(like=True),
+                         name='store_relation_book_like_idx'),
+            models.Index(fields=['book', 'rate'],
+                         condition=models.Q(rate__isnull=False),
+                         name='store_relation_book_rate_idx'),
+        ]
+
     def __str__(self):
         return f'{self.user.username}: {self.book.name}, RATE: {self.rate}'
 
     def save(self, *args, **kwargs):  # вызывается при сохранении
-        from store.logic import set_rating
+        # «database is locked» откатывает транзакцию целиком, повтор
+        # начинается с того же состояния объекта
+        pk, adding = self.pk, self._state.adding
+        loaded = dict(self._loaded_values) if self.has_loaded_values() \
+            else None
+
+        def restore():
+            self.pk, self._state.adding = pk, adding
+            if loaded is not None:
+                self._loaded_values = dict(loaded)
+            elif self.has_loaded_values():
+                del self._loaded_values
+
+        return retry_on_locked(self._save_with_counters,
+                               using=kwargs.get('using'),
+                               on_retry=restore)(*args, **kwargs)
+
+    def _save_with_counters(self, *args, **kwargs):
+        from store.logic import update_book_counters
 
         creating = not self.pk
-        old_rating = self.rate
+        old_rating, old_like = None, False
         if not creating:
-            old_rating = UserBookRelation.objects.get(id=self.id).rate
+            if self.has_loaded_values():
+                dirty_fields = self.get_dirty_fields()
+                old_rating = dirty_fields.get('rate', self.rate)
+                old_like = dirty_fields.get('like', self.like)
+                if not kwargs.get('force_insert') and \
+                        kwargs.get('update_fields') is None:
+                    # пишем только изменённые колонки
+                    kwargs['update_fields'] = list(dirty_fields)
+            else:
+                old_rating, old_like = UserBookRelation.objects.values_list(
+                    'rate', 'like').get(id=self.id)
+
+        new_rating, new_like = self.rate, self.like
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            if 'rate' not in update_fields:
+                new_rating = old_rating
+            if 'like' not in update_fields:
+                new_like = old_like
+
+        # savepoint не нужен: при ошибке откатится вся внешняя транзакция
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super().save(*args,
+                         **kwargs)  # делаем сохранение из родительского метода чтобы потом просто добавитьфункцию
+            update_book_counters(self.book_id,
+                                 old_rate=old_rating, new_rate=new_rating,
+                                 old_like=old_like, new_like=new_like,
+                                 readers_delta=int(creating))
 
-        super().save(*args,
-                     **kwargs)  # делаем сохранение из родительского метода чтобы потом просто добавитьфункцию
 
-        new_rating = self.rate
+class DirtyBook(models.Model):
+    """Метка «счётчики книги устарели» для отложенного пересчёта
+    (STORE_RATING_MODE = 'deferred'), метки одной книги склеиваются
+    в одну строку. Разбирается командой process_rating_queue."""
+    book = models.OneToOneField(Book, primary_key=True,
+                                on_delete=models.CASCADE, related_name='+')
+    # время самой старой необработанной метки
+    marked_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f'Book {self.book_id} dirty since {self.marked_at}'
 
-        if old_rating != new_rating or creating:
-            set_rating(self.book)
+
+class LeaderboardEntry(models.Model):
+    """Место книги в таблице лидеров (см. store.leaderboards)."""
+    board = models.CharField(max_length=32)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE,
+                             related_name='+')
+    # значение счётчика книги, по которому она попала в таблицу
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['board', 'book'],
+                                    name='store_leaderboard_board_book_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['board', '-score', 'book'],
+                         name='store_leaderboard_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.board}: book {self.book_id} ({self.score})'
@@ -0,0 +1,205 @@
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from store.cache import get_list_version
+from store.routers import get_replica
+
+
+class KeysetPagination(BasePagination):
+    """Курсорная (keyset) пагинация по сортировке queryset'а.
+
+    Позиция в курсоре - значения всех ключей сортировки последней (или
+    первой) записи страницы, к сортировке всегда добавляется ``tiebreaker``,
+    поэтому страница строится одним ``WHERE (key, id) > (...) LIMIT n``
+    и не зависит от глубины. Ключи сортировки не должны быть NULL.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    count_cache_timeout = 60
+    tiebreaker = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = None
+        if self.count_requested(request):
+            self.count = self.get_count(queryset, request)
+
+        self.ordering = self.get_ordering(queryset)
+        reverse, position = self.decode_cursor(request, queryset)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [self._invert(key) for key in ordering]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(
+                self.get_position_filter(ordering, position))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        fields = []
+        if self.count is not None:
+            fields.append(('count', self.count))
+        fields += [
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]
+        return Response(OrderedDict(fields))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset):
+        """Сортировка queryset'а после фильтров плюс tiebreaker."""
+        ordering = [key for key in queryset.query.order_by
+                    if isinstance(key, str)]
+        if not ordering:
+            ordering = list(queryset.model._meta.ordering)
+        names = [key.lstrip('-') for key in ordering]
+        if self.tiebreaker not in names and 'pk' not in names:
+            ordering.append(self.tiebreaker)
+        return ordering
+
+    def get_position_filter(self, ordering, position):
+        """(k1, k2, ...) > (v1, v2, ...) с учётом направления каждого ключа."""
+        position_filter = Q()
+        equal = {}
+        for key, value in zip(ordering, position):
+            name = key.lstrip('-')
+            lookup = 'lt' if key.startswith('-') else 'gt'
+            position_filter |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return position_filter
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(True, self.page[0])
+
+    def encode_cursor(self, reverse, instance):
+        position = [self._get_value(instance, key.lstrip('-'))
+                    for key in self.ordering]
+        payload = json.dumps({'r': int(reverse), 'p': position},
+                             cls=DjangoJSONEncoder, separators=(',', ':'))
+        cursor = urlsafe_b64encode(payload.encode()).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request, queryset):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return False, None
+        try:
+            payload = json.loads(urlsafe_b64decode(cursor.encode()))
+            reverse, position = bool(payload['r']), payload['p']
+            if not isinstance(position, list) or \
+                    len(position) != len(self.ordering):
+                raise ValueError
+            # значения приводятся к типам ключей здесь, иначе ORM упадёт
+            # на них уже в фильтре
+            position = [
+                self.get_key_field(queryset, key.lstrip('-')).to_python(value)
+                for key, value in zip(self.ordering, position)]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        if None in position:
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, position
+
+    @staticmethod
+    def get_key_field(queryset, name):
+        """Поле модели или аннотации, по которому идёт сортировка."""
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        model, field = queryset.model, None
+        for part in name.split('__'):
+            if model is None:
+                raise FieldDoesNotExist(name)
+            field = model._meta.pk if part == 'pk' else \
+                model._meta.get_field(part)
+            model = field.related_model
+        if field.is_relation:
+            field = field.target_field
+        return field
+
+    def count_requested(self, request):
+        value = request.query_params.get(self.count_query_param, '')
+        return value.lower() in ('1', 'true', 'yes')
+
+    def get_count(self, queryset, request):
+        """Общее число записей, кешируется отдельно от страниц до
+        следующего изменения книг."""
+        cache_key = self.get_count_cache_key(request)
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.order_by().count()
+            cache.set(cache_key, count, self.count_cache_timeout)
+        return count
+
+    def get_count_cache_key(self, request):
+        ignored = (self.cursor_query_param, self.page_size_query_param,
+                   self.count_query_param)
+        params = sorted(
+            (key, value) for key, values in request.query_params.lists()
+            if key not in ignored for value in values)
+        digest = hashlib.md5(
+            json.dumps([request.path, params]).encode()).hexdigest()
+        key = f'keyset-count:{get_list_version()}:{digest}'
+        if get_replica() is not None:
+            # число с отстающей реплики не должны видеть читающие default
+            key += ':replica'
+        return key
+
+    @staticmethod
+    def _invert(key):
+        return key[1:] if key.startswith('-') else f'-{key}'
+
+    @staticmethod
+    def _get_value(instance, name):
+        if isinstance(instance, dict):
+            # строка .values()
+            return instance[name]
+        for attr in name.split('__'):
+            instance = getattr(instance, attr)
+        return instance
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import re
+import traceback
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('store.querybudget')
+
+# служебные запросы транзакций (в тестах каждый atomic - savepoint)
+IGNORED_SQL = re.compile(r'\s*(SAVEPOINT|RELEASE|ROLLBACK TO)\b', re.I)
+# IN (%s, %s, ...) с разным числом параметров - один и тот же запрос
+IN_PARAMS = re.compile(r'\bIN \((?:%s, )*%s\)')
+
+_unset = object()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(queries=None, repeats=_unset):
+    """Бюджет запросов к БД для view или действия viewset.
+
+    queries - сколько запросов можно выполнить (None - не ограничено),
+    repeats - сколько раз можно повторить один запрос, пока это не
+    считается N+1 (0 - не проверять, по умолчанию QUERY_BUDGET_REPEATS).
+    """
+    def decorator(func):
+        func.query_budget = queries
+        if repeats is not _unset:
+            func.query_repeats = repeats
+        return func
+    return decorator
+
+
+def get_view_handler(view_func, method):
+    """(название, метод-обработчик, класс view) для функции из URLconf:
+    'BookViewSet.list' для действия viewset, имя функции для
+    обычной view."""
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return view_func.__qualname__, view_func, None
+    action = (getattr(view_func, 'actions', None) or {}).get(
+        method.lower(), method.lower())
+    return f'{cls.__name__}.{action}', getattr(cls, action, None), cls
+
+
+def get_view_name(view_func, method):
+    return get_view_handler(view_func, method)[0]
+
+
+def get_view_budget(view_func, method):
+    """(название view, бюджет, порог повторов) для функции из URLconf.
+
+    Бюджет берётся из @query_budget на действии, затем из атрибута
+    query_budgets = {'list': 2, ...} класса view.
+    """
+    name, handler, cls = get_view_handler(view_func, method)
+    queries = getattr(handler, 'query_budget', None)
+    if cls is not None and not hasattr(handler, 'query_budget'):
+        action = name.rpartition('.')[2]
+        queries = getattr(cls, 'query_budgets', {}).get(action)
+    repeats = getattr(handler, 'query_repeats',
+                      settings.QUERY_BUDGET_REPEATS)
+    return name, queries, repeats
+
+
+def normalize_sql(sql):
+    return IN_PARAMS.sub('IN (...)', sql)
+
+
+def project_stack():
+    """Стек вызова без кадров Django, библиотек и этого модуля."""
+    base_dir = str(settings.BASE_DIR)
+    return ''.join(traceback.format_list([
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(base_dir) and
+        frame.filename != __file__ and 'site-packages' not in frame.filename
+    ]))
+
+
+class QueryLog:
+    """execute_wrapper, который считает запросы и одинаковые запросы."""
+
+    def __init__(self):
+        self.active = False
+        self.repeats = 0
+        self.count = 0
+        self.shapes = Counter()
+        self.stacks = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.active and not IGNORED_SQL.match(sql):
+            self.count += 1
+            shape = normalize_sql(sql)
+            self.shapes[shape] += 1
+            if self.shapes[shape] == self.repeats:
+                self.stacks[shape] = project_stack()
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMiddleware:
+    """Проверяет бюджеты запросов к БД, объявленные через @query_budget
+    или query_budgets у view, и ищет N+1 - один и тот же запрос,
+    выполненный QUERY_BUDGET_REPEATS раз и больше.
+
+    QUERY_BUDGET_MODE: 'log' - предупреждение в логгер store.querybudget,
+    'raise' - QueryBudgetExceeded (так в тестах), 'off' - выключено.
+    Считаются запросы от view до возврата ответа, загрузка сессии и
+    пользователя не входит. Асинхронная цепочка middleware не
+    проверяется.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # так Django распознаёт асинхронную middleware
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.get_response(request)
+        if settings.QUERY_BUDGET_MODE == 'off':
+            return self.get_response(request)
+        request.query_log = QueryLog()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(request.query_log))
+            response = self.get_response(request)
+        self.check(request, request.query_log)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        query_log = getattr(request, 'query_log', None)
+        if query_log is None or asyncio.iscoroutinefunction(view_func):
+            return None
+        # сессию и пользователя грузим до начала подсчёта
+        getattr(getattr(request, 'user', None), 'is_authenticated', None)
+        request.query_budget = get_view_budget(view_func, request.method)
+        query_log.repeats = request.query_budget[2]
+        query_log.active = True
+        return None
+
+    def check(self, request, query_log):
+        if not query_log.active:
+            return
+        name, queries, _ = request.query_budget
+        problems = []
+        if queries is not None and query_log.count > queries:
+            problems.append(f'{name}: {query_log.count} queries, '
+                            f'budget {queries}')
+        for shape, stack in query_log.stacks.items():
+            problems.append(f'{name}: N+1, {query_log.shapes[shape]} '
+                            f'identical queries {shape}\n{stack}')
+        logger.debug('%s %s: %s queries', request.method, name,
+                     query_log.count)
+        if not problems:
+            return
+        if settings.QUERY_BUDGET_MODE == 'raise':
+            raise QueryBudgetExceeded('\n'.join(problems))
+        for problem in problems:
+            logger.warning(problem)
@@ -0,0 +1,74 @@
+import decimal
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # без orjson работают как обычные JSONRenderer/Parser
+    orjson = None
+
+# JSONRenderer экранирует их, чтобы JSON был валидным JavaScript
+LINE_SEPARATORS = (
+    ('\u2028'.encode(), b'\\u2028'),
+    ('\u2029'.encode(), b'\\u2029'),
+)
+
+_encoder = JSONEncoder()
+
+if orjson is not None:
+    # даты форматирует JSONEncoder DRF; нестроковые ключи словарей
+    # (OPT_NON_STR_KEYS заметно медленнее) уходят в JSONRenderer
+    OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def _default(obj):
+    # сериализаторы и так отдают Decimal строкой ('5.00'), это для
+    # значений, собранных вручную
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    return _encoder.default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """JSONRenderer на orjson: тот же компактный UTF-8 вывод в несколько
+    раз быстрее.
+
+    Отступы (``Accept: application/json; indent=4``) и то, что orjson
+    не умеет (целые больше 64 бит, нестроковые ключи), рендерятся
+    как раньше.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or \
+                not self.compact or \
+                self.get_indent(accepted_media_type,
+                                renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        try:
+            ret = orjson.dumps(data, default=_default, option=OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+        for separator, escaped in LINE_SEPARATORS:
+            if separator in ret:
+                ret = ret.replace(separator, escaped)
+        return ret
+
+
+class ORJSONParser(JSONParser):
+    """JSONParser на orjson, тело в другой кодировке разбирается как
+    раньше."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', 'utf-8')
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,88 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_COOKIE = 'store_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class Routing:
+    """Куда идут чтения в текущем запросе."""
+    __slots__ = ('replica', 'pinned', 'wrote')
+
+    def __init__(self, pinned=False):
+        self.replica = None
+        # читаем только с основной БД: запрос пишет или уже писал
+        self.pinned = pinned
+        self.wrote = False
+
+
+_routing = ContextVar('store_routing', default=None)
+
+
+def use_replica():
+    """Направляет дальнейшие чтения запроса на случайную реплику, если
+    реплики есть и запрос ещё ничего не писал."""
+    routing = _routing.get()
+    if routing is None or routing.pinned or not settings.READ_REPLICAS:
+        return None
+    if routing.replica is None:
+        routing.replica = random.choice(settings.READ_REPLICAS)
+    return routing.replica
+
+
+def get_replica():
+    """Реплика, с которой читает текущий запрос, или None."""
+    routing = _routing.get()
+    if routing is None or routing.pinned:
+        return None
+    return routing.replica
+
+
+class ReplicaRouter:
+    """Чтения с реплики только там, где запрос включил это через
+    use_replica(), все записи и чтения после них - в default."""
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return get_replica()
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None:
+            routing.pinned = routing.wrote = True
+        # и объекты, прочитанные с реплики, сохраняются в default
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики - копии default
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    """Состояние маршрутизации на время запроса.
+
+    Запрос, который что-то записал, ставит cookie, и следующие
+    READ_REPLICA_MAX_LAG секунд запросы этого клиента читают с основной
+    БД, то есть видят свои изменения, даже если реплика отстаёт.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = Routing(pinned=request.method not in SAFE_METHODS or
+                          PIN_COOKIE in request.COOKIES)
+        token = _routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        if routing.wrote and settings.READ_REPLICAS:
+            response.set_cookie(PIN_COOKIE, '1', httponly=True,
+                                max_age=settings.READ_REPLICA_MAX_LAG)
+        return response
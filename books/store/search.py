@@ -0,0 +1,197 @@
+import re
+
+from django.db import connections
+from django.db.models import F, FloatField, Lookup, TextField
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import SearchFilter
+
+FTS_TABLE = 'store_book_fts'
+
+# Миграция 0011 ставит индекс своей копией этого DDL, изменения здесь
+# доходят до БД только новой миграцией (или rebuild_search_index).
+# SQLite не умеет большинство ALTER TABLE, и Django пересоздаёт таблицу
+# store_book при любом AlterField/RemoveField у Book - вместе с ней
+# пропадают триггеры store_book_fts_*. Индекс перестаёт обновляться,
+# is_available() это видит, и поиск молча переходит на ILIKE. Такая
+# миграция должна следом снова выполнить SQLITE_INSTALL своей копией.
+SQLITE_INSTALL = (
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        name, author_name, content='store_book', content_rowid='id')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON store_book
+    BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, author_name)
+        VALUES (new.id, new.name, new.author_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON store_book
+    BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, author_name)
+        VALUES ('delete', old.id, old.name, old.author_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au
+    AFTER UPDATE OF name, author_name ON store_book
+    BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, author_name)
+        VALUES ('delete', old.id, old.name, old.author_name);
+        INSERT INTO {FTS_TABLE}(rowid, name, author_name)
+        VALUES (new.id, new.name, new.author_name);
+    END""",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+)
+
+SQLITE_UNINSTALL = (
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_ai',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_ad',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_au',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+)
+
+POSTGRESQL_INSTALL = (
+    """ALTER TABLE store_book ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple',
+        coalesce(name, '') || ' ' || coalesce(author_name, ''))) STORED""",
+    """CREATE INDEX IF NOT EXISTS store_book_search_vector_idx
+    ON store_book USING GIN (search_vector)""",
+)
+
+POSTGRESQL_UNINSTALL = (
+    'DROP INDEX IF EXISTS store_book_search_vector_idx',
+    'ALTER TABLE store_book DROP COLUMN IF EXISTS search_vector',
+)
+
+
+class FullTextField(TextField):
+    """Скрытая колонка FTS5-таблицы (с тем же именем, что и таблица),
+    по которой делается MATCH."""
+
+
+@FullTextField.register_lookup
+class Match(Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+class SearchBackend:
+    """Полнотекстовый поиск книг по name и author_name.
+
+    filter() оставляет только подходящие книги и добавляет аннотацию
+    search_rank: чем больше, тем релевантнее.
+    """
+    vendor = None
+    install_sql = ()
+    uninstall_sql = ()
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            for sql in self.install_sql:
+                cursor.execute(sql)
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            for sql in self.uninstall_sql:
+                cursor.execute(sql)
+
+    def is_available(self, connection):
+        raise NotImplementedError
+
+    def filter(self, queryset, terms):
+        raise NotImplementedError
+
+    @staticmethod
+    def split_words(terms):
+        return [word for term in terms for word in re.findall(r'\w+', term)]
+
+
+class SQLiteFTSBackend(SearchBackend):
+    vendor = 'sqlite'
+    install_sql = SQLITE_INSTALL
+    uninstall_sql = SQLITE_UNINSTALL
+
+    def is_available(self, connection):
+        # без триггеров индекс устаревает (например, после пересоздания
+        # store_book миграцией), тогда лучше искать по-старому
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM sqlite_master "
+                "WHERE name = %s OR tbl_name = 'store_book' AND name LIKE %s",
+                [FTS_TABLE, f'{FTS_TABLE}_a_'])
+            return cursor.fetchone()[0] == 4
+
+    def filter(self, queryset, terms):
+        match = ' '.join(f'"{word}"*' for word in self.split_words(terms))
+        if not match:
+            return queryset
+        # JOIN с store_book_fts через store.models.BookSearchIndex,
+        # rank в FTS5 - bm25 со знаком минус
+        return queryset.filter(search_index__document__match=match).annotate(
+            search_rank=-F('search_index__rank'))
+
+
+class PostgreSQLBackend(SearchBackend):
+    vendor = 'postgresql'
+    install_sql = POSTGRESQL_INSTALL
+    uninstall_sql = POSTGRESQL_UNINSTALL
+
+    def is_available(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM information_schema.columns "
+                "WHERE table_name = 'store_book' "
+                "AND column_name = 'search_vector'")
+            return cursor.fetchone()[0] == 1
+
+    def filter(self, queryset, terms):
+        query = ' & '.join(f'{word}:*' for word in self.split_words(terms))
+        if not query:
+            return queryset
+        return queryset.filter(id__in=RawSQL(
+            "SELECT id FROM store_book "
+            "WHERE search_vector @@ to_tsquery('simple', %s)", (query,),
+        )).annotate(search_rank=RawSQL(
+            "ts_rank(store_book.search_vector, to_tsquery('simple', %s))",
+            (query,), output_field=FloatField(),
+        ))
+
+
+BACKENDS = [SQLiteFTSBackend(), PostgreSQLBackend()]
+
+_available = {}
+
+
+def get_search_backend(using='default'):
+    """Backend для БД using или None, если индекс не установлен."""
+    connection = connections[using]
+    for backend in BACKENDS:
+        if backend.vendor == connection.vendor:
+            break
+    else:
+        return None
+    if using not in _available:
+        _available[using] = backend.is_available(connection)
+    return backend if _available[using] else None
+
+
+def reset_search_backends():
+    _available.clear()
+
+
+class FullTextSearchFilter(SearchFilter):
+    """?search= через полнотекстовый индекс с сортировкой по релевантности.
+
+    Если индекса в БД нет, работает как обычный SearchFilter (ILIKE).
+    """
+    ordering_param = 'ordering'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        backend = get_search_backend(queryset.db)
+        if not terms or backend is None:
+            return super().filter_queryset(request, queryset, view)
+
+        queryset = backend.filter(queryset, terms)
+        if self.ordering_param not in request.query_params:
+            queryset = queryset.order_by('-search_rank', 'id')
+        return queryset
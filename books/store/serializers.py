@@ -1,9 +1,18 @@
+import decimal
+from functools import lru_cache
+
 from django.contrib.auth.models import User
+from django.db.models import OuterRef, Subquery
 from rest_framework import serializers
+from rest_framework.fields import empty
+from rest_framework.settings import api_settings
 from rest_framework.serializers import ModelSerializer
 
+from store.metrics import SERIALIZER_SECONDS
 from store.models import Book, UserBookRelation
 
+READERS_PREVIEW_SIZE = 3
+
 
 class BookReaderSerializer(ModelSerializer):
     class Meta:
@@ -11,23 +20,228 @@ class BookReaderSerializer(ModelSerializer):
         fields = ('first_name', 'last_name',)
 
 
-class BookSerializer(ModelSerializer):
-    # likes_count = serializers.SerializerMethodField()
-    annotated_likes = serializers.IntegerField(read_only=True)
+class TimedDataMixin:
+    """Время вычисления .data в метрике store_serializer_duration_seconds,
+    вложенные сериализаторы входят во время внешнего."""
+
+    @property
+    def data(self):
+        if hasattr(self, '_data'):
+            return super().data
+        serializer = getattr(self, 'child', self)
+        with SERIALIZER_SECONDS.time(type(serializer).__name__):
+            return super().data
+
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    pass
+
+
+class SparseFieldsMixin:
+    """Позволяет оставить в выдаче только часть полей: fields=[...]."""
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+
+class BookSerializer(TimedDataMixin, SparseFieldsMixin, ModelSerializer):
+    annotated_likes = serializers.IntegerField(source='likes_count',
+                                               read_only=True)
     rating = serializers.DecimalField(max_digits=3, decimal_places=2,
                                       read_only=True)
     owner_name = serializers.CharField(source='owner.username', default='',
                                        read_only=True)
-
-    readers = BookReaderSerializer(many=True, read_only=True)
+    readers_count = serializers.IntegerField(read_only=True)
+    readers_preview = serializers.SerializerMethodField()
 
     class Meta:
         model = Book
+        fields = ('id', 'name', 'price', 'author_name',
+                  'annotated_likes', 'rating', 'owner_name',
+                  'readers_count', 'readers_preview',)
+        list_serializer_class = TimedListSerializer
+
+    def get_readers_preview(self, book):
+        # заполняется Prefetch'ем во вьюхе, иначе отдельный запрос
+        relations = getattr(book, 'readers_preview_relations', None)
+        if relations is None:
+            relations = book.userbookrelation_set.select_related(
+                'user').order_by('id')[:READERS_PREVIEW_SIZE]
+        return BookReaderSerializer([relation.user for relation in relations],
+                                    many=True).data
+
+
+def first_readers(size=READERS_PREVIEW_SIZE):
+    """Первые size отношений каждой книги (по id)."""
+    first_relations = UserBookRelation.objects.filter(
+        book=OuterRef('book')).order_by('id').values('id')[:size]
+    return UserBookRelation.objects.filter(
+        id__in=Subquery(first_relations)).order_by('id')
+
+
+class FastBookSerializer:
+    """Сериализация строк ``.values()`` в точности в формат BookSerializer,
+    только для чтения.
+
+    Для каждого поля BookSerializer заранее собирается функция
+    «значение колонки -> значение в ответе», поэтому на каждую книгу нет
+    ни поиска полей, ни get_attribute/to_representation DRF. Превью
+    читателей загружается одним запросом на все строки.
+    """
+    serializer_class = BookSerializer
+    # колонка .values() для каждого поля
+    columns = {
+        'id': 'id',
+        'name': 'name',
+        'price': 'price',
+        'author_name': 'author_name',
+        'annotated_likes': 'likes_count',
+        'rating': 'rating',
+        'owner_name': 'owner__username',
+        'readers_count': 'readers_count',
+    }
+    readers_preview_field = 'readers_preview'
+
+    def __init__(self, instance, many=True, fields=None, context=None,
+                 readers_previews=None):
+        assert many, 'FastBookSerializer serializes lists only'
+        self.instance = instance
+        self.fields = tuple(fields or self.serializer_class.Meta.fields)
+        self.readers_previews = readers_previews
+
+    @classmethod
+    def get_columns(cls, fields=None):
+        fields = fields or cls.serializer_class.Meta.fields
+        return ['id'] + [cls.columns[field] for field in fields
+                         if field in cls.columns and field != 'id']
+
+    @property
+    def data(self):
+        with SERIALIZER_SECONDS.time(type(self).__name__):
+            return self.serialize()
+
+    def serialize(self):
+        accessors = _compile_accessors(
+            self.serializer_class, self.fields, tuple(self.columns.items()),
+            self.readers_preview_field)
+        rows = self.instance
+        previews = {}
+        if self.readers_preview_field in self.fields:
+            previews = self.readers_previews
+            if previews is None:
+                previews = self.load_readers_previews(
+                    [row['id'] for row in rows])
+        return [
+            {name: accessor(row[column]) if accessor is not None
+             else previews.get(row[column], [])
+             for name, column, accessor in accessors}
+            for row in rows
+        ]
+
+    @staticmethod
+    def load_readers_previews(book_ids):
+        previews = {}
+        for book_id, first_name, last_name in first_readers().filter(
+                book_id__in=book_ids).values_list(
+                'book_id', 'user__first_name', 'user__last_name'):
+            previews.setdefault(book_id, []).append(
+                {'first_name': first_name, 'last_name': last_name})
+        return previews
+
+
+@lru_cache(maxsize=None)
+def _compile_accessors(serializer_class, fields, columns, preview_field):
+    # (поле, колонка, функция), для превью читателей функции нет:
+    # оно берётся по id книги
+    columns = dict(columns)
+    accessors = []
+    for name, field in serializer_class(fields=fields).fields.items():
+        if name == preview_field:
+            accessors.append((name, 'id', None))
+        else:
+            accessors.append((name, columns[name], _compile_field(field)))
+    return accessors
+
+
+def _compile_field(field):
+    """Функция, повторяющая Serializer.to_representation для одного поля."""
+    # как Field.get_attribute: None в середине source ('owner.username')
+    # даёт default, а просто None так и остаётся None
+    none_value = None
+    if len(field.source_attrs) > 1 and field.default is not empty:
+        none_value = field.default
+
+    if isinstance(field, serializers.DecimalField) and \
+            not field.localize and getattr(
+            field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING):
+        context = decimal.getcontext().copy()
+        if field.max_digits is not None:
+            context.prec = field.max_digits
+        exponent = decimal.Decimal('.1') ** field.decimal_places
+
+        def represent(value):
+            if value is None:
+                return none_value
+            if not isinstance(value, decimal.Decimal):
+                value = decimal.Decimal(str(value).strip())
+            return '{:f}'.format(value.quantize(
+                exponent, rounding=field.rounding, context=context))
+    elif type(field) is serializers.IntegerField:
+        def represent(value):
+            return none_value if value is None else int(value)
+    elif type(field) is serializers.CharField:
+        def represent(value):
+            return none_value if value is None else str(value)
+    else:
+        def represent(value):
+            if value is None:
+                return none_value
+            return field.to_representation(value)
+    return represent
+
+
+class BookWithReadersSerializer(BookSerializer):
+    """Старый формат книги с полным списком читателей."""
+    readers = BookReaderSerializer(many=True, read_only=True)
+
+    class Meta(BookSerializer.Meta):
         fields = ('id', 'name', 'price', 'author_name',
                   'annotated_likes', 'rating', 'owner_name', 'readers',)
 
 
-class UserBookRelationSerializer(ModelSerializer):
+class PersonalBookSerializer(BookSerializer):
+    """Книга с лайком, закладкой и оценкой текущего пользователя из
+    аннотаций queryset'а (см. BookViewSet.get_queryset)."""
+    my_like = serializers.BooleanField(read_only=True)
+    my_bookmark = serializers.BooleanField(read_only=True)
+    my_rate = serializers.IntegerField(read_only=True)
+
+    class Meta(BookSerializer.Meta):
+        fields = BookSerializer.Meta.fields + (
+            'my_like', 'my_bookmark', 'my_rate',)
+
+
+class PersonalFastBookSerializer(FastBookSerializer):
+    serializer_class = PersonalBookSerializer
+    columns = dict(FastBookSerializer.columns, my_like='my_like',
+                   my_bookmark='my_bookmark', my_rate='my_rate')
+
+
+class UserBookRelationSerializer(TimedDataMixin, ModelSerializer):
+    class Meta:
+        model = UserBookRelation
+        fields = ('book', 'like', 'in_bookmarks', 'rate',)
+
+
+class UserBookRelationBulkSerializer(ModelSerializer):
+    """Элемент пачки отношений, книга - просто id: её существование
+    проверяется одним запросом на всю пачку."""
+    book = serializers.IntegerField(min_value=1)
+
     class Meta:
         model = UserBookRelation
         fields = ('book', 'like', 'in_bookmarks', 'rate',)
@@ -0,0 +1,87 @@
+from contextvars import ContextVar
+
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from store import leaderboards
+from store.cache import bump_book_version, bump_user_version
+from store.db.sqlite import apply_pragmas
+from store.models import Book, LeaderboardEntry, UserBookRelation
+
+# id книг, которые сейчас удаляются вместе с отношениями
+_deleting_books = ContextVar('store_deleting_books', default=frozenset())
+# поля User в ответах по книгам: owner_name, readers_preview и readers
+BOOK_USER_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    apply_pragmas(connection)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def book_changed(sender, instance, **kwargs):
+    bump_book_version(instance.id)
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, created, **kwargs):
+    leaderboards.book_saved(instance, created)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    """Меняет updated_at и версии в кеше книг владельца и читателя: их
+    ответы показывают имя пользователя, а книги оно не меняет."""
+    if created or update_fields is not None and \
+            not BOOK_USER_FIELDS.intersection(update_fields):
+        # например, last_login при входе
+        return
+    book_ids = list(Book.objects.filter(
+        Q(owner=instance) | Q(readers=instance)).values_list(
+        'id', flat=True).distinct())
+    if book_ids:
+        Book.objects.filter(id__in=book_ids).update(
+            updated_at=timezone.now())
+        bump_book_version(*book_ids)
+
+
+@receiver(pre_delete, sender=Book)
+def book_deleting(sender, instance, **kwargs):
+    _deleting_books.set(_deleting_books.get() | {instance.id})
+    # места книги удалятся каскадом, запоминаем, какие таблицы добрать
+    instance._leaderboards = list(LeaderboardEntry.objects.filter(
+        book_id=instance.id).values_list('board', flat=True))
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    _deleting_books.set(_deleting_books.get() - {instance.id})
+    if getattr(instance, '_leaderboards', None):
+        leaderboards.refill_leaderboards(instance._leaderboards)
+
+
+@receiver(post_save, sender=UserBookRelation)
+@receiver(post_delete, sender=UserBookRelation)
+def relation_changed(sender, instance, **kwargs):
+    bump_user_version(instance.user_id)
+
+
+@receiver(post_delete, sender=UserBookRelation)
+def relation_deleted(sender, instance, **kwargs):
+    from store.logic import update_book_counters
+
+    if instance.book_id in _deleting_books.get():
+        # счётчики и места удаляемой книги пересчитывать незачем
+        return
+    old_rating, old_like = instance.rate, instance.like
+    if instance.has_loaded_values():
+        old_rating = instance.get_loaded_value('rate')
+        old_like = instance.get_loaded_value('like')
+    update_book_counters(instance.book_id, old_rate=old_rating,
+                         old_like=old_like, readers_delta=-1)
@@ -1,16 +1,30 @@
 import json
+import multiprocessing
+import os
+import tempfile
+from base64 import urlsafe_b64encode
+from unittest import mock
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import connection
-from django.db.models import Count, Case, When
 from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.exceptions import ErrorDetail
-from rest_framework.test import APITestCase
+from django.test import override_settings
+from rest_framework.test import APIClient, APITestCase
 
+from store import metrics, views
+from store.cache import get_stats
+from store.logic import set_rating
 from store.models import Book, UserBookRelation
-from store.serializers import BookSerializer
+from store.querybudget import QueryBudgetExceeded
+from store.routers import PIN_COOKIE
+from store.search import SQLiteFTSBackend, reset_search_backends
+from store.serializers import BookSerializer, BookWithReadersSerializer
+from store.views import BookViewSet
 
 
 class BooksApiTestCase(APITestCase):
@@ -33,16 +47,14 @@ class BooksApiTestCase(APITestCase):
         with CaptureQueriesContext(connection) as queries:  # Проверка запросов
             response = self.client.get(url)
             self.assertEqual(2, len(queries))
-        books = Book.objects.all().annotate(
-            annotated_likes=Count(
-                Case(When(userbookrelation__like=True, then=1))),
-        ).order_by('id')
+            self.assertNotIn('GROUP BY', queries[0]['sql'])
+        books = Book.objects.all().order_by('id')
 
         serializer_data = BookSerializer(books,
                                          many=True).data  # передаем список элементов и каждый серриализоввываем
 
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
         self.assertEqual(serializer_data[0]['rating'], '5.00')
         self.assertEqual(serializer_data[0]['annotated_likes'], 1)
 
@@ -50,10 +62,7 @@ class BooksApiTestCase(APITestCase):
         """Получаем информацию об одной книге"""
         url = reverse('book-detail', args=(self.book_1.id,))
         book = Book.objects.filter(
-            id__in=[self.book_1.id]).annotate(
-            annotated_likes=Count(
-                Case(When(userbookrelation__like=True, then=1))),
-        ).first()
+            id__in=[self.book_1.id]).first()
         response = self.client.get(url)
         serializer_data = BookSerializer(book).data
         self.assertEqual(status.HTTP_200_OK, response.status_code)
@@ -63,42 +72,238 @@ class BooksApiTestCase(APITestCase):
         """Фильтрация по цене"""
         url = reverse('book-list')
         books = Book.objects.filter(
-            id__in=[self.book_2.id, self.book_3.id]).annotate(
-            annotated_likes=Count(
-                Case(When(userbookrelation__like=True, then=1))),
-        )
+            id__in=[self.book_2.id, self.book_3.id])
         response = self.client.get(url, data={'price': 55})
         serializer_data = BookSerializer(books, many=True).data
 
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
 
     def test_get_search(self):
         """Поиск автору"""
         url = reverse('book-list')
         books = Book.objects.filter(
-            id__in=[self.book_1.id, self.book_3.id]).annotate(
-            annotated_likes=Count(
-                Case(When(userbookrelation__like=True, then=1))),
-        )
+            id__in=[self.book_1.id, self.book_3.id])
         response = self.client.get(url, data={'search': 'Author 1'})
         serializer_data = BookSerializer(books, many=True).data
 
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_search_index(self):
+        """Поиск идёт по полнотекстовому индексу с ранжированием"""
+        Book.objects.create(name='Author Author', price=10,
+                            author_name='Author 1')
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'search': 'auth',
+                                                  'fields': 'id,name'})
+        self.assertIn('store_book_fts', queries[0]['sql'])
+        names = [book['name'] for book in response.data['results']]
+        self.assertEqual(4, len(names))
+        self.assertEqual('Author Author', names[0])
+
+        response = self.client.get(url, data={'search': 'auth',
+                                              'fields': 'id,name',
+                                              'page_size': 3})
+        response = self.client.get(response.data['next'])
+        self.assertEqual(names[3:], [book['name'] for book
+                                     in response.data['results']])
+
+        self.book_2.name = 'Python'
+        self.book_2.save()
+        response = self.client.get(url, data={'search': 'python'})
+        self.assertEqual([self.book_2.id],
+                         [book['id'] for book in response.data['results']])
+
+    def test_get_search_fallback(self):
+        """Без индекса поиск работает через ILIKE"""
+        url = reverse('book-list')
+        reset_search_backends()
+        try:
+            with mock.patch.object(SQLiteFTSBackend, 'is_available',
+                                   return_value=False):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url,
+                                               data={'search': 'ok Author 1'})
+        finally:
+            reset_search_backends()
+        self.assertNotIn('store_book_fts', queries[0]['sql'])
+        self.assertEqual([self.book_1.id, self.book_3.id],
+                         [book['id'] for book in response.data['results']])
 
     def test_get_sort(self):
         """Сортировка по цене"""
         url = reverse('book-list')
         response = self.client.get(url, data={'ordering': 'price'})
-        books = Book.objects.all().annotate(
-            annotated_likes=Count(
-                Case(When(userbookrelation__like=True, then=1))),
-        ).order_by('price')
+        books = Book.objects.all().order_by('price')
         serializer_data = BookSerializer(books, many=True).data  # передаем список элементов и каждый серриализоввываем
 
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_pages(self):
+        """Курсорная пагинация с сортировкой по цене и id"""
+        url = reverse('book-list')
+        response = self.client.get(url, data={'ordering': '-price',
+                                              'page_size': 2})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.book_2.id, self.book_3.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['previous'])
+        self.assertNotIn('count', response.data)
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([self.book_1.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([self.book_2.id, self.book_3.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['previous'])
+
+    def test_get_pages_count(self):
+        """Общее количество считается по запросу и кешируется"""
+        url = reverse('book-list')
+        data = {'price': 55, 'page_size': 1, 'count': 'true'}
+        response = self.client.get(url, data=data)
+        self.assertEqual(2, response.data['count'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(response.data['next'])
+        self.assertEqual(2, response.data['count'])
+        self.assertEqual([self.book_3.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertFalse([query for query in queries
+                          if 'COUNT' in query['sql']])
+
+    def test_get_readers_preview(self):
+        """В списке только первые читатели, полный список - по ссылке"""
+        users = [User.objects.create(username=f'reader{i}', first_name=str(i))
+                 for i in range(4)]
+        for user in users:
+            UserBookRelation.objects.create(user=user, book=self.book_2)
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(2, len(queries))
+        book_2 = response.data['results'][1]
+        self.assertEqual(4, book_2['readers_count'])
+        self.assertEqual(['0', '1', '2'], [reader['first_name'] for reader
+                                           in book_2['readers_preview']])
+        self.assertNotIn('readers', book_2)
+
+        url = reverse('book-readers', args=(self.book_2.id,))
+        response = self.client.get(url, data={'page_size': 3})
+        self.assertEqual(['0', '1', '2'], [reader['first_name'] for reader
+                                           in response.data['results']])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(['3'], [reader['first_name'] for reader
+                                 in response.data['results']])
+
+    def test_get_full_readers(self):
+        """Старый формат списка с полным списком читателей"""
+        url = reverse('book-list')
+        response = self.client.get(url, data={'readers': 'full'})
+        books = Book.objects.all().order_by('id')
+        serializer_data = BookWithReadersSerializer(books, many=True).data
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_sparse_fields(self):
+        """Урезанная выдача - один узкий SELECT без JOIN и prefetch"""
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'fields': 'id,name,price'})
+        self.assertEqual(1, len(queries))
+        sql = queries[0]['sql']
+        self.assertNotIn('JOIN', sql)
+        self.assertNotIn('"author_name"', sql)
+        self.assertNotIn('"likes_count"', sql)
+        self.assertEqual({'id': self.book_1.id, 'name': 'test book 1',
+                          'price': '25.00'}, response.data['results'][0])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={
+                'exclude': 'owner_name,readers_preview', 'ordering': 'price'})
+        self.assertEqual(1, len(queries))
+        self.assertNotIn('JOIN', queries[0]['sql'])
+        self.assertEqual(['id', 'name', 'price', 'author_name',
+                          'annotated_likes', 'rating', 'readers_count'],
+                         list(response.data['results'][0]))
+
+    def test_get_id_sparse_fields(self):
+        """Урезанная выдача одной книги"""
+        url = reverse('book-detail', args=(self.book_1.id,))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'fields': 'owner_name'})
+        self.assertEqual(1, len(queries))
+        self.assertIn('JOIN', queries[0]['sql'])
+        self.assertEqual({'owner_name': 'test_username'}, response.data)
+
+    def test_get_bad_cursor(self):
+        """Неверный курсор"""
+        url = reverse('book-list')
+        response = self.client.get(url, data={'cursor': 'bad'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_get_cursor_bad_types(self):
+        """Курсор с позицией не того типа - 404, а не 500"""
+        url = reverse('book-list')
+        for ordering, position in (('', ['abc']),
+                                   ('price', ['abc', 1]),
+                                   ('price', [{'a': 1}, 1]),
+                                   ('-price', [None, 1])):
+            cursor = urlsafe_b64encode(json.dumps(
+                {'r': 0, 'p': position}).encode()).decode()
+            response = self.client.get(url, data={'cursor': cursor,
+                                                  'ordering': ordering})
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code,
+                             position)
+
+        cursor = urlsafe_b64encode(json.dumps(
+            {'r': 0, 'p': ['25.00', str(self.book_1.id)]}).encode()).decode()
+        response = self.client.get(url, data={'cursor': cursor,
+                                              'ordering': 'price'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+    def test_export_ndjson(self):
+        """Выгрузка всего каталога в NDJSON пачками: на пачку один запрос
+        книг и один запрос читателей"""
+        url = reverse('book-export')
+        with mock.patch('store.views.BookViewSet.export_chunk_size', 2), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+            content = b''.join(response.streaming_content)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        # SQLite отдаёт строки одним запросом, дальше - по prefetch на пачку
+        self.assertEqual(3, len(queries), queries.captured_queries)
+
+        books = Book.objects.all().order_by('id')
+        self.assertEqual(BookSerializer(books, many=True).data,
+                         [json.loads(line) for line in
+                          content.decode().splitlines()])
+
+    def test_export_json(self):
+        """Выгрузка JSON-массивом с фильтрами и полями списка"""
+        url = reverse('book-export')
+        with mock.patch('store.views.BookViewSet.export_chunk_size', 1):
+            response = self.client.get(url, data={
+                'export_format': 'json', 'ordering': '-price', 'price': 55,
+                'fields': 'id,name'})
+            content = b''.join(response.streaming_content)
+        self.assertEqual('application/json', response['Content-Type'])
+        self.assertEqual([
+            {'id': self.book_2.id, 'name': 'test book 2'},
+            {'id': self.book_3.id, 'name': 'test book Author 1'},
+        ], json.loads(content))
+
+        response = self.client.get(url, data={'export_format': 'json',
+                                              'price': 1})
+        self.assertEqual([], json.loads(b''.join(response.streaming_content)))
+        response = self.client.get(url, data={'export_format': 'xml'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
 
     def test_create(self):
         """Создание новой книги и проверка всех полей"""
@@ -223,6 +428,167 @@ class BooksApiTestCase(APITestCase):
         self.assertEqual(3, Book.objects.all().count())
 
 
+class BooksCacheTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='test book 1', price=25,
+                                          author_name='Author 1',
+                                          owner=self.user)
+        self.book_2 = Book.objects.create(name='test book 2', price=55,
+                                          author_name='Author 5')
+
+    def test_list(self):
+        """Повторный запрос списка отдаётся из кеша без запросов к БД"""
+        url = reverse('book-list')
+        response = self.client.get(url, data={'ordering': 'price'})
+        self.assertEqual('MISS', response['X-Cache'])
+        stats = get_stats()
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(url, data={'ordering': 'price'})
+        self.assertEqual(0, len(queries))
+        self.assertEqual('HIT', cached['X-Cache'])
+        self.assertEqual(response.data, cached.data)
+        self.assertEqual(stats['hits'] + 1, get_stats()['hits'])
+
+        response = self.client.get(url, data={'ordering': '-price'})
+        self.assertEqual('MISS', response['X-Cache'])
+
+    def test_list_invalidated_by_like(self):
+        """Лайк инвалидирует закешированный список"""
+        url = reverse('book-list')
+        self.client.get(url)
+        UserBookRelation.objects.create(user=self.user, book=self.book_2,
+                                        like=True)
+        response = self.client.get(url)
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual(1, response.data['results'][1]['annotated_likes'])
+
+    def test_detail(self):
+        """Изменение книги инвалидирует только её кеш"""
+        url_1 = reverse('book-detail', args=(self.book_1.id,))
+        url_2 = reverse('book-detail', args=(self.book_2.id,))
+        self.client.get(url_1)
+        self.client.get(url_2)
+
+        self.client.force_login(self.user)
+        self.client.patch(url_1, data=json.dumps({'price': 30}),
+                          content_type='application/json')
+        response = self.client.get(url_1)
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual('30.00', response.data['price'])
+        self.assertEqual('HIT', self.client.get(url_2)['X-Cache'])
+
+    def test_user_renamed(self):
+        """Новое имя владельца или читателя сбрасывает кеш книги"""
+        reader = User.objects.create(username='reader')
+        UserBookRelation.objects.create(user=reader, book=self.book_2,
+                                        like=True)
+        url = reverse('book-list')
+        self.client.get(url)
+        self.assertEqual('HIT', self.client.get(url)['X-Cache'])
+
+        reader.first_name = 'Reader'
+        reader.save()
+        response = self.client.get(url)
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual('Reader', response.data['results'][1][
+            'readers_preview'][0]['first_name'])
+
+        self.user.username = 'new_username'
+        self.user.save()
+        response = self.client.get(
+            reverse('book-detail', args=(self.book_1.id,)))
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertEqual('new_username', response.data['owner_name'])
+
+
+class BooksConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='test book 1', price=25,
+                                          author_name='Author 1',
+                                          owner=self.user)
+        self.book_2 = Book.objects.create(name='test book 2', price=55,
+                                          author_name='Author 5')
+
+    def test_detail(self):
+        """Книга не изменилась - 304 по одному узкому запросу"""
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        self.assertEqual(1, len(queries))
+        self.assertNotIn('"name"', queries[0]['sql'])
+
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        rate=4)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_detail_cached(self):
+        """Закешированный ответ отвечает 304 без запросов к БД"""
+        url = reverse('book-detail', args=(self.book_1.id,))
+        etag = self.client.get(url)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(0, len(queries))
+
+    def test_list(self):
+        """Валидатор списка зависит от фильтра и изменений книг в нём"""
+        url = reverse('book-list')
+        etag = self.client.get(url, data={'price': 55})['ETag']
+        self.assertNotEqual(etag, self.client.get(url)['ETag'])
+
+        cache.clear()
+        response = self.client.get(url, data={'price': 55},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        self.book_2.name = 'new name'
+        self.book_2.save()
+        response = self.client.get(url, data={'price': 55},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('new name', response.data['results'][0]['name'])
+
+    def test_user_renamed(self):
+        """Новое имя владельца или читателя меняет ETag книги, вход
+        пользователя - нет"""
+        reader = User.objects.create(username='reader')
+        UserBookRelation.objects.create(user=reader, book=self.book_2,
+                                        like=True)
+        url_1 = reverse('book-detail', args=(self.book_1.id,))
+        url_2 = reverse('book-detail', args=(self.book_2.id,))
+        etag_1 = self.client.get(url_1)['ETag']
+        etag_2 = self.client.get(url_2)['ETag']
+
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        cache.clear()
+        response = self.client.get(url_1, HTTP_IF_NONE_MATCH=etag_1)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        self.user.username = 'new_username'
+        self.user.save()
+        reader.first_name = 'Reader'
+        reader.save()
+        cache.clear()
+        response = self.client.get(url_1, HTTP_IF_NONE_MATCH=etag_1)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('new_username', response.data['owner_name'])
+        response = self.client.get(url_2, HTTP_IF_NONE_MATCH=etag_2)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+
 class BooksRelationTestCase(APITestCase):
     def setUp(self):
         self.user = User.objects.create(username='test_username')
@@ -265,6 +631,92 @@ class BooksRelationTestCase(APITestCase):
                                                 book=self.book_1)
         self.assertTrue(relation.in_bookmarks)
 
+    def test_like_queries(self):
+        """Like существующего отношения не перечитывает его и не трогает
+        рейтинг"""
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        rate=4)
+        url = reverse('userbookrelation-detail', args=(self.book_1.id,))
+        json_data = json.dumps({"like": True})
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, data=json_data,
+                                         content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        # сессия, пользователь, SELECT отношения, UPDATE отношения и
+        # счётчика, места книги, чтение мест и INSERT места в 'likes'
+        self.assertEqual(8, len(queries))
+        self.assertIn('SET "like"', queries[3]['sql'])
+        self.assertNotIn('"rate"', queries[3]['sql'])
+        self.assertIn('"likes_count"', queries[4]['sql'])
+        self.assertNotIn('"rating"', queries[4]['sql'])
+        self.assertIn('INSERT INTO "store_leaderboardentry"',
+                      queries[-1]['sql'])
+
+        self.book_1.refresh_from_db()
+        self.assertEqual('4.00', str(self.book_1.rating))
+
+    @override_settings(LEADERBOARD_SIZE=1)
+    def test_first_like_queries(self):
+        """Первая отметка книги - один INSERT отношения со значениями из
+        запроса, а лайк книги ниже последнего места не трогает таблицы"""
+        user3 = User.objects.create(username='test_username3')
+        for user in (self.user2, user3):
+            UserBookRelation.objects.create(user=user, book=self.book_2,
+                                            like=True)
+        url = reverse('userbookrelation-detail', args=(self.book_1.id,))
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, data=json.dumps({'like': True}),
+                                         content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        sql = [query['sql'] for query in queries[2:]
+               if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # SELECT и INSERT отношения, UPDATE счётчиков, места книги
+        self.assertEqual(4, len(sql), sql)
+        self.assertIn('INSERT INTO "store_userbookrelation"', sql[1])
+        self.assertNotIn('store_leaderboardentry" (', sql[-1])
+
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book_1)
+        self.assertTrue(relation.like)
+        self.book_1.refresh_from_db()
+        self.assertEqual((1, 1), (self.book_1.likes_count,
+                                  self.book_1.readers_count))
+
+    def test_concurrent_first_like(self):
+        """Отношение, созданное параллельным запросом после SELECT,
+        обновляется, а не роняет запрос"""
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        rate=4)
+        get_object = views.UserBooksRelationView.get_object
+        calls = []
+
+        def stale_get_object(view):
+            # первый SELECT ещё не видит отношение
+            calls.append(view)
+            if len(calls) == 1:
+                return UserBookRelation(user=self.user, book=self.book_1)
+            return get_object(view)
+
+        url = reverse('userbookrelation-detail', args=(self.book_1.id,))
+        self.client.force_login(self.user)
+        with mock.patch.object(views.UserBooksRelationView, 'get_object',
+                               stale_get_object):
+            response = self.client.patch(url, data=json.dumps({'like': True}),
+                                         content_type='application/json')
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(2, len(calls))
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book_1)
+        self.assertEqual((4, True), (relation.rate, relation.like))
+        self.book_1.refresh_from_db()
+        self.assertEqual((1, 4, 1, 1), (self.book_1.likes_count,
+                                        self.book_1.rating_sum,
+                                        self.book_1.rating_count,
+                                        self.book_1.readers_count))
+
     def test_rate(self):
         """Авторизованный пользователь ставит рейтинг книге"""
         url = reverse('userbookrelation-detail', args=(self.book_1.id,))
@@ -296,6 +748,530 @@ class BooksRelationTestCase(APITestCase):
 
         self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code,
                          response.data)
+        # отношение создаётся только вместе с верными значениями
+        self.assertFalse(UserBookRelation.objects.filter(
+            user=self.user, book=self.book_1).exists())
+
+    def test_bulk(self):
+        """Пачка отношений: новые создаются, существующие обновляются,
+        ошибочные элементы возвращаются по индексу"""
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=2)
+        UserBookRelation.objects.create(user=self.user2, book=self.book_2,
+                                        rate=5)
+        url = reverse('userbookrelation-bulk')
+        data = [
+            {'book': self.book_1.id, 'rate': 4, 'like': False},
+            {'book': self.book_2.id, 'rate': 3, 'in_bookmarks': True},
+            {'book': self.book_3.id, 'rate': 7},
+            {'book': 100500, 'like': True},
+            {'book': self.book_2.id, 'like': True},
+        ]
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data=json.dumps(data),
+                                        content_type='application/json')
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code,
+                         response.data)
+        self.assertEqual([
+            {'index': 0, 'book': self.book_1.id, 'created': False},
+            {'index': 1, 'book': self.book_2.id, 'created': True},
+        ], response.data['results'])
+        self.assertEqual([2, 3, 4], [error['index']
+                                     for error in response.data['errors']])
+        self.assertIn('rate', response.data['errors'][0]['errors'])
+        self.assertIn('book', response.data['errors'][1]['errors'])
+
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book_1)
+        self.assertEqual((4, False, False),
+                         (relation.rate, relation.like, relation.in_bookmarks))
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book_2)
+        self.assertEqual((3, False, True),
+                         (relation.rate, relation.like, relation.in_bookmarks))
+        self.assertFalse(UserBookRelation.objects.filter(
+            book=self.book_3).exists())
+
+        self.book_1.refresh_from_db()
+        self.assertEqual((0, 4, 1, 1), (self.book_1.likes_count,
+                                        self.book_1.rating_sum,
+                                        self.book_1.rating_count,
+                                        self.book_1.readers_count))
+        self.book_2.refresh_from_db()
+        self.assertEqual('4.00', str(self.book_2.rating))
+        self.assertEqual(2, self.book_2.readers_count)
+        # сессия, пользователь, проверка книг, SAVEPOINT, SELECT отношений,
+        # bulk_create, bulk_update, по UPDATE счётчиков на вид изменения,
+        # книги и места в таблицах лидеров, их DELETE и INSERT, RELEASE
+        self.assertEqual(14, len(queries), queries.captured_queries)
+
+    def test_bulk_concurrent_create(self):
+        """Отношение, созданное параллельным запросом после SELECT пачки,
+        не роняет пачку, а обновляется при повторе"""
+        from store import logic
+
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True)
+        lock_relations = logic._lock_relations
+        calls = []
+
+        def stale_lock(user, book_ids):
+            # первый SELECT ещё не видит отношение к book_1
+            calls.append(book_ids)
+            relations = lock_relations(user, book_ids)
+            if len(calls) == 1:
+                relations.pop(self.book_1.id)
+            return relations
+
+        url = reverse('userbookrelation-bulk')
+        data = [{'book': self.book_1.id, 'rate': 4},
+                {'book': self.book_2.id, 'like': True}]
+        self.client.force_login(self.user)
+        with mock.patch('store.logic._lock_relations', stale_lock):
+            response = self.client.post(url, data=json.dumps(data),
+                                        content_type='application/json')
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code,
+                         response.data)
+        self.assertEqual(2, len(calls))
+        self.assertEqual([
+            {'index': 0, 'book': self.book_1.id, 'created': False},
+            {'index': 1, 'book': self.book_2.id, 'created': True},
+        ], response.data['results'])
         relation = UserBookRelation.objects.get(user=self.user,
                                                 book=self.book_1)
-        self.assertEqual(None, relation.rate)
+        self.assertEqual((4, True), (relation.rate, relation.like))
+        self.book_1.refresh_from_db()
+        self.assertEqual((1, 4, 1, 1), (self.book_1.likes_count,
+                                        self.book_1.rating_sum,
+                                        self.book_1.rating_count,
+                                        self.book_1.readers_count))
+
+    def test_bulk_not_list(self):
+        """Пачка должна быть списком"""
+        url = reverse('userbookrelation-bulk')
+        self.client.force_login(self.user)
+        response = self.client.post(url, data=json.dumps({'book': 1}),
+                                    content_type='application/json')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+
+@override_settings(READ_REPLICAS=['replica1'])
+class BooksReplicaTestCase(APITestCase):
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='test_username')
+        self.book = Book.objects.create(name='test book 1', price=25,
+                                        author_name='Author 1',
+                                        owner=self.user)
+        self.replicate()
+
+    @staticmethod
+    def replicate():
+        """Реплика догнала основную БД"""
+        for model in (User, Book):
+            model.objects.using('replica1').all().delete()
+            model.objects.using('replica1').bulk_create(model.objects.all())
+
+    def test_read_from_replica(self):
+        """Чтения идут на реплику, пока она отстаёт - видны старые данные"""
+        url = reverse('book-detail', args=(self.book.id,))
+        Book.objects.filter(id=self.book.id).update(name='not replicated')
+
+        response = self.client.get(url)
+        self.assertEqual('test book 1', response.data['name'])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.replicate()
+        response = self.client.get(reverse('book-list'))
+        self.assertEqual('not replicated',
+                         response.data['results'][0]['name'])
+
+    def test_read_your_writes(self):
+        """Автор сразу видит свою правку, остальные - когда реплика
+        догонит"""
+        url = reverse('book-detail', args=(self.book.id,))
+        self.client.force_login(self.user)
+        response = self.client.patch(url, data=json.dumps({'name': 'new'}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        self.assertEqual('new', self.client.get(url).data['name'])
+        self.assertEqual('new', self.client.get(
+            reverse('book-list')).data['results'][0]['name'])
+
+        other = APIClient()
+        self.assertEqual('test book 1', other.get(url).data['name'])
+        self.replicate()
+        cache.clear()
+        self.assertEqual('new', other.get(url).data['name'])
+
+    def test_relation_pins_primary(self):
+        """Запись отношения тоже переключает клиента на основную БД"""
+        url = reverse('userbookrelation-detail', args=(self.book.id,))
+        self.client.force_login(self.user)
+        response = self.client.patch(url, data=json.dumps({'like': True}),
+                                     content_type='application/json')
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        response = self.client.get(reverse('book-detail',
+                                           args=(self.book.id,)))
+        self.assertEqual(1, response.data['annotated_likes'])
+        response = APIClient().get(reverse('book-detail',
+                                           args=(self.book.id,)))
+        self.assertEqual(0, response.data['annotated_likes'])
+
+
+class QueryBudgetTestCase(APITestCase):
+    """books.test_runner включает QUERY_BUDGET_MODE='raise', бюджеты
+    проверяются в каждом запросе к API"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='test_username')
+        for index in range(3):
+            Book.objects.create(name=f'test book {index}', price=25,
+                                author_name='Author 1', owner=self.user)
+
+    def test_budget_exceeded(self):
+        """Превышение бюджета действия"""
+        with mock.patch.dict(BookViewSet.query_budgets, {'list': 1}):
+            with self.assertRaisesRegex(
+                    QueryBudgetExceeded,
+                    r'BookViewSet\.list: \d+ queries, budget 1'):
+                self.client.get(reverse('book-list'))
+
+    @override_settings(QUERY_BUDGET_MODE='log')
+    def test_budget_log(self):
+        """В режиме log превышение только пишется в лог"""
+        with mock.patch.dict(BookViewSet.query_budgets, {'list': 1}), \
+                self.assertLogs('store.querybudget', 'WARNING') as logs:
+            response = self.client.get(reverse('book-list'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertRegex(logs.output[0],
+                         r'BookViewSet\.list: \d+ queries, budget 1')
+
+    @override_settings(QUERY_BUDGET_REPEATS=3)
+    def test_n_plus_one(self):
+        """Владелец каждой книги отдельным запросом - N+1 со стеком"""
+        def get_queryset(view):
+            return Book.objects.all().order_by('id')
+
+        with mock.patch.object(BookViewSet, 'fast_serializer_class', None), \
+                mock.patch.object(BookViewSet, 'get_queryset',
+                                  get_queryset), \
+                mock.patch.dict(BookViewSet.query_budgets, {'list': None}):
+            with self.assertRaises(QueryBudgetExceeded) as context:
+                self.client.get(reverse('book-list'), {'exclude': 'x'})
+        message = str(context.exception)
+        self.assertIn('BookViewSet.list: N+1, 3 identical queries', message)
+        self.assertIn('"auth_user"', message)
+        self.assertIn('test_api.py', message)
+
+
+def _recompute_in_child():
+    metrics.RATING_RECOMPUTES.inc('child')
+    metrics.REQUEST_SECONDS.observe(0.3, 'BookViewSet.list', 'GET')
+    # дочерний процесс multiprocessing завершается без atexit
+    metrics.flush()
+
+
+def _pool_in_child():
+    metrics.DB_POOL_WAITS.inc('child')
+    metrics.DB_POOL_CONNECTIONS.set(3, 'child', 'in_use')
+    metrics.flush()
+
+
+class MetricsTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.user = User.objects.create(username='test_username')
+        self.book = Book.objects.create(name='test book', price=25,
+                                        author_name='Author 1',
+                                        owner=self.user)
+
+    def get_metrics(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(metrics.CONTENT_TYPE, response['Content-Type'])
+        return response.content.decode()
+
+    def test_request_metrics(self):
+        """Время ответа по действию, запросы к БД и время сериализатора"""
+        self.client.get(reverse('book-list'))
+        self.client.get(reverse('book-list'))
+        self.client.get(reverse('book-detail', args=(self.book.id,)))
+        text = self.get_metrics()
+        self.assertIn('# TYPE store_request_duration_seconds histogram',
+                      text)
+        self.assertIn('store_request_duration_seconds_count'
+                      '{view="BookViewSet.list",method="GET"} 2', text)
+        self.assertIn('store_request_duration_seconds_bucket'
+                      '{view="BookViewSet.list",method="GET",le="+Inf"} 2',
+                      text)
+        self.assertIn('store_request_duration_seconds_count'
+                      '{view="BookViewSet.retrieve",method="GET"} 1', text)
+        self.assertIn('store_db_queries_per_request_count'
+                      '{view="BookViewSet.list"} 2', text)
+        self.assertIn('store_db_duration_seconds_per_request_count'
+                      '{view="BookViewSet.list"} 2', text)
+        # второй список отдан из кеша ответов без сериализации
+        self.assertIn('store_serializer_duration_seconds_count'
+                      '{serializer="FastBookSerializer"} 1', text)
+        self.assertIn('store_serializer_duration_seconds_count'
+                      '{serializer="BookSerializer"} 1', text)
+
+    def test_rating_recomputes(self):
+        """Вызовы и время пересчётов рейтинга"""
+        set_rating(self.book)
+        set_rating(self.book)
+        text = self.get_metrics()
+        self.assertIn('store_rating_recomputes_total'
+                      '{function="set_rating"} 2', text)
+        self.assertIn('store_rating_recompute_seconds_total'
+                      '{function="set_rating"}', text)
+
+    def test_multiprocess(self):
+        """/metrics складывает значения всех процессов из METRICS_DIR"""
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS_DIR=directory):
+            metrics.REQUEST_SECONDS.observe(0.02, 'BookViewSet.list', 'GET')
+            child = multiprocessing.get_context('fork').Process(
+                target=_recompute_in_child)
+            child.start()
+            child.join()
+            self.assertEqual(0, child.exitcode)
+            text = metrics.render()
+        self.assertIn('store_rating_recomputes_total{function="child"} 1',
+                      text)
+        self.assertIn('store_request_duration_seconds_count'
+                      '{view="BookViewSet.list",method="GET"} 2', text)
+        self.assertIn('store_request_duration_seconds_bucket'
+                      '{view="BookViewSet.list",method="GET",le="0.025"} 1',
+                      text)
+        self.assertIn('store_request_duration_seconds_bucket'
+                      '{view="BookViewSet.list",method="GET",le="0.5"} 2',
+                      text)
+
+    def test_dead_process_files(self):
+        """Счётчики остановленного процесса переносятся в архив, его файл
+        и Gauge удаляются"""
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS_DIR=directory):
+            child = multiprocessing.get_context('fork').Process(
+                target=_pool_in_child)
+            child.start()
+            child.join()
+            text = metrics.render()
+            # повторный сбор не переносит счётчики ещё раз
+            self.assertEqual(text, metrics.render())
+            files = sorted(name for name in os.listdir(directory)
+                           if name.endswith('.json'))
+        self.assertIn('store_db_pool_waits_total{alias="child"} 1', text)
+        self.assertNotIn('alias="child",state="in_use"', text)
+        self.assertEqual(f'archive_{os.getpid()}.json', files[0])
+        self.assertFalse(any(name.startswith(f'metrics_{child.pid}_')
+                             for name in files))
+
+    def test_previous_run_files(self):
+        """Файлы процессов прошлого запуска сервера не учитываются"""
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS_DIR=directory):
+            child = multiprocessing.get_context('fork').Process(
+                target=_pool_in_child)
+            child.start()
+            child.join()
+            name = next(name for name in os.listdir(directory)
+                        if name.startswith(f'metrics_{child.pid}_'))
+            # как будто его запустил уже остановленный мастер
+            old_name = f'metrics_{child.pid}_{child.pid}_old.json'
+            os.rename(os.path.join(directory, name),
+                      os.path.join(directory, old_name))
+            text = metrics.render()
+            files = os.listdir(directory)
+        self.assertNotIn('alias="child"', text)
+        self.assertFalse(any(str(child.pid) in name for name in files))
+
+    def test_access(self):
+        """/metrics только для METRICS_ALLOWED_IPS и METRICS_TOKEN"""
+        url = reverse('metrics')
+        self.assertEqual(status.HTTP_200_OK, self.client.get(url).status_code)
+        with override_settings(METRICS_ALLOWED_IPS=['10.0.0.0/8'],
+                               METRICS_TOKEN='secret'):
+            self.assertEqual(status.HTTP_403_FORBIDDEN,
+                             self.client.get(url).status_code)
+            self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get(
+                url, HTTP_AUTHORIZATION='Bearer wrong').status_code)
+            self.assertEqual(status.HTTP_200_OK, self.client.get(
+                url, HTTP_AUTHORIZATION='Bearer secret').status_code)
+            self.assertEqual(status.HTTP_200_OK, self.client.get(
+                url, REMOTE_ADDR='10.1.2.3').status_code)
+
+
+class LeaderboardApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='test book 1', price=25,
+                                          author_name='Author 1',
+                                          owner=self.user)
+        self.book_2 = Book.objects.create(name='test book 2', price=600,
+                                          author_name='Author 2')
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=3)
+        UserBookRelation.objects.create(user=self.user, book=self.book_2,
+                                        rate=5)
+
+    def test_list(self):
+        response = self.client.get(reverse('leaderboard-list'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(['likes', 'rating', 'rating-budget'], response.data)
+
+    def test_get(self):
+        """Места в порядке таблицы с книгами в формате списка книг"""
+        url = reverse('leaderboard-detail', args=('rating',))
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('rating', response.data['board'])
+        self.assertEqual([(1, 5.0, self.book_2.id), (2, 3.0, self.book_1.id)],
+                         [(entry['position'], entry['score'],
+                           entry['book']['id'])
+                          for entry in response.data['results']])
+        book = response.data['results'][1]['book']
+        self.assertEqual('test_username', book['owner_name'])
+        self.assertEqual(1, book['annotated_likes'])
+        self.assertNotIn('readers_preview', book)
+
+        response = self.client.get(url, {'limit': 1})
+        self.assertEqual([self.book_2.id],
+                         [entry['book']['id']
+                          for entry in response.data['results']])
+
+        url = reverse('leaderboard-detail', args=('rating-budget',))
+        response = self.client.get(url)
+        self.assertEqual([self.book_1.id],
+                         [entry['book']['id']
+                          for entry in response.data['results']])
+
+    def test_relation_patch(self):
+        """Первый лайк книги через API ставит её в таблицу"""
+        book_3 = Book.objects.create(name='test book 3', price=30,
+                                     author_name='Author 3')
+        self.client.force_login(self.user)
+        url = reverse('userbookrelation-detail', args=(book_3.id,))
+        response = self.client.patch(url, data=json.dumps({'like': True}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.client.get(reverse('leaderboard-detail',
+                                           args=('likes',)))
+        self.assertEqual([self.book_1.id, book_3.id],
+                         [entry['book']['id']
+                          for entry in response.data['results']])
+
+    def test_unknown(self):
+        url = reverse('leaderboard-detail', args=('unknown',))
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class MyRelationsApiTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='test_username')
+        self.other = User.objects.create(username='test_username2')
+        self.books = [Book.objects.create(name=f'test book {i}', price=25,
+                                          author_name='Author')
+                      for i in range(3)]
+        UserBookRelation.objects.create(user=self.user, book=self.books[0],
+                                        like=True, rate=4)
+        UserBookRelation.objects.create(user=self.user, book=self.books[1],
+                                        in_bookmarks=True)
+        UserBookRelation.objects.create(user=self.other, book=self.books[2],
+                                        like=True, in_bookmarks=True, rate=1)
+        self.url = reverse('book-list')
+
+    def my_relations(self, response):
+        return [(book['my_like'], book['my_bookmark'], book['my_rate'])
+                for book in response.data['results']]
+
+    def test_get(self):
+        """Отметки пользователя приходят в том же запросе, что и книги"""
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'my_relations': 1})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([(True, False, 4), (False, True, None),
+                          (False, False, None)],
+                         self.my_relations(response))
+        # сессия, пользователь, страница, превью читателей
+        self.assertEqual(4, len(queries))
+        self.assertIn('LEFT OUTER JOIN "store_userbookrelation"',
+                      queries[2]['sql'])
+
+        # больше книг - столько же запросов
+        for i in range(5):
+            Book.objects.create(name=f'more {i}', price=25,
+                                author_name='Author')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'my_relations': 1})
+        self.assertEqual(8, len(response.data['results']))
+        self.assertEqual(4, len(queries))
+
+        response = self.client.get(self.url, {'my_relations': 1,
+                                              'fields': 'id,my_rate'})
+        self.assertEqual({'id': self.books[0].id, 'my_rate': 4},
+                         response.data['results'][0])
+
+        response = self.client.get(
+            reverse('book-detail', args=(self.books[0].id,)),
+            {'my_relations': 1})
+        self.assertEqual((True, False, 4),
+                         (response.data['my_like'],
+                          response.data['my_bookmark'],
+                          response.data['my_rate']))
+
+    def test_not_requested(self):
+        """Без параметра и без входа выдача прежняя"""
+        response = self.client.get(self.url, {'my_relations': 1})
+        self.assertNotIn('my_like', response.data['results'][0])
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertNotIn('my_like', response.data['results'][0])
+
+    def test_cache(self):
+        """Закешированный ответ и ETag у каждого пользователя свои и
+        устаревают при изменении его отметок"""
+        self.client.force_login(self.user)
+        response = self.client.get(self.url, {'my_relations': 1})
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)
+        response = self.client.get(self.url, {'my_relations': 1},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        self.client.force_login(self.other)
+        response = self.client.get(self.url, {'my_relations': 1},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual((False, False, None), self.my_relations(response)[0])
+
+        # закладка не меняет ни счётчиков, ни updated_at книги
+        self.client.force_login(self.user)
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.books[0])
+        relation.in_bookmarks = True
+        relation.save()
+        response = self.client.get(self.url, {'my_relations': 1},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual((True, True, 4), self.my_relations(response)[0])
+
+        UserBookRelation.objects.filter(user=self.user).update(
+            in_bookmarks=False)
+        response = self.client.get(self.url, {'my_relations': 1})
+        self.assertEqual((True, False, 4), self.my_relations(response)[0])
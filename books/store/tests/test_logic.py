@@ -1,14 +1,37 @@
 import os
+from decimal import Decimal
+import sqlite3
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
 from django.contrib.auth.models import User
 
-from store.models import Book, UserBookRelation
+from store.models import Book, DirtyBook, LeaderboardEntry, \
+    UserBookRelation
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "books.settings")
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 
-from store.logic import operations, set_rating
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, \
+    transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.utils import load_backend
+from django.core.management.base import CommandError
+
+from store.logic import operations, set_rating, find_rating_drift, \
+    rebuild_ratings, find_likes_drift, rebuild_likes, find_readers_drift, \
+    rebuild_readers, process_dirty_books
+from store import leaderboards, logic, metrics
+from store.dataset import DatasetGenerator
+from store.db import pool as db_pool
+from store.db.sqlite import apply_pragmas, retry_on_locked
+from store.leaderboards import find_leaderboard_drift, rebuild_leaderboards
+from store.search import SQLiteFTSBackend
 
 
 class LogicTestCase(TestCase):
@@ -51,3 +74,843 @@ class SetRatingTestCase(TestCase):
         set_rating(self.book_1)
         self.book_1.refresh_from_db()
         self.assertEqual('4.67', str(self.book_1.rating))
+
+
+class UpdateRatingTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create(username='test_username1')
+        self.user2 = User.objects.create(username='test_username2')
+        self.book_1 = Book.objects.create(name='test book 1', price=25,
+                                          author_name='Author 1')
+        self.relation_1 = UserBookRelation.objects.create(user=self.user1,
+                                                          book=self.book_1,
+                                                          rate=5)
+        self.relation_2 = UserBookRelation.objects.create(user=self.user2,
+                                                          book=self.book_1,
+                                                          rate=4)
+
+    def assertRating(self, rating, rating_sum, rating_count):
+        self.book_1.refresh_from_db()
+        self.assertEqual(rating, self.book_1.rating and str(self.book_1.rating))
+        self.assertEqual(rating_sum, self.book_1.rating_sum)
+        self.assertEqual(rating_count, self.book_1.rating_count)
+
+    def test_create(self):
+        """Счётчики увеличиваются при создании оценок"""
+        self.assertRating('4.50', 9, 2)
+
+    def test_change_rate(self):
+        """Изменение оценки меняет только сумму"""
+        self.relation_2.rate = 2
+        self.relation_2.save()
+        self.assertRating('3.50', 7, 2)
+
+    def test_rate_to_null(self):
+        """Снятие оценки уменьшает сумму и количество"""
+        self.relation_2.rate = None
+        self.relation_2.save()
+        self.assertRating('5.00', 5, 1)
+
+    def test_all_null(self):
+        """Без оценок рейтинг пустой"""
+        self.relation_1.rate = None
+        self.relation_1.save()
+        self.relation_2.rate = None
+        self.relation_2.save()
+        self.assertRating(None, 0, 0)
+
+    def test_dirty_fields(self):
+        """Отношение помнит загруженные значения полей"""
+        relation = UserBookRelation.objects.get(id=self.relation_2.id)
+        self.assertFalse(relation.is_dirty())
+        relation.like = True
+        relation.rate = 1
+        self.assertEqual({'like': False, 'rate': 4},
+                         relation.get_dirty_fields())
+        self.assertTrue(relation.is_dirty('rate'))
+        relation.save()
+        self.assertFalse(relation.is_dirty())
+        self.assertRating('3.00', 6, 2)
+
+    def test_unique(self):
+        """У пользователя одно отношение к книге"""
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserBookRelation.objects.create(user=self.user1, book=self.book_1)
+        self.assertRating('4.50', 9, 2)
+
+    def test_delete(self):
+        """Удаление отношения убирает его оценку"""
+        self.relation_1.delete()
+        self.assertRating('4.00', 4, 1)
+
+    def test_rebuild(self):
+        """Пересчёт с нуля чинит разошедшиеся счётчики"""
+        Book.objects.filter(id=self.book_1.id).update(rating_sum=100,
+                                                      rating_count=1)
+        self.assertEqual([self.book_1.id],
+                         [book.id for book in find_rating_drift()])
+        with self.assertRaises(CommandError):
+            call_command('rebuild_ratings', '--check', stdout=StringIO())
+
+        self.assertEqual(1, rebuild_ratings())
+        self.assertRating('4.50', 9, 2)
+        self.assertFalse(find_rating_drift().exists())
+        call_command('rebuild_ratings', '--check', stdout=StringIO())
+
+
+class LikesCountTestCase(TestCase):
+    def setUp(self):
+        self.user1 = User.objects.create(username='test_username1')
+        self.user2 = User.objects.create(username='test_username2')
+        self.book_1 = Book.objects.create(name='test book 1', price=25,
+                                          author_name='Author 1')
+        self.book_2 = Book.objects.create(name='test book 2', price=55,
+                                          author_name='Author 2')
+        self.relation_1 = UserBookRelation.objects.create(user=self.user1,
+                                                          book=self.book_1,
+                                                          like=True)
+        self.relation_2 = UserBookRelation.objects.create(user=self.user2,
+                                                          book=self.book_1)
+
+    def assertLikes(self, book, likes_count):
+        book.refresh_from_db()
+        self.assertEqual(likes_count, book.likes_count)
+
+    def test_save(self):
+        """Лайк и его снятие меняют счётчик"""
+        self.assertLikes(self.book_1, 1)
+        self.relation_2.like = True
+        self.relation_2.save()
+        self.assertLikes(self.book_1, 2)
+        self.relation_1.like = False
+        self.relation_1.save()
+        self.assertLikes(self.book_1, 1)
+
+    def test_delete(self):
+        """Удаление отношения с лайком уменьшает счётчик"""
+        self.relation_1.delete()
+        self.assertLikes(self.book_1, 0)
+
+    def test_queryset_update_and_delete(self):
+        """Массовые update и delete не ломают счётчики"""
+        UserBookRelation.objects.create(user=self.user1, book=self.book_2)
+        UserBookRelation.objects.update(like=True, rate=4)
+        self.assertLikes(self.book_1, 2)
+        self.assertLikes(self.book_2, 1)
+        self.assertEqual('4.00', str(self.book_2.rating))
+
+        UserBookRelation.objects.filter(user=self.user1).delete()
+        self.assertLikes(self.book_1, 1)
+        self.assertLikes(self.book_2, 0)
+        self.assertEqual(None, self.book_2.rating)
+
+    def test_readers_count(self):
+        """Число читателей растёт при создании отношения и падает при
+        удалении"""
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.readers_count)
+        self.relation_2.delete()
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.readers_count)
+
+        Book.objects.update(readers_count=5)
+        self.assertEqual(2, find_readers_drift().count())
+        self.assertEqual(2, rebuild_readers())
+        self.assertFalse(find_readers_drift().exists())
+        call_command('rebuild_readers', '--check', stdout=StringIO())
+
+    def test_rebuild(self):
+        """Пересчёт с нуля чинит разошедшийся счётчик лайков"""
+        Book.objects.update(likes_count=10)
+        self.assertEqual(2, find_likes_drift().count())
+        with self.assertRaises(CommandError):
+            call_command('rebuild_likes', '--check', stdout=StringIO())
+
+        self.assertEqual(2, rebuild_likes())
+        self.assertLikes(self.book_1, 1)
+        self.assertLikes(self.book_2, 0)
+        call_command('rebuild_likes', '--check', stdout=StringIO())
+
+
+@override_settings(LEADERBOARD_SIZE=2)
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f'test_username{i}')
+                      for i in range(3)]
+        self.books = [Book.objects.create(name=f'test book {i}',
+                                          price=100 * (i + 3),
+                                          author_name='Author')
+                      for i in range(4)]
+
+    def like(self, user, book, like=True):
+        relation, _ = UserBookRelation.objects.get_or_create(user=user,
+                                                             book=book)
+        relation.like = like
+        relation.save()
+
+    def board(self, name):
+        return list(LeaderboardEntry.objects.filter(board=name).order_by(
+            '-score', 'book_id').values_list('book_id', flat=True))
+
+    def test_incremental(self):
+        """Лайки и оценки двигают книги по таблицам без пересчёта"""
+        book_0, book_1, book_2, book_3 = self.books
+        self.like(self.users[0], book_1)
+        self.like(self.users[1], book_1)
+        self.like(self.users[0], book_2)
+        self.like(self.users[1], book_3)
+        self.assertEqual([book_1.id, book_2.id], self.board('likes'))
+
+        # снятый лайк вытесняет книгу из заполненной таблицы
+        self.like(self.users[0], book_2, like=False)
+        self.assertEqual([book_1.id, book_3.id], self.board('likes'))
+        self.like(self.users[0], book_0)
+        self.like(self.users[2], book_0)
+        self.like(self.users[1], book_0)
+        self.assertEqual([book_0.id, book_1.id], self.board('likes'))
+
+        UserBookRelation.objects.filter(book=book_1).update(rate=5)
+        self.assertEqual([book_1.id], self.board('rating'))
+        self.assertEqual([book_1.id], self.board('rating-budget'))
+        self.assertEqual({}, find_leaderboard_drift())
+
+    def test_between(self):
+        """Книга между первым и последним местом вытесняет последнее"""
+        book_0, book_1, book_2, _ = self.books
+        for user in self.users:
+            self.like(user, book_0)
+        self.like(self.users[0], book_1)
+        self.assertEqual([book_0.id, book_1.id], self.board('likes'))
+        self.like(self.users[0], book_2)
+        self.like(self.users[1], book_2)
+        self.assertEqual([book_0.id, book_2.id], self.board('likes'))
+        self.assertEqual({}, find_leaderboard_drift())
+
+    def test_below_last_place(self):
+        """Лайк книги ниже последнего места заполненной таблицы - один
+        запрос, без блокировки и записи"""
+        book_0, book_1, book_2, _ = self.books
+        for user in self.users:
+            self.like(user, book_0)
+            self.like(user, book_1)
+        self.like(self.users[0], book_2)
+        self.assertEqual([book_0.id, book_1.id], self.board('likes'))
+
+        with mock.patch('store.leaderboards.lock_boards') as lock, \
+                self.assertNumQueries(1):
+            leaderboards.update_leaderboards([book_2.id], {'likes_count'})
+        lock.assert_not_called()
+
+        # вошла бы в таблицу - блокировка и пересчёт
+        Book.objects.filter(id=book_2.id).update(likes_count=4)
+        leaderboards.update_leaderboards([book_2.id], {'likes_count'})
+        self.assertEqual([book_2.id, book_0.id], self.board('likes'))
+        self.assertEqual({}, find_leaderboard_drift())
+
+    def test_price_filter(self):
+        """Смена цены переносит книгу в таблицу дешёвых книг и обратно"""
+        book = self.books[3]
+        UserBookRelation.objects.create(user=self.users[0], book=book,
+                                        rate=4)
+        self.assertEqual([book.id], self.board('rating'))
+        self.assertEqual([], self.board('rating-budget'))
+        book.refresh_from_db()
+        book.price = 100
+        book.save()
+        self.assertEqual([book.id], self.board('rating-budget'))
+        self.assertEqual({}, find_leaderboard_drift())
+
+    def test_delete_refill(self):
+        """Удалённая книга уходит из таблицы, её место занимает
+        следующая"""
+        for index, book in enumerate(self.books[:3]):
+            for user in self.users[:index + 1]:
+                self.like(user, book)
+        self.assertEqual([self.books[2].id, self.books[1].id],
+                         self.board('likes'))
+        self.books[2].delete()
+        self.assertEqual([self.books[1].id, self.books[0].id],
+                         self.board('likes'))
+        self.assertEqual({}, find_leaderboard_drift())
+
+    def test_rebuild(self):
+        """Пересчёт с нуля чинит разошедшиеся таблицы"""
+        self.like(self.users[0], self.books[0])
+        Book.objects.filter(id=self.books[1].id).update(likes_count=5)
+        self.assertEqual(['likes'], list(find_leaderboard_drift()))
+        with self.assertRaises(CommandError):
+            call_command('rebuild_leaderboards', '--check', stdout=StringIO())
+
+        self.assertEqual(2, rebuild_leaderboards())
+        self.assertEqual([self.books[1].id, self.books[0].id],
+                         self.board('likes'))
+        call_command('rebuild_leaderboards', '--check', stdout=StringIO())
+
+
+@override_settings(STORE_RATING_MODE='deferred')
+class DeferredRatingTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user{i}')
+                      for i in range(3)]
+        self.book_1 = Book.objects.create(name='1', price=25,
+                                          author_name='Author 1')
+        self.book_2 = Book.objects.create(name='2', price=55,
+                                          author_name='Author 2')
+
+    def test_coalesce(self):
+        """Оценки только помечают книгу, пересчёт один на книгу"""
+        for rate, user in zip((5, 4, 3), self.users):
+            UserBookRelation.objects.create(user=user, book=self.book_1,
+                                            rate=rate, like=True)
+        relation = UserBookRelation.objects.create(user=self.users[0],
+                                                   book=self.book_2)
+        relation.in_bookmarks = True
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual((None, 0, 0),
+                         (self.book_1.rating, self.book_1.likes_count,
+                          self.book_1.readers_count))
+        self.assertEqual([self.book_1.id, self.book_2.id], list(
+            DirtyBook.objects.order_by('book').values_list('book', flat=True)))
+
+        # SAVEPOINT, SELECT меток, DELETE меток, UPDATE книг, книги и места
+        # в таблицах лидеров, INSERT мест, RELEASE
+        with self.assertNumQueries(8):
+            self.assertEqual(2, process_dirty_books())
+        self.assertFalse(DirtyBook.objects.exists())
+        self.book_1.refresh_from_db()
+        self.assertEqual(('4.00', 12, 3, 3, 3),
+                         (str(self.book_1.rating), self.book_1.rating_sum,
+                          self.book_1.rating_count, self.book_1.likes_count,
+                          self.book_1.readers_count))
+        self.assertEqual(0, process_dirty_books())
+
+    def test_shards(self):
+        """Шарды разбирают только свои книги"""
+        UserBookRelation.objects.create(user=self.users[0], book=self.book_1,
+                                        rate=5)
+        UserBookRelation.objects.create(user=self.users[0], book=self.book_2,
+                                        rate=3)
+        shard = self.book_1.id % 2
+        self.assertEqual(1, process_dirty_books(shard=shard, shards=2))
+        self.assertEqual([self.book_2.id], list(
+            DirtyBook.objects.values_list('book', flat=True)))
+
+        out = StringIO()
+        call_command('process_rating_queue', stdout=out)
+        self.assertIn('Recomputed 1 books', out.getvalue())
+        self.book_2.refresh_from_db()
+        self.assertEqual('3.00', str(self.book_2.rating))
+        call_command('process_rating_queue', '--check', stdout=StringIO())
+
+    def test_mark_during_recompute(self):
+        """Метка, поставленная во время пересчёта, остаётся в очереди"""
+        UserBookRelation.objects.create(user=self.users[0], book=self.book_1,
+                                        rate=5)
+        recompute = logic.recompute_books
+
+        def recompute_and_rate(book_ids):
+            updated = recompute(book_ids)
+            # оценка после того, как пересчёт прочитал отношения
+            UserBookRelation.objects.create(user=self.users[1],
+                                            book=self.book_1, rate=1)
+            return updated
+
+        with mock.patch('store.logic.recompute_books', recompute_and_rate):
+            self.assertEqual(1, process_dirty_books())
+        self.assertEqual([self.book_1.id], list(
+            DirtyBook.objects.values_list('book', flat=True)))
+        self.assertEqual(1, process_dirty_books())
+        self.book_1.refresh_from_db()
+        self.assertEqual((6, 2), (self.book_1.rating_sum,
+                                  self.book_1.rating_count))
+
+    @override_settings(STORE_RATING_MAX_STALENESS=0)
+    def test_check_staleness(self):
+        """--check падает, если очередь отстала больше допустимого"""
+        UserBookRelation.objects.create(user=self.users[0], book=self.book_1,
+                                        rate=5)
+        with self.assertRaises(CommandError):
+            call_command('process_rating_queue', '--check', stdout=StringIO())
+
+
+class DatasetTestCase(TestCase):
+    databases = {'default', 'replica1'}
+
+    def generate(self, seed=0):
+        created = DatasetGenerator(seed=seed, batch_size=50).generate(
+            users=20, books=30, relations=200)
+        self.assertEqual({'users': 20, 'books': 30, 'relations': 200},
+                         created)
+        relations = list(UserBookRelation.objects.order_by(
+            'user_id', 'book_id').values_list(
+            'user__username', 'book__name', 'like', 'in_bookmarks', 'rate'))
+        books = list(Book.objects.order_by('id').values_list(
+            'name', 'price', 'owner__username'))
+        return relations, books
+
+    def test_reproducible(self):
+        """Один seed - одни и те же данные, счётчики сходятся"""
+        data = self.generate()
+        self.assertFalse(find_likes_drift().exists())
+        self.assertFalse(find_rating_drift().exists())
+        self.assertFalse(find_readers_drift().exists())
+        self.assertEqual({}, find_leaderboard_drift())
+        # популярность неравномерна
+        readers = sorted(Book.objects.values_list('readers_count', flat=True))
+        self.assertGreater(readers[-1], 2 * readers[len(readers) // 2])
+
+        self.clear()
+        self.assertEqual(data, self.generate())
+        self.clear()
+        self.assertNotEqual(data, self.generate(seed=1))
+
+    @staticmethod
+    def clear():
+        UserBookRelation.objects.all().delete()
+        Book.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_append(self):
+        """Повторная генерация дописывает новые данные"""
+        self.generate()
+        DatasetGenerator(seed=1).generate(users=5, books=5, relations=10)
+        self.assertEqual(35, Book.objects.count())
+        self.assertEqual(210, UserBookRelation.objects.count())
+        self.assertFalse(find_readers_drift().exists())
+
+    def test_other_database(self):
+        """Данные, счётчики и таблицы лидеров пишутся в БД using"""
+        DatasetGenerator(batch_size=50, using='replica1').generate(
+            users=20, books=30, relations=200)
+        self.assertFalse(Book.objects.exists())
+        self.assertFalse(LeaderboardEntry.objects.exists())
+        books = Book.objects.using('replica1')
+        self.assertEqual(30, books.count())
+        self.assertFalse(find_likes_drift(books).exists())
+        self.assertTrue(LeaderboardEntry.objects.using('replica1').exists())
+        self.assertEqual({}, find_leaderboard_drift(using='replica1'))
+
+
+class ConnectionPoolTestCase(TestCase):
+    def make_pool(self, **kwargs):
+        return db_pool.ConnectionPool('test', lambda: sqlite3.connect(
+            ':memory:', check_same_thread=False), **kwargs)
+
+    def test_reuse(self):
+        """Возвращённое соединение выдаётся снова"""
+        pool = self.make_pool(max_size=2)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(first, pool.acquire())
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertEqual({'size': 2, 'max_size': 2, 'in_use': 2, 'idle': 0,
+                          'waiting': 0, 'waits': 0, 'timeouts': 0,
+                          'opened': 2, 'closed': 0}, pool.stats())
+        self.assertIn('store_db_pool_connections{alias="test",'
+                      'state="in_use"} 2', metrics.render())
+
+    def test_wait_and_timeout(self):
+        """Без свободных соединений ждём освобождения, затем таймаут"""
+        pool = self.make_pool(max_size=1, timeout=5)
+        first = pool.acquire()
+        releaser = threading.Timer(0.05, pool.release, args=(first,))
+        releaser.start()
+        self.assertIs(first, pool.acquire())
+        releaser.join()
+
+        pool.timeout = 0.05
+        with self.assertRaises(db_pool.PoolTimeout):
+            pool.acquire()
+        stats = pool.stats()
+        self.assertEqual((2, 1, 1), (stats['waits'], stats['timeouts'],
+                                     stats['size']))
+
+    def test_broken_and_expired(self):
+        """Разорванное соединение из пула и соединение старше
+        max_lifetime заменяются новыми"""
+        pool = self.make_pool(check_after=0)
+        first = pool.acquire()
+        pool.release(first)
+        first.close()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+
+        pool.max_lifetime = 0
+        pool.release(second)
+        self.assertEqual((0, 2), (pool.stats()['idle'],
+                                  pool.stats()['closed']))
+
+    def test_backend(self):
+        """Бэкенд store.db берёт соединения из пула и возвращает их"""
+        backend = load_backend('store.db.backends.sqlite3')
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as file:
+            settings_dict = dict(connection.settings_dict, NAME=file.name,
+                                 POOL={'MAX_SIZE': 2},
+                                 CONN_HEALTH_CHECKS=True)
+            wrapper = backend.DatabaseWrapper(settings_dict, alias='pooled')
+            try:
+                with wrapper.cursor() as cursor:
+                    cursor.execute('CREATE TABLE t (id integer)')
+                raw = wrapper.connection
+                wrapper.close()
+                self.assertEqual(1, wrapper.pool.stats()['idle'])
+                with wrapper.cursor() as cursor:
+                    cursor.execute('SELECT * FROM t')
+                self.assertIs(raw, wrapper.connection)
+                self.assertEqual(1, wrapper.pool.stats()['in_use'])
+
+                # проверка соединения в начале следующего запроса к сайту
+                wrapper.close_if_unusable_or_obsolete()
+                with mock.patch.object(wrapper, 'is_usable',
+                                       return_value=False):
+                    wrapper.ensure_connection()
+                self.assertIsNot(raw, wrapper.connection)
+                self.assertEqual(1, wrapper.pool.stats()['closed'])
+            finally:
+                wrapper.close()
+                wrapper.pool.close_all()
+                db_pool._pools.pop('pooled', None)
+
+
+class SqliteTuningTestCase(TestCase):
+    pragmas = {'journal_mode': 'wal', 'synchronous': 'normal',
+               'cache_size': -2048, 'busy_timeout': 1234,
+               'temp_store': 'memory'}
+
+    def read_pragmas(self, pragmas):
+        backend = load_backend('django.db.backends.sqlite3')
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as file:
+            wrapper = backend.DatabaseWrapper(
+                dict(connection.settings_dict, NAME=file.name),
+                alias='tuned')
+            try:
+                with override_settings(SQLITE_PRAGMAS=pragmas):
+                    wrapper.ensure_connection()
+                values = {}
+                with wrapper.cursor() as cursor:
+                    for name in self.pragmas:
+                        cursor.execute(f'PRAGMA {name}')
+                        values[name] = cursor.fetchone()[0]
+                return values
+            finally:
+                wrapper.close()
+
+    def test_pragmas(self):
+        """SQLITE_PRAGMAS выполняются при открытии соединения"""
+        self.assertEqual({'journal_mode': 'wal', 'synchronous': 1,
+                          'cache_size': -2048, 'busy_timeout': 1234,
+                          'temp_store': 2}, self.read_pragmas(self.pragmas))
+
+    def test_disabled(self):
+        """Без SQLITE_PRAGMAS соединение не настраивается"""
+        self.assertEqual('delete', self.read_pragmas({})['journal_mode'])
+
+    def test_bad_pragma(self):
+        with override_settings(SQLITE_PRAGMAS={'journal_mode': 'wal; --'}):
+            with self.assertRaises(ValueError):
+                apply_pragmas(connection)
+
+
+@override_settings(SQLITE_LOCKED_RETRY_DELAY=0, SQLITE_LOCKED_RETRIES=3)
+class RetryOnLockedTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book = Book.objects.create(name='Test book 1', price=25,
+                                        author_name='Author 1')
+
+    def flaky(self, func, failures):
+        """func, первые failures вызовов которой - «database is locked»."""
+        calls = []
+
+        def wrapper(*args, **kwargs):
+            calls.append(args)
+            if len(calls) <= failures:
+                raise OperationalError('database is locked')
+            return func(*args, **kwargs)
+        return wrapper, calls
+
+    def test_retry(self):
+        func, calls = self.flaky(lambda: 'done', 2)
+        self.assertEqual('done', retry_on_locked(func)())
+        self.assertEqual(3, len(calls))
+
+        func, calls = self.flaky(lambda: 'done', 3)
+        with self.assertRaises(OperationalError):
+            retry_on_locked(func)()
+        self.assertEqual(3, len(calls))
+
+    def test_other_errors(self):
+        """Другие ошибки и ошибки внутри внешней транзакции не
+        повторяются"""
+        def broken():
+            calls.append(1)
+            raise OperationalError('no such table: t')
+
+        calls = []
+        with self.assertRaises(OperationalError):
+            retry_on_locked(broken)()
+        self.assertEqual(1, len(calls))
+
+        func, calls = self.flaky(lambda: 'done', 1)
+        with transaction.atomic():
+            with self.assertRaises(OperationalError):
+                retry_on_locked(func)()
+        self.assertEqual(1, len(calls))
+
+    def test_relation_save(self):
+        """Отношение и счётчики книги после повтора записаны один раз"""
+        name = 'UserBookRelation._save_with_counters'
+        retries = metrics.DB_LOCKED_RETRIES.get(name)
+        flaky, calls = self.flaky(logic.update_book_counters, 1)
+        relation = UserBookRelation(user=self.user, book=self.book,
+                                    like=True, rate=5)
+        with mock.patch('store.logic.update_book_counters', flaky):
+            relation.save()
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, UserBookRelation.objects.count())
+        self.book.refresh_from_db()
+        self.assertEqual((1, 1, 5, 1), (
+            self.book.readers_count, self.book.likes_count,
+            self.book.rating_sum, self.book.rating_count))
+
+        relation.rate = 3
+        flaky, calls = self.flaky(logic.update_book_counters, 1)
+        with mock.patch('store.logic.update_book_counters', flaky):
+            relation.save()
+        self.book.refresh_from_db()
+        self.assertEqual((3, 1), (self.book.rating_sum,
+                                  self.book.rating_count))
+        self.assertEqual(retries + 2, metrics.DB_LOCKED_RETRIES.get(name))
+
+
+@override_settings(SQLITE_LOCKED_RETRIES=200, SQLITE_LOCKED_RETRY_DELAY=0.001)
+class ConcurrentRatingTestCase(TransactionTestCase):
+    threads = 6
+    rounds = 15
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.users = [User.objects.create(username=f'reader{index}')
+                      for index in range(self.threads)]
+        self.book = Book.objects.create(name='Test book 1', price=25,
+                                        author_name='Author 1',
+                                        owner=self.owner)
+
+    def run_threads(self, targets):
+        errors = []
+
+        def run(target):
+            try:
+                target()
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(target,))
+                   for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+    def rate(self, user, index):
+        # чтения и INSERT в общем кэше in-memory БД тоже ловят блокировку
+        relation = retry_on_locked(UserBookRelation.objects.create)(
+            user=user, book=self.book)
+        for number in range(self.rounds):
+            relation.rate = (index + number) % 5 + 1
+            relation.like = not relation.like
+            relation.save()
+            if number % 5 == 0:
+                retry_on_locked(lambda: set_rating(
+                    Book.objects.get(id=self.book.id)))()
+
+    def edit(self):
+        @retry_on_locked
+        def edit(price):
+            # книга загружена до чужих оценок и сохраняется целиком
+            book = Book.objects.get(id=self.book.id)
+            time.sleep(0.001)
+            book.price = price
+            book.save()
+
+        for number in range(self.rounds):
+            edit(100 + number)
+
+    def test_concurrent_rates(self):
+        """Одновременные оценки одной книги и правки владельца не
+        затирают друг друга"""
+        started = time.perf_counter()
+        self.run_threads([
+            lambda user=user, index=index: self.rate(user, index)
+            for index, user in enumerate(self.users)] + [self.edit])
+        elapsed = time.perf_counter() - started
+
+        self.book.refresh_from_db()
+        rates = [(index + self.rounds - 1) % 5 + 1
+                 for index in range(self.threads)]
+        self.assertEqual((sum(rates), len(rates)), (
+            self.book.rating_sum, self.book.rating_count))
+        self.assertAlmostEqual(sum(rates) / len(rates),
+                               float(self.book.rating), places=2)
+        # после нечётного числа переключений лайк стоит
+        self.assertEqual(self.threads * (self.rounds % 2),
+                         self.book.likes_count)
+        self.assertEqual(self.threads, self.book.readers_count)
+        self.assertEqual(100 + self.rounds - 1, self.book.price)
+        self.assertEqual([], list(find_rating_drift()))
+        self.assertEqual([], list(find_likes_drift()))
+        self.assertEqual({}, find_leaderboard_drift())
+        # не меньше десятка записей в секунду даже с повторами
+        saves = self.threads * self.rounds
+        self.assertGreater(saves / elapsed, 10)
+
+
+@override_settings(LEADERBOARD_SIZE=2, SQLITE_LOCKED_RETRIES=50,
+                   SQLITE_LOCKED_RETRY_DELAY=0.001,
+                   LEADERBOARDS={'likes': {'field': 'likes_count'}})
+class ConcurrentLeaderboardTestCase(TransactionTestCase):
+    def setUp(self):
+        self.books = [Book.objects.create(name=f'Test book {index}',
+                                          price=100, author_name='Author',
+                                          likes_count=likes)
+                      for index, likes in enumerate([5, 4, 0, 0])]
+        rebuild_leaderboards()
+
+    def test_different_books(self):
+        """Книги, одновременно вошедшие в таблицу, не вытесняют одно и то
+        же место и не раздувают таблицу"""
+        checked, barrier = threading.Barrier(2), \
+            threading.Barrier(2, timeout=0.3)
+        book_rows, update_board = leaderboards._book_rows, \
+            leaderboards._update_board
+        errors = []
+
+        def check(*args, positions=False):
+            # проверка без блокировки - в обоих потоках до блокировки:
+            # общий кэш SQLite не пускает читать таблицу, в которую пишут
+            rows = book_rows(*args, positions=positions)
+            if positions:
+                checked.wait(timeout=5)
+            return rows
+
+        def wait_and_update(*args):
+            # оба потока прочитали места до того, как кто-то их изменил,
+            # если блокировки нет; с блокировкой второй ждёт первого
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            return update_board(*args)
+
+        def run(book_id):
+            try:
+                leaderboards.update_leaderboards([book_id])
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        # лайки записаны, места обновляются одновременно
+        Book.objects.filter(id=self.books[2].id).update(likes_count=10)
+        Book.objects.filter(id=self.books[3].id).update(likes_count=9)
+        threads = [threading.Thread(target=run, args=(book.id,))
+                   for book in self.books[2:]]
+        with mock.patch('store.leaderboards._book_rows', check), \
+                mock.patch('store.leaderboards._update_board',
+                           wait_and_update):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual([self.books[2].id, self.books[3].id], list(
+            LeaderboardEntry.objects.filter(board='likes').order_by(
+                '-score', 'book_id').values_list('book_id', flat=True)))
+        self.assertEqual({}, find_leaderboard_drift())
+
+
+class MigrationTestCase(TransactionTestCase):
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+
+class SearchIndexMigrationTestCase(MigrationTestCase):
+    def search(self, word):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rowid FROM store_book_fts '
+                           'WHERE store_book_fts MATCH %s', [word])
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_install(self):
+        """Миграция 0011 ставит FTS5-индекс с триггерами по существующим
+        книгам, откат его убирает"""
+        backend = SQLiteFTSBackend()
+        apps = self.migrate([('store', '0010_book_updated_at')])
+        self.assertFalse(backend.is_available(connection))
+        Book = apps.get_model('store', 'Book')
+        book = Book.objects.create(name='Python', price=25,
+                                   author_name='Author 1')
+
+        apps = self.migrate([('store', '0011_book_search_index')])
+        self.assertTrue(backend.is_available(connection))
+        self.assertEqual([book.id], self.search('python'))
+        Book = apps.get_model('store', 'Book')
+        Book.objects.filter(id=book.id).update(name='Django')
+        self.assertEqual([], self.search('python'))
+        self.assertEqual([book.id], self.search('django'))
+
+
+class DedupeRelationsMigrationTestCase(MigrationTestCase):
+    before = [('store', '0011_book_search_index')]
+    after = [('store', '0012_relation_indexes')]
+
+    def test_dedupe(self):
+        """Миграция 0012 сливает дубли отношений и пересчитывает счётчики"""
+        apps = self.migrate(self.before)
+        User = apps.get_model('auth', 'User')
+        Book = apps.get_model('store', 'Book')
+        Relation = apps.get_model('store', 'UserBookRelation')
+        user_1 = User.objects.create(username='user_1')
+        user_2 = User.objects.create(username='user_2')
+        book = Book.objects.create(name='Test book 1', price=25,
+                                   author_name='Author 1', rating_sum=99,
+                                   rating_count=9, likes_count=9,
+                                   readers_count=9)
+        other = Book.objects.create(name='Test book 2', price=55,
+                                    author_name='Author 2', likes_count=7)
+        first = Relation.objects.create(user=user_1, book=book, rate=2)
+        Relation.objects.create(user=user_1, book=book, like=True)
+        Relation.objects.create(user=user_1, book=book, rate=4,
+                                in_bookmarks=True)
+        Relation.objects.create(user=user_2, book=book, rate=5, like=True)
+
+        apps = self.migrate(self.after)
+        Book = apps.get_model('store', 'Book')
+        Relation = apps.get_model('store', 'UserBookRelation')
+        survivor = Relation.objects.get(user=user_1.id, book=book.id)
+        self.assertEqual(first.id, survivor.id)
+        # лайк и закладка - если были хоть в одном дубле, оценка -
+        # последняя
+        self.assertEqual((True, True, 4), (
+            survivor.like, survivor.in_bookmarks, survivor.rate))
+        self.assertEqual(2, Relation.objects.count())
+
+        book = Book.objects.get(id=book.id)
+        self.assertEqual((9, 2, 2, 2), (
+            book.rating_sum, book.rating_count, book.likes_count,
+            book.readers_count))
+        self.assertEqual(Decimal('4.50'), book.rating)
+        # книги без дублей не пересчитываются
+        self.assertEqual(7, Book.objects.get(id=other.id).likes_count)
@@ -1,9 +1,19 @@
+import datetime
+import decimal
+import io
+from collections import OrderedDict
+
 from django.contrib.auth.models import User
-from django.db.models import Count, Case, When
 from django.test import TestCase
 
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
 from store.models import Book, UserBookRelation
-from store.serializers import BookSerializer
+from store.renderers import ORJSONParser, ORJSONRenderer
+from store.serializers import BookSerializer, BookWithReadersSerializer, \
+    FastBookSerializer
 
 
 class BookSerializerTestCase(TestCase):
@@ -36,10 +46,7 @@ class BookSerializerTestCase(TestCase):
                                         rate=4)
         UserBookRelation.objects.create(user=user3, book=book_2, like=False)
 
-        books = Book.objects.all().annotate(
-            annotated_likes=Count(
-                Case(When(userbookrelation__like=True, then=1))),
-        ).order_by('id')
+        books = Book.objects.all().order_by('id')
         data = BookSerializer(books, many=True).data
         expected_data = [
             {
@@ -50,7 +57,8 @@ class BookSerializerTestCase(TestCase):
                 'annotated_likes': 3,
                 'rating': '4.67',
                 'owner_name': 'test_username1',
-                'readers': [
+                'readers_count': 3,
+                'readers_preview': [
                     {
                         'first_name': 'Ivan',
                         'last_name': 'Petrov',
@@ -73,7 +81,8 @@ class BookSerializerTestCase(TestCase):
                 'annotated_likes': 2,
                 'rating': '3.50',
                 'owner_name': '',
-                'readers': [
+                'readers_count': 3,
+                'readers_preview': [
                     {
                         'first_name': 'Ivan',
                         'last_name': 'Petrov',
@@ -93,3 +102,88 @@ class BookSerializerTestCase(TestCase):
         print(expected_data[0])
         print(data[0])
         self.assertEqual(expected_data, data)
+
+        legacy_data = BookWithReadersSerializer(books, many=True).data
+        self.assertEqual(['id', 'name', 'price', 'author_name',
+                          'annotated_likes', 'rating', 'owner_name',
+                          'readers'], list(legacy_data[0]))
+        self.assertEqual(expected_data[0]['readers_preview'],
+                         legacy_data[0]['readers'])
+
+
+class FastBookSerializerTestCase(TestCase):
+    def setUp(self):
+        users = [User.objects.create(username=f'user{i}',
+                                     first_name=f'Имя {i}', last_name='')
+                 for i in range(5)]
+        prices = ('25', '0.5', '99999.99', '1234.5')
+        for i, price in enumerate(prices):
+            book = Book.objects.create(name=f'book "{i}"', price=price,
+                                       author_name=f'Автор {i}',
+                                       owner=users[i] if i % 2 else None)
+            for user, rate in zip(users[:i + 2], (5, 4, 1, 2, 3)):
+                UserBookRelation.objects.create(user=user, book=book,
+                                                like=bool(rate % 2),
+                                                rate=rate if i else None)
+        Book.objects.create(name='empty', price=1, author_name='')
+
+    def render(self, serializer):
+        return JSONRenderer().render(serializer.data)
+
+    def test_parity(self):
+        """Вывод быстрого сериализатора совпадает с BookSerializer
+        байт в байт"""
+        books = Book.objects.select_related('owner').order_by('id')
+        rows = Book.objects.order_by('id').values(
+            *FastBookSerializer.get_columns())
+        self.assertEqual(self.render(BookSerializer(books, many=True)),
+                         self.render(FastBookSerializer(rows)))
+
+    def test_parity_sparse_fields(self):
+        """Совпадает и урезанный набор полей"""
+        fields = ['name', 'rating', 'owner_name', 'readers_preview']
+        books = Book.objects.select_related('owner').order_by('id')
+        rows = Book.objects.order_by('id').values(
+            *FastBookSerializer.get_columns(fields))
+        with self.assertNumQueries(2):
+            fast = self.render(FastBookSerializer(rows, fields=fields))
+        self.assertEqual(
+            self.render(BookSerializer(books, many=True, fields=fields)),
+            fast)
+
+
+class ORJSONRendererTestCase(TestCase):
+    def test_same_output(self):
+        """orjson даёт те же байты, что и JSONRenderer"""
+        data = [OrderedDict([
+            ('name', 'Война и мир "1"\\ \u2028 \u2029 \x1f 😀'),
+            ('price', '25.00'),
+            ('rating', None),
+            ('nested', {1: [True, False, 0, -7]}),
+        ])]
+        self.assertEqual(JSONRenderer().render(data),
+                         ORJSONRenderer().render(data))
+
+    def test_fallbacks(self):
+        """Decimal строкой, остальное как в JSONRenderer"""
+        renderer = ORJSONRenderer()
+        moment = datetime.datetime(2020, 11, 1, 18, 35, 1, 123456)
+        self.assertEqual(b'{"rating":"5.00"}', renderer.render(
+            {'rating': decimal.Decimal('5.00')}))
+        self.assertEqual(JSONRenderer().render({'at': moment}),
+                         renderer.render({'at': moment}))
+        self.assertEqual(b'[18446744073709551616]',
+                         renderer.render([2 ** 64]))
+        self.assertEqual(JSONRenderer().render({'a': 1}, 'application/json; '
+                                                         'indent=2'),
+                         renderer.render({'a': 1}, 'application/json; '
+                                                   'indent=2'))
+        self.assertEqual(b'', renderer.render(None))
+
+    def test_parser(self):
+        """orjson разбирает тело так же, как JSONParser"""
+        body = '{"name": "книга", "rate": 5, "like": true}'.encode()
+        self.assertEqual(JSONParser().parse(io.BytesIO(body)),
+                         ORJSONParser().parse(io.BytesIO(body)))
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"name": NaN}'))
@@ -1,27 +1,272 @@
-from django.db.models import Count, Case, When
-from django.shortcuts import render
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, FilteredRelation, Prefetch, Q, Value, \
+    prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from django.shortcuts import render, get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import mixins
-from rest_framework.filters import SearchFilter, OrderingFilter
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.viewsets import ModelViewSet, GenericViewSet
+from rest_framework import mixins, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.filters import OrderingFilter
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
+from rest_framework.response import Response
+from rest_framework.viewsets import ModelViewSet, GenericViewSet, ViewSet
 
+from store.leaderboards import get_board
+from store.logic import bulk_upsert_relations
+from store.mixins import CachedResponseMixin, ConditionalGetMixin, \
+    ReplicaReadMixin
 from store.models import Book, UserBookRelation
+from store.pagination import KeysetPagination
 from store.permissions import IsOwnerOrStaffOrReadOnly
-from store.serializers import BookSerializer, UserBookRelationSerializer
+from store.querybudget import query_budget
+from store.renderers import ORJSONRenderer
+from store.search import FullTextSearchFilter
+from store.serializers import BookSerializer, UserBookRelationSerializer, \
+    BookWithReadersSerializer, BookReaderSerializer, READERS_PREVIEW_SIZE, \
+    UserBookRelationBulkSerializer, FastBookSerializer, first_readers, \
+    PersonalBookSerializer, PersonalFastBookSerializer
 
 
-class BookViewSet(ModelViewSet):
-    queryset = Book.objects.all().annotate(
-        annotated_likes=Count(Case(When(userbookrelation__like=True, then=1))),
-        # rating=Avg('userbookrelation__rate')
-    ).select_related('owner').prefetch_related('readers').order_by('id')
+def readers_preview_prefetch(size=READERS_PREVIEW_SIZE):
+    """Первые size читателей каждой книги одним запросом."""
+    return Prefetch(
+        'userbookrelation_set',
+        queryset=first_readers(size).select_related('user'),
+        to_attr='readers_preview_relations')
+
+
+def my_relations_annotations(user):
+    """my_like, my_bookmark и my_rate пользователя одним LEFT JOIN
+    к его отношениям."""
+    return {
+        'my_relation': FilteredRelation(
+            'userbookrelation', condition=Q(userbookrelation__user=user)),
+        'my_like': Coalesce(F('my_relation__like'), Value(False)),
+        'my_bookmark': Coalesce(F('my_relation__in_bookmarks'),
+                                Value(False)),
+        'my_rate': F('my_relation__rate'),
+    }
+
+
+class BookViewSet(ReplicaReadMixin, CachedResponseMixin, ConditionalGetMixin,
+                  ModelViewSet):
+    queryset = Book.objects.all().order_by('id')
     permission_classes = [IsOwnerOrStaffOrReadOnly]
     serializer_class = BookSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    pagination_class = KeysetPagination
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter,
+                       OrderingFilter]
     filter_fields = ['price']
     search_fields = ['name', 'author_name']
     ordering_fields = ['price', 'author_name']
+    # ?readers=full - старый формат с полным списком читателей
+    readers_query_param = 'readers'
+    # ?fields=id,name или ?exclude=readers_preview - урезанная выдача
+    fields_query_param = 'fields'
+    exclude_query_param = 'exclude'
+    # /book/export/?export_format=ndjson|json
+    export_format_query_param = 'export_format'
+    export_content_types = {
+        'ndjson': 'application/x-ndjson',
+        'json': 'application/json',
+    }
+    export_chunk_size = 500
+    # не больше стольких запросов к БД на действие, см. store.querybudget;
+    # export читает БД уже при отдаче ответа и не проверяется
+    query_budgets = {
+        # страница, первые читатели (или все при ?readers=full), проверка
+        # FTS-индекса при первом запросе процесса
+        'list': 3,
+        'retrieve': 3,
+        'readers': 2,
+        'create': 2,
+        # + места в таблицах лидеров при смене цены: два чтения, DELETE
+        # и INSERT
+        'update': 7,
+        'partial_update': 7,
+        # каскадное удаление отношений, отметок и мест, добор таблиц
+        # лидеров, из которых выбыла книга
+        'destroy': 16,
+    }
+    # ?my_relations=1 - лайк, закладка и оценка вошедшего пользователя
+    my_relations_query_param = 'my_relations'
+    personal_serializer_class = PersonalBookSerializer
+    # список из строк .values() без ModelSerializer, None - выключено
+    fast_serializer_class = FastBookSerializer
+    personal_fast_serializer_class = PersonalFastBookSerializer
+    # колонки Book, нужные полям сериализатора
+    field_columns = {
+        'id': ['id'],
+        'name': ['name'],
+        'price': ['price'],
+        'author_name': ['author_name'],
+        'annotated_likes': ['likes_count'],
+        'rating': ['rating'],
+        'owner_name': ['owner__username'],
+        'readers_count': ['readers_count'],
+    }
+
+    def full_readers_requested(self):
+        return self.request.query_params.get(
+            self.readers_query_param) == 'full'
+
+    def is_personal_response(self):
+        return self.request.query_params.get(
+            self.my_relations_query_param) in ('1', 'true') and \
+            self.request.method in SAFE_METHODS and \
+            self.action != 'readers' and \
+            not self.full_readers_requested() and \
+            self.request.user.is_authenticated
+
+    def _get_list_param(self, name):
+        value = self.request.query_params.get(name, '')
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    def get_requested_fields(self):
+        """Поля из ?fields=/?exclude=, None - если выдача не урезана."""
+        if self.request.method not in SAFE_METHODS or \
+                self.action == 'readers':
+            return None
+        fields = self._get_list_param(self.fields_query_param)
+        exclude = self._get_list_param(self.exclude_query_param)
+        if not fields and not exclude:
+            return None
+        return [
+            field for field in self.get_serializer_class().Meta.fields
+            if (not fields or field in fields) and field not in exclude
+        ]
+
+    def use_fast_serializer(self):
+        return self.fast_serializer_class is not None and \
+            self.action == 'list' and not self.full_readers_requested()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'readers':
+            return queryset
+
+        requested_fields = self.get_requested_fields()
+        fields = requested_fields
+        if fields is None:
+            fields = self.get_serializer_class().Meta.fields
+        if self.is_personal_response() and \
+                {'my_like', 'my_bookmark', 'my_rate'} & set(fields):
+            queryset = queryset.annotate(
+                **my_relations_annotations(self.request.user))
+        if self.use_fast_serializer():
+            columns = self.get_fast_serializer_class().get_columns(fields)
+            # updated_at - для ETag, ключи сортировки - для курсора
+            columns.append(self.last_modified_field)
+            columns += [ordering.lstrip('-') for ordering in
+                        OrderingFilter().get_ordering(
+                            self.request, queryset, self) or []]
+            return queryset.values(*dict.fromkeys(columns))
+        if 'owner_name' in fields:
+            queryset = queryset.select_related('owner')
+        if 'readers' in fields:
+            queryset = queryset.prefetch_related('readers')
+        if 'readers_preview' in fields:
+            queryset = queryset.prefetch_related(readers_preview_prefetch())
+
+        if requested_fields is not None:
+            # updated_at нужен для ETag
+            columns = {'id', self.last_modified_field}
+            for field in requested_fields:
+                columns.update(self.field_columns.get(field, []))
+            # ключи сортировки нужны пагинации для курсора
+            for ordering in OrderingFilter().get_ordering(
+                    self.request, queryset, self) or []:
+                columns.add(ordering.lstrip('-'))
+            queryset = queryset.only(*sorted(columns))
+        return queryset
+
+    def get_serializer_class(self):
+        if self.full_readers_requested():
+            return BookWithReadersSerializer
+        if self.is_personal_response():
+            return self.personal_serializer_class
+        return super().get_serializer_class()
+
+    def get_fast_serializer_class(self):
+        if self.is_personal_response():
+            return self.personal_fast_serializer_class
+        return self.fast_serializer_class
+
+    def get_serializer(self, *args, **kwargs):
+        requested_fields = self.get_requested_fields()
+        if requested_fields is not None:
+            kwargs['fields'] = requested_fields
+        if self.use_fast_serializer():
+            kwargs.setdefault('context', self.get_serializer_context())
+            return self.get_fast_serializer_class()(*args, **kwargs)
+        return super().get_serializer(*args, **kwargs)
+
+    @action(detail=True, methods=['get'])
+    def readers(self, request, pk=None):
+        """Полный список читателей книги с пагинацией."""
+        book = get_object_or_404(Book.objects.only('id'), pk=pk)
+        relations = UserBookRelation.objects.filter(
+            book=book).select_related('user').order_by('id')
+        page = self.paginate_queryset(relations)
+        serializer = BookReaderSerializer(
+            [relation.user for relation in page], many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Весь каталог потоком: NDJSON или JSON-массив
+        (?export_format=json), с теми же фильтрами, что и список."""
+        export_format = request.query_params.get(
+            self.export_format_query_param, 'ndjson')
+        if export_format not in self.export_content_types:
+            raise ValidationError({self.export_format_query_param: [
+                f'Expected one of: {", ".join(self.export_content_types)}.']})
+
+        queryset = self.filter_queryset(self.get_queryset())
+        # iterator() не выполняет prefetch_related, делаем его по пачкам;
+        # БД фиксируем сейчас, пока известен маршрут запроса
+        lookups = queryset._prefetch_related_lookups
+        queryset = queryset.prefetch_related(None).using(queryset.db)
+        # стабильный порядок при равных ключах сортировки
+        queryset = queryset.order_by(*queryset.query.order_by, 'pk')
+        response = StreamingHttpResponse(
+            self.stream_export(queryset, lookups, export_format),
+            content_type=self.export_content_types[export_format])
+        response['Content-Disposition'] = \
+            f'attachment; filename="books.{export_format}"'
+        return response
+
+    def stream_export(self, queryset, lookups, export_format):
+        renderer = ORJSONRenderer()
+        first = True
+        if export_format == 'json':
+            yield b'['
+        for chunk in self.iter_chunks(queryset, lookups):
+            data = self.get_serializer(chunk, many=True).data
+            if export_format == 'ndjson':
+                yield b''.join(renderer.render(item) + b'\n'
+                               for item in data)
+                continue
+            items = b','.join(renderer.render(item) for item in data)
+            yield items if first else b',' + items
+            first = False
+        if export_format == 'json':
+            yield b']'
+
+    def iter_chunks(self, queryset, lookups):
+        chunk = []
+        for book in queryset.iterator(chunk_size=self.export_chunk_size):
+            chunk.append(book)
+            if len(chunk) == self.export_chunk_size:
+                prefetch_related_objects(chunk, *lookups)
+                yield chunk
+                chunk = []
+        if chunk:
+            prefetch_related_objects(chunk, *lookups)
+            yield chunk
 
     def perform_create(self, serializer):
         serializer.validated_data['owner'] = self.request.user
@@ -33,12 +278,122 @@ class UserBooksRelationView(mixins.UpdateModelMixin, GenericViewSet):
     queryset = UserBookRelation.objects.all()
     serializer_class = UserBookRelationSerializer
     lookup_field = 'book'
+    bulk_max_size = 500
+    # SELECT отношения, его INSERT или UPDATE, UPDATE счётчиков книги,
+    # проверка мест в таблицах лидеров - обычно на этом всё; если книга
+    # входит в таблицу или сдвигается - ещё чтение мест, DELETE и INSERT,
+    # а в PostgreSQL - блокировка и повторное чтение книги
+    query_budgets = {'update': 9, 'partial_update': 9}
 
     def get_object(self):
-        obj, _ = UserBookRelation.objects.get_or_create(user=self.request.user,
-                                                        book_id=self.kwargs['book'])
-        return obj
+        try:
+            return UserBookRelation.objects.get(user=self.request.user,
+                                                book_id=self.kwargs['book'])
+        except UserBookRelation.DoesNotExist:
+            # первая отметка книги - один INSERT со значениями из запроса,
+            # а не INSERT по умолчанию и UPDATE следом
+            return UserBookRelation(user=self.request.user,
+                                    book_id=self.kwargs['book'])
+
+    def perform_update(self, serializer):
+        if serializer.instance.pk is not None:
+            serializer.save()
+            return
+        try:
+            with transaction.atomic():
+                serializer.save()
+        except IntegrityError:
+            # параллельный запрос успел создать то же отношение
+            serializer.instance = self.get_object()
+            serializer.save()
+
+    # UPDATE счётчиков на каждый вид изменения - одинаковые запросы
+    # с разными параметрами, это не N+1
+    @query_budget(repeats=0)
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Пачка {book, like, in_bookmarks, rate}: ошибки в отдельных
+        элементах возвращаются по индексу, остальные применяются."""
+        if not isinstance(request.data, list):
+            raise ValidationError({'non_field_errors': ['Expected a list.']})
+        if len(request.data) > self.bulk_max_size:
+            raise ValidationError({'non_field_errors': [
+                f'Ensure this list has at most {self.bulk_max_size} items.']})
+
+        errors, items = {}, {}
+        for index, data in enumerate(request.data):
+            serializer = UserBookRelationBulkSerializer(data=data)
+            if not serializer.is_valid():
+                errors[index] = serializer.errors
+            elif serializer.validated_data['book'] in items:
+                errors[index] = {'book': ['Duplicate book in batch.']}
+            else:
+                items[serializer.validated_data['book']] = \
+                    (index, serializer.validated_data)
+
+        known = set(Book.objects.filter(id__in=list(items)).values_list(
+            'id', flat=True))
+        for book_id in list(items):
+            if book_id not in known:
+                index, _ = items.pop(book_id)
+                errors[index] = {'book': [
+                    f'Invalid pk "{book_id}" - object does not exist.']}
+
+        created = bulk_upsert_relations(
+            request.user, [data for _, data in items.values()])
+        return Response({
+            'results': [{'index': index, 'book': book_id,
+                         'created': created[book_id]}
+                        for book_id, (index, _) in items.items()],
+            'errors': [{'index': index, 'errors': errors[index]}
+                       for index in sorted(errors)],
+        }, status=status.HTTP_200_OK if items or not errors
+            else status.HTTP_400_BAD_REQUEST)
+
+
+class LeaderboardViewSet(ReplicaReadMixin, ViewSet):
+    """GET /leaderboard/ - названия таблиц лидеров,
+    GET /leaderboard/<название>/?limit=10 - места с книгами в формате
+    списка книг, без превью читателей."""
+    limit_query_param = 'limit'
+    # места и книги на них
+    query_budgets = {'list': 0, 'retrieve': 2}
+
+    def list(self, request):
+        return Response(list(settings.LEADERBOARDS))
+
+    def retrieve(self, request, pk=None):
+        board = get_board(pk)
+        if board is None:
+            raise NotFound()
+        entries = list(board.entries().values_list(
+            'book_id', 'score')[:self.get_limit(request, board)])
+        fields = [field for field in BookSerializer.Meta.fields
+                  if field != FastBookSerializer.readers_preview_field]
+        rows = {row['id']: row for row in Book.objects.filter(
+            id__in=[book_id for book_id, _ in entries]).values(
+            *FastBookSerializer.get_columns(fields))}
+        # книга может быть удалена между запросами
+        entries = [(book_id, score) for book_id, score in entries
+                   if book_id in rows]
+        books = FastBookSerializer([rows[book_id] for book_id, _ in entries],
+                                   fields=fields).data
+        return Response({
+            'board': board.name,
+            'field': board.field,
+            'results': [{'position': position, 'score': score, 'book': book}
+                        for position, ((_, score), book)
+                        in enumerate(zip(entries, books), 1)],
+        })
 
+    def get_limit(self, request, board):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return board.size
+        if limit <= 0:
+            return board.size
+        return min(limit, board.size)
 
 
 def auth(request):